@@ -0,0 +1,603 @@
+# Benchmarks and validation checks for the model implementation in mlserver-model.
+# Can be run locally, outside the ML server; see the README for the available benchmarks.
+
+# usage example:
+#   python benchmark.py flagging --nls 500 2000 10000
+
+import os
+import sys
+import time
+import argparse
+import itertools
+import numpy as np
+
+# import local modules from the mlserver-model directory
+thisdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(thisdir, 'mlserver-model'))
+import bad_ROC as bad_ROC
+from nmf2d import NMF2D
+
+
+################################################################################
+#######                   Reference implementations                       ######
+################################################################################
+
+# Copy of the original string parsing of the power group geometry
+# (functions.py as deployed with model 17), so that the reference does not depend on
+# the precomputed lookup tables that it is used to validate.
+
+def legacy_panelDiskToIndex(panel, disk, ring):
+    '''
+    Original functions.panelDiskToIndex: slices of a panel on a disk (data WITH the cross).
+    '''
+    if abs(disk) > 3:
+        raise Exception("Disk number must be between -3 and 3!")
+    if abs(panel) > 18:
+        raise Exception("Panel number must be between -11 and 11 for Ring 1 and between -18 and 18 for Ring 2!")
+    if ring > 2 or ring < 1:
+        raise Exception("Ring number must be either 1 or 2!")
+    diskIndexStart = 8*disk + 24
+    diskIndexEnd = 8*disk + 32
+    if ring == 2:
+        panelIndexStart = 4*panel + 68
+        panelIndexEnd = 4*panel + 72
+    elif ring == 1:
+        panelIndexStart = 4*panel + 44
+        panelIndexEnd = 4*panel + 48
+    return slice(panelIndexStart, panelIndexEnd), slice(diskIndexStart, diskIndexEnd)
+
+def legacy_analyzePowerGroupString(powerGroupString):
+    '''
+    Original functions.analyzePowerGroupString: returns m/p, I/O, disk number and part number.
+    '''
+    stringParts = powerGroupString.split('_')
+    if len(powerGroupString) != 16 or len(stringParts) != 4:
+        raise Exception("Power Group String Not in Expected Format of: FPix_B[m/p][I/O]_D#_ROG#")
+    quarterIdentifier = stringParts[1]
+    diskIdentifier = stringParts[2]
+    partIdentifier = stringParts[3]
+    disk_minus_positive_char = quarterIdentifier[1]
+    if disk_minus_positive_char == 'm':
+        disk_minus_pos = -1
+    elif disk_minus_positive_char == 'p':
+        disk_minus_pos = 1
+    else:
+        raise Exception("Power Group String had malformed B[m/p]!")
+    panel_minus_positive_char = quarterIdentifier[2]
+    if panel_minus_positive_char != 'O' and panel_minus_positive_char != 'I':
+        raise Exception("Power Group String had malformed B[I/O]!")
+    disk_number = int(diskIdentifier[1]) * disk_minus_pos
+    part_number = int(partIdentifier[3])
+    return disk_minus_positive_char, panel_minus_positive_char, disk_number, part_number
+
+def legacy_powerGroupToDiskPanels(powerGroupString, ring):
+    '''
+    Original functions.powerGroupToDiskPanels: returns the (signed) panels and the disk number.
+    '''
+    _, panel_minus_positive_char, disk_number, part_number = legacy_analyzePowerGroupString(powerGroupString)
+    panel_minus_pos = -1 if panel_minus_positive_char == 'O' else 1
+    if ring == 1:
+        panels = {1: [1, 2, 3], 2: [4, 5, 6], 3: [7, 8], 4: [9, 10, 11]}[part_number]
+    elif ring == 2:
+        panels = {1: [1, 2, 3, 4], 2: [5, 6, 7, 8], 3: [9, 10, 11, 12, 13], 4: [14, 15, 16, 17]}[part_number]
+    return np.array(panels) * panel_minus_pos, disk_number
+
+def legacy_powerGroupToIndex(powerGroupString, ring):
+    '''
+    Original functions.powerGroupToIndex: slices of a power group (data WITH the cross).
+    '''
+    panels, disk = legacy_powerGroupToDiskPanels(powerGroupString, ring)
+    slices = [legacy_panelDiskToIndex(panel, disk, ring) for panel in panels]
+    diskSlice = slices[-1][1]
+    # the panels are in increasing order for Inner, and decreasing order for Outer
+    if powerGroupString.split('_')[1][2] == 'I':
+        return slice(slices[0][0].start, slices[-1][0].stop), diskSlice
+    return slice(slices[-1][0].start, slices[0][0].stop), diskSlice
+
+def legacy_powerGroupsToAnomalyType(powergroup_one, powergroup_two):
+    '''
+    Original functions.powerGroupsToAnomalyType: Multi-Disk if the power groups are on the same
+    half, I/O and part number, but on different disks.
+    '''
+    m_or_p_one, I_or_O_one, disk_number_one, part_number_one = legacy_analyzePowerGroupString(powergroup_one)
+    m_or_p_two, I_or_O_two, disk_number_two, part_number_two = legacy_analyzePowerGroupString(powergroup_two)
+    if m_or_p_one == m_or_p_two and I_or_O_one == I_or_O_two and part_number_one == part_number_two and disk_number_one != disk_number_two:
+        return "Multi-Disk"
+    return "Single-Disk"
+
+def legacy_search_for_anomalies(losses, thresholds):
+    '''
+    Per-lumisection implementation of bad_ROC.search_for_anomalies
+    (as deployed with model 17), used as reference for validation.
+    '''
+    mename = 'Ring2'
+    loss_threshold = thresholds['loss_threshold']
+    ROC_fraction = thresholds['ROC_fraction']
+    losses_array = np.array(losses[mename])
+    res = np.zeros(losses_array.shape[0], dtype=bool)
+    for i in range(losses_array.shape[0]):
+        binary_losses = (losses_array[i] > loss_threshold).astype(int)
+        powergroups = []
+        for powergroup in bad_ROC.optimized_powerGroupStringsList:
+            powerGroupSlice, diskSlice = legacy_powerGroupToIndex(powergroup, bad_ROC.RING)
+            num_bad_ROCs = int(np.sum(binary_losses[powerGroupSlice, diskSlice].flatten()))
+            total_ROC_in_powergroup = int(binary_losses[powerGroupSlice, diskSlice].flatten().size)
+            if num_bad_ROCs >= int(ROC_fraction/100 * total_ROC_in_powergroup):
+                powergroups.append(powergroup)
+        # a Multi-Disk anomaly is found either as a whole quarter
+        # (12 anomalous power groups in the same quarter)
+        # or as a pair of anomalous power groups of type Multi-Disk
+        whole_quarter = (len(powergroups) == 12
+                         and any(np.all(np.isin(powergroups, quarter)) for quarter in bad_ROC.QUARTERS))
+        multi_disk = any(legacy_powerGroupsToAnomalyType(pg_one, pg_two) == 'Multi-Disk'
+                         for pg_one, pg_two in itertools.combinations(powergroups, 2))
+        res[i] = (whole_quarter or multi_disk)
+    return res
+
+
+################################################################################
+#######                          Synthetic data                           ######
+################################################################################
+
+def make_losses(nls, ring=bad_ROC.RING, anomaly_rate=0.05, seed=1):
+    '''
+    Make a synthetic loss cube (WITH the cross) with random single- and multi-disk anomalies.
+    Returns:
+    - np array of shape (nls, y-bins, x-bins)
+    '''
+    rng = np.random.default_rng(seed)
+    masks = bad_ROC.get_powergroup_masks(ring)
+    losses = rng.exponential(scale=1e4, size=(nls, *masks.shape[1:]))
+    for i in np.nonzero(rng.random(nls) < anomaly_rate)[0]:
+        # pick a power group and (sometimes) the same power group on other disks,
+        # and put a random fraction of its bins above threshold
+        j = rng.integers(len(masks))
+        js = [j]
+        if rng.random() < 0.5:
+            # power groups on the same half, I/O and ROG are consecutive in groups of 3
+            js = list(range(3*(j//3), 3*(j//3)+3))[:rng.integers(2, 4)]
+        for j in js:
+            idx = np.nonzero(masks[j])
+            bad = rng.random(len(idx[0])) < rng.uniform(0.3, 0.6)
+            losses[i, idx[0][bad], idx[1][bad]] = 1e6
+    return losses
+
+def load_test_data(path, mename='Ring2'):
+    '''
+    Load the raw histograms from a test data file in the format of test_data.pkl (see test_predictions.py).
+    '''
+    import pickle
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    return data[mename]
+
+def load_model(path=None):
+    '''
+    Load a model (default: the deployed model in mlserver-model).
+    '''
+    import joblib
+    if path is None: path = os.path.join(thisdir, 'mlserver-model', 'pixelring2nmf.joblib')
+    return joblib.load(path)
+
+def make_histograms(model, nls, mename='Ring2', ring=bad_ROC.RING, anomaly_rate=0.05, seed=1):
+    '''
+    Make synthetic raw histograms (WITH the cross) from the NMF components of a model,
+    with random dead power groups on one or more disks.
+    Returns:
+    - INT32 np array of shape (nls, y-bins, x-bins)
+    '''
+    rng = np.random.default_rng(seed)
+    components = model.nmfs[mename].components
+    coefficients = rng.uniform(100, 500, size=(nls, len(components)))
+    mes = np.tensordot(coefficients, components, axes=1)
+    mes = rng.poisson(mes).astype(np.int32)
+    mes = model.preprocessors[mename].deprocess(mes)
+    masks = bad_ROC.get_powergroup_masks(ring, mes.shape[1:])
+    for i in np.nonzero(rng.random(nls) < anomaly_rate)[0]:
+        j = rng.integers(len(masks))
+        js = [j]
+        if rng.random() < 0.5: js = list(range(3*(j//3), 3*(j//3)+3))[:rng.integers(2, 4)]
+        for j in js: mes[i][masks[j]] = 0
+    return mes
+
+
+################################################################################
+#######                            Benchmarks                             ######
+################################################################################
+
+def timeit(func, *args, repeat=1, **kwargs):
+    '''
+    Return the result of func(*args, **kwargs) and the best execution time (in seconds).
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+def benchmark_flagging(args):
+    '''
+    Compare the vectorized bad_ROC.search_for_anomalies with the per-lumisection reference,
+    and check that the anomaly score is consistent with the flags (flagged if and only if score >= 1).
+    The check is also done for a ROC_fraction of 0.5%, for which the minimum number of bad bins is 0
+    for all power groups (so that every power group is anomalous).
+    '''
+    print('Number of LS | ROC fraction | reference (s) | vectorized (s) | with scores (s) | speedup | flagged | identical | consistent score')
+    for nls in args.nls:
+        losses = {'Ring2': make_losses(nls)}
+        for ROC_fraction in [40, 0.5]:
+            thresholds = {"loss_threshold": 1e5, "ROC_fraction": ROC_fraction}
+            ref, t_ref = timeit(legacy_search_for_anomalies, losses, thresholds)
+            new, t_new = timeit(bad_ROC.search_for_anomalies, losses, thresholds, repeat=args.repeat)
+            (_, scores), t_scores = timeit(bad_ROC.search_for_anomalies, losses, thresholds, return_scores=True, repeat=args.repeat)
+            identical = np.array_equal(ref, new)
+            consistent = np.array_equal(new, scores['score'] >= 1)
+            print(f'{nls:12d} | {ROC_fraction:11g}% | {t_ref:13.3f} | {t_new:14.4f} | {t_scores:15.4f} | {t_ref/t_new:6.0f}x | {np.sum(new):7d} | {identical!s:9s} | {consistent}')
+            if not identical:
+                raise Exception(f'Flags differ from the reference for {nls} lumisections (ROC_fraction {ROC_fraction}).')
+            if not consistent:
+                raise Exception(f'Anomaly scores are not consistent with the flags for {nls} lumisections (ROC_fraction {ROC_fraction}).')
+
+def peak_memory(func, *args, **kwargs):
+    '''
+    Return the result of func(*args, **kwargs) and the peak memory allocated during the call (in MB).
+    '''
+    import tracemalloc
+    tracemalloc.start()
+    result = func(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, peak / 1024**2
+
+def benchmark_chunking(args):
+    '''
+    Compare PixelRing2NMF.predict in monolithic mode and in chunked mode (flags must be identical).
+    '''
+    model = load_model(args.model)
+    print('Number of LS | chunk size | time (s) | peak memory (MB) | flagged | identical')
+    for nls in args.nls:
+        X = {'Ring2': make_histograms(model, nls)}
+        reference = None
+        for chunk_size in [None] + args.chunk_size:
+            model.chunk_size = chunk_size
+            (flags, t), peak = peak_memory(timeit, model.predict, X)
+            if reference is None: reference = flags
+            identical = np.array_equal(reference, flags)
+            print(f'{nls:12d} | {str(chunk_size):>10s} | {t:8.2f} | {peak:16.0f} | {np.sum(flags):7d} | {identical}')
+            if not identical:
+                raise Exception(f'Flags in chunked mode differ from the monolithic mode for {nls} lumisections.')
+
+def benchmark_fused(args):
+    '''
+    Compare PixelRing2NMF.predict with and without the fused path (flags must be identical).
+    '''
+    model = load_model(args.model)
+    print('Number of LS | fused | time (s) | peak memory (MB) | flagged | identical')
+    for nls in args.nls:
+        X = {'Ring2': make_histograms(model, nls)}
+        reference = None
+        for fused in [False, True]:
+            model.fused = fused
+            (flags, t), peak = peak_memory(timeit, model.predict, X)
+            if reference is None: reference = flags
+            identical = np.array_equal(reference, flags)
+            print(f'{nls:12d} | {str(fused):>5s} | {t:8.2f} | {peak:16.0f} | {np.sum(flags):7d} | {identical}')
+            if not identical:
+                raise Exception(f'Flags in fused mode differ from the non-fused mode for {nls} lumisections.')
+
+def benchmark_solver(args):
+    '''
+    Compare the NMF inference solvers with MiniBatchNMF.transform:
+    the reconstruction must agree within a relative tolerance (exactly for the 'mu' solver,
+    within --tolerance for the others), and the flags are compared as well.
+    '''
+    model = load_model(args.model)
+    mename = 'Ring2'
+    nmf = model.nmfs[mename]
+    solvers = [('mu', {}), ('nnls', {}), ('mu', {'max_iter': 50, 'warm_start': True})]
+    print('Number of LS | solver                             | time (s) | per LS (ms) | max. rel. diff. | flagged | identical flags')
+    for nls in args.nls:
+        X = {mename: make_histograms(model, nls)}
+        X_crop = model.preprocessors[mename].crop(X[mename], dtype=np.float64)
+        reference = None
+        for solver, kwargs in [('sklearn', {})] + solvers:
+            model.set_solver(solver, **kwargs)
+            model.prepare_inference()
+            reco, t = timeit(nmf.predict, X_crop, repeat=1 if solver=='sklearn' else args.repeat)
+            flags = model.run_chain(X)
+            if reference is None: reference = (reco, flags)
+            diff = np.max(np.abs(reco - reference[0])) / np.max(np.abs(reference[0]))
+            identical = np.array_equal(reference[1], flags)
+            name = solver + ''.join(f' {key}={val}' for key, val in kwargs.items())
+            print(f'{nls:12d} | {name:34s} | {t:8.3f} | {1000*t/nls:11.4f} | {diff:15.2e} | {np.sum(flags):7d} | {identical}')
+            tolerance = 1e-12 if (solver=='mu' and not kwargs) else args.tolerance
+            if diff > tolerance:
+                msg = f'Reconstruction with solver {solver} differs from sklearn by {diff:.2e}'
+                msg += f' (tolerance: {tolerance:.0e}) for {nls} lumisections.'
+                raise Exception(msg)
+        model.set_solver('sklearn')
+
+    # early stopping: with tol > 0, 'mu' must apply the same (batch-global) stopping rule as sklearn
+    nmf_tol = NMF2D.from_other(nmf)
+    nmf_tol.nmf.tol = 1e-4
+    for nls in args.nls:
+        X_crop = model.preprocessors[mename].crop(make_histograms(model, nls), dtype=np.float64)
+        reference, t_ref = timeit(nmf_tol.predict, X_crop)
+        nmf_tol.set_solver('mu')
+        reco, t = timeit(nmf_tol.predict, X_crop, repeat=args.repeat)
+        nmf_tol.set_solver('sklearn')
+        diff = np.max(np.abs(reco - reference)) / np.max(np.abs(reference))
+        print(f'{nls:12d} | {"mu tol=1e-4 (sklearn tol=1e-4)":34s} | {t:8.3f} | {1000*t/nls:11.4f} | {diff:15.2e} |')
+        if diff > 1e-12:
+            raise Exception(f'Reconstruction with solver mu and tol > 0 differs from sklearn by {diff:.2e} for {nls} lumisections.')
+
+    # non-Frobenius beta_loss: the cached-Gram solvers cannot reproduce sklearn and must be refused
+    nmf_kl = NMF2D.from_other(nmf)
+    nmf_kl.nmf.set_params(beta_loss='kullback-leibler')
+    nmf_kl.nmf._beta_loss = 1
+    for solver in ['mu', 'nnls']:
+        try:
+            nmf_kl.set_solver(solver)
+        except Exception:
+            print(f'solver {solver} refused for beta_loss kullback-leibler (as expected)')
+            continue
+        raise Exception(f'Solver {solver} was accepted for a model with beta_loss kullback-leibler.')
+
+def benchmark_precision(args):
+    '''
+    Compare PixelRing2NMF.predict in float64 and float32 precision
+    (flag agreement rate, time and peak memory), for each solver.
+    '''
+    model = load_model(args.model)
+    mename = 'Ring2'
+    datasets = []
+    if args.data is not None:
+        datasets.append((os.path.basename(args.data), {mename: load_test_data(args.data, mename)}))
+    else:
+        for nls in args.nls: datasets.append((f'synthetic {nls}', {mename: make_histograms(model, nls)}))
+    print('Data              | solver  | precision | time (s) | peak memory (MB) | flagged | agreement')
+    for name, X in datasets:
+        for solver in ['sklearn', 'mu', 'nnls']:
+            model.set_solver(solver)
+            reference = None
+            for precision in ['float64', 'float32']:
+                model.set_precision(precision)
+                model.prepare_inference()
+                (flags, t), peak = peak_memory(timeit, model.run_chain, X)
+                if reference is None: reference = flags
+                agreement = np.mean(reference == flags)
+                print(f'{name:17s} | {solver:7s} | {precision:9s} | {t:8.2f} | {peak:16.0f} | {np.sum(flags):7d} | {agreement:9.2%}')
+    model.set_solver('sklearn')
+    model.set_precision('float64')
+
+def benchmark_serialization(args):
+    '''
+    Time the serialization of the response (Handler.postprocess, response model and JSON rendering
+    as done by the MLServer REST server), with list outputs (before and after the change to ravel)
+    and with base64-encoded binary outputs.
+    Note: requires mlserver.
+    '''
+    import json
+    import asyncio
+    from fastapi.encoders import jsonable_encoder
+    from mlserver.types import InferenceResponse, ResponseOutput
+    from mlserver.rest.responses import Response
+    from app import Handler
+    from datatype import dtype_to_datatype, decode_tensor_data
+
+    def legacy_postprocess(results):
+        # list outputs with flatten, as before
+        outputs = []
+        for name, values in [('Flag', results), ('Metric', results.astype(float))]:
+            outputs.append(ResponseOutput(name=name, shape=values.shape, datatype=dtype_to_datatype(values.dtype),
+                                          data=values.flatten().tolist()))
+        return outputs
+
+    def serialize(outputs):
+        response = InferenceResponse(id='0', model_name='benchmark', model_version='0', outputs=outputs)
+        content = jsonable_encoder(response, exclude_unset=True, exclude_none=True)
+        return Response(content).body
+
+    print('Number of LS | outputs        | time (ms) | size (kB) | identical')
+    rng = np.random.default_rng(1)
+    for nls in args.nls:
+        results = rng.random(nls) < 0.01
+        for name in ['list (flatten)', 'list', 'binary']:
+            if name == 'list (flatten)': postprocess = lambda: legacy_postprocess(results)
+            else: postprocess = lambda: asyncio.run(Handler.postprocess(None, results, binary=(name=='binary')))
+            body, t = timeit(lambda: serialize(postprocess()), repeat=args.repeat)
+            output = json.loads(body)['outputs'][0]
+            flags = decode_tensor_data(output['data'], output['datatype'], output['shape'])
+            identical = np.array_equal(flags, results)
+            print(f'{nls:12d} | {name:14s} | {1000*t:9.2f} | {len(body)/1024:9.0f} | {identical}')
+            if not identical:
+                raise Exception(f'Decoded flags differ from the original ones for {nls} lumisections.')
+
+def benchmark_filtering(args):
+    '''
+    Time PixelRing2NMF.predict for different fractions of lumisections rejected by the OMS filters
+    (which are applied before inference, so the time should scale with the selected fraction).
+    '''
+    model = load_model(args.model)
+    keys = ["beams_stable", "cms_active", "bpix_ready", "fpix_ready", "tibtid_ready", "tob_ready", "tecp_ready", "tecm_ready"]
+    print('Number of LS | rejected | time (s) | flagged')
+    for nls in args.nls:
+        X = {'Ring2': make_histograms(model, nls)}
+        X['general__run_number'] = np.full(nls, 1)
+        X['general__lumisection_number'] = np.arange(1, nls+1)
+        for rejected in [0., 0.25, 0.5, 0.75]:
+            for key in keys: X['dcs_bits__'+key] = np.ones(nls, dtype=bool)
+            X['dcs_bits__beams_stable'][:int(rejected*nls)] = False
+            flags, t = timeit(model.predict, X)
+            print(f'{nls:12d} | {rejected:8.0%} | {t:8.2f} | {np.sum(flags):7d}')
+
+def benchmark_cache(args):
+    '''
+    Time PixelRing2NMF.predict with the result cache enabled, for a first request
+    and a re-request of the same run with 10% more lumisections appended (flags must be identical).
+    '''
+    model = load_model(args.model)
+    print('Number of LS | request              | time (s) | cache hits | flagged | identical')
+    for nls in args.nls:
+        X = {'Ring2': make_histograms(model, nls + nls//10)}
+        reference = model.predict(X)
+        model.enable_cache(max_entries=2*len(reference))
+        requests = [('first', nls), ('same', nls), ('10% appended', len(reference))]
+        for name, n in requests:
+            hits = model.cache.hits
+            flags, t = timeit(model.predict, {'Ring2': X['Ring2'][:n]})
+            identical = np.array_equal(flags, reference[:n])
+            print(f'{nls:12d} | {name:20s} | {t:8.2f} | {model.cache.hits-hits:10d} | {np.sum(flags):7d} | {identical}')
+            if not identical:
+                raise Exception(f'Flags with cache differ from the flags without cache for {nls} lumisections.')
+        model.disable_cache()
+
+def benchmark_multi(args):
+    '''
+    Time PixelRing2NMF.predict for a container with a Ring 1 and a Ring 2 model,
+    with the monitoring elements processed sequentially and in parallel threads,
+    compared with the single-ME models on their own
+    (the combined and per-ME flags must be identical to those of the single-ME models).
+    Note: the threaded mode can only be faster than the sequential one with more than one CPU.
+    '''
+    import copy
+    import joblib
+    from pixelring2nmf import PixelRing2NMF
+    ring2 = load_model(args.model)
+    ring1_path = args.ring1_model
+    if ring1_path is None:
+        ring1_path = os.path.join(thisdir, '..', 'Development', 'models', 'model_8_PXRing_1_period_4_type_1.pkl')
+    ring1 = PixelRing2NMF({'Ring1': joblib.load(ring1_path)})
+    model = PixelRing2NMF({'Ring1': ring1.nmfs['Ring1'], 'Ring2': ring2.nmfs['Ring2']},
+                          thresholds=copy.deepcopy(ring2.thresholds))
+    for m in [ring1, ring2, model]:
+        m.set_solver(ring2.nmfs['Ring2'].solver)
+        m.fused = ring2.fused
+    print(f'Number of CPUs: {os.cpu_count()}')
+    print('Number of LS | model              | time (s) | flagged | Ring1 | Ring2 | identical')
+    for nls in args.nls:
+        X = {'Ring1': make_histograms(ring1, nls, mename='Ring1', ring=1, seed=2),
+             'Ring2': make_histograms(ring2, nls)}
+        reference = {}
+        for mename, single in [('Ring1', ring1), ('Ring2', ring2)]:
+            reference[mename], t = timeit(single.predict, {mename: X[mename]}, repeat=args.repeat)
+            print(f'{nls:12d} | {mename + " only":18s} | {t:8.2f} | {np.sum(reference[mename]):7d} |       |       |')
+        for n_threads, name in [(1, 'Ring1+Ring2 seq.'), (None, 'Ring1+Ring2 thr.')]:
+            model.n_threads = n_threads
+            (flags, scores), t = timeit(model.predict, X, return_scores=True, repeat=args.repeat)
+            identical = (np.array_equal(flags, reference['Ring1'] | reference['Ring2'])
+                         and all(np.array_equal(scores[f'{mename}_flag'], reference[mename]) for mename in reference))
+            nflags = [int(np.sum(scores[f'{mename}_flag'])) for mename in ['Ring1', 'Ring2']]
+            print(f'{nls:12d} | {name:18s} | {t:8.2f} | {np.sum(flags):7d} | {nflags[0]:5d} | {nflags[1]:5d} | {identical}')
+            if not identical:
+                raise Exception(f'Flags of the multi-ME model differ from the single-ME models for {nls} lumisections.')
+
+def benchmark_loading(args):
+    '''
+    Time the cold start (a fresh process that imports the model modules and loads the model)
+    for the pickled model and for the same model in the model artifact format (see mlserver-model/artifact.py),
+    and check that both give identical flags and scores.
+    '''
+    import subprocess
+    import tempfile
+    import joblib
+    from artifact import save_artifact, load_artifact
+    path = args.model
+    if path is None: path = os.path.join(thisdir, 'mlserver-model', 'pixelring2nmf.joblib')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        artifact_path = os.path.join(tmpdir, 'artifact')
+        save_artifact(joblib.load(path), artifact_path)
+        loaders = {
+          'joblib': f'import joblib; model = joblib.load({path!r})',
+          'artifact': f'from artifact import load_artifact; model = load_artifact({artifact_path!r})',
+        }
+        print('format   | process (s) | load (s)')
+        for name, loader in loaders.items():
+            # note: the load time includes the import of the modules needed to load the model
+            code = 'import time; start = time.perf_counter(); import sys; '
+            code += f'sys.path.append({os.path.join(thisdir, "mlserver-model")!r}); '
+            code += loader + '; model.prepare_inference(); print(time.perf_counter() - start)'
+            times = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                output = subprocess.run([sys.executable, '-W', 'ignore', '-c', code],
+                                        check=True, capture_output=True, text=True).stdout
+                times.append((time.perf_counter() - start, float(output.split()[-1])))
+            tprocess, tload = min(times)
+            print(f'{name:8s} | {tprocess:11.2f} | {tload:8.3f}')
+        reference = joblib.load(path)
+        model = load_artifact(artifact_path)
+        for nls in args.nls:
+            X = {mename: make_histograms(reference, nls, mename=mename) for mename in reference.menames}
+            flags, scores = model.predict(X, return_scores=True)
+            reference_flags, reference_scores = reference.predict(X, return_scores=True)
+            identical = (np.array_equal(flags, reference_flags)
+                         and all(np.array_equal(scores[key], reference_scores[key]) for key in scores))
+            print(f'[INFO]: {nls} lumisections: {np.sum(flags)} flagged, identical: {identical}')
+            if not identical:
+                raise Exception(f'Flags or scores of the artifact model differ from the pickled model for {nls} lumisections.')
+
+# modules that should not be imported on the deployment path (see benchmark_imports)
+HEAVY_MODULES = ['matplotlib', 'pandas', 'sklearn']
+
+def benchmark_imports(args):
+    '''
+    Measure the import time of the deployment modules in a fresh process (with python -X importtime),
+    and check that it is below --max-import-time and that none of HEAVY_MODULES is imported.
+    '''
+    import subprocess
+    modules = ['pixelring2nmf', 'artifact']
+    print('module        | import time (s) | slowest imports')
+    for module in modules:
+        code = f'import sys; sys.path.append({os.path.join(thisdir, "mlserver-model")!r}); import {module}'
+        code += f'; print([m for m in {HEAVY_MODULES!r} if m in sys.modules])'
+        results = []
+        for _ in range(args.repeat):
+            output = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                                    check=True, capture_output=True, text=True)
+            # each line of the importtime output is of the form
+            # "import time: self [us] | cumulative [us] | module name"
+            times = {}
+            for line in output.stderr.splitlines():
+                if not line.startswith('import time:') or 'cumulative' in line: continue
+                _, cumulative, name = line[len('import time:'):].split('|')
+                times[name.strip()] = int(cumulative)/1e6
+            results.append((times[module], times, output.stdout.strip()))
+        total, times, heavy = min(results, key=lambda result: result[0])
+        slowest = sorted([(t, name) for name, t in times.items() if name != module], reverse=True)[:3]
+        slowest = ', '.join(f'{name} ({t:.3f})' for t, name in slowest)
+        print(f'{module:13s} | {total:15.3f} | {slowest}')
+        if heavy != '[]':
+            raise Exception(f'Importing {module} also imports the following heavy modules: {heavy}.')
+        if total > args.max_import_time:
+            raise Exception(f'Import time of {module} ({total:.3f} s) exceeds the maximum of {args.max_import_time} s.')
+
+
+BENCHMARKS = {
+    'cache': benchmark_cache,
+    'flagging': benchmark_flagging,
+    'filtering': benchmark_filtering,
+    'chunking': benchmark_chunking,
+    'fused': benchmark_fused,
+    'solver': benchmark_solver,
+    'precision': benchmark_precision,
+    'serialization': benchmark_serialization,
+    'multi': benchmark_multi,
+    'loading': benchmark_loading,
+    'imports': benchmark_imports,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run benchmarks and validation checks.")
+    parser.add_argument("benchmark", choices=list(BENCHMARKS.keys()), help="Benchmark to run.")
+    parser.add_argument("--nls", type=int, nargs='+', default=[500, 2000, 10000], help="Numbers of lumisections.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of repetitions (best time is reported).")
+    parser.add_argument("--model", default=None, help="Model file (default: the deployed model).")
+    parser.add_argument("--chunk-size", type=int, nargs='+', default=[100, 500], help="Chunk sizes.")
+    parser.add_argument("--ring1-model", default=None, help="Ring 1 NMF2D model file for the multi benchmark (default: a Development model).")
+    parser.add_argument("--data", default=None, help="Test data file (format of test_data.pkl; default: synthetic data).")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="Relative tolerance for the solver comparison.")
+    parser.add_argument("--max-import-time", type=float, default=0.5, help="Maximum import time (in seconds) for the imports benchmark.")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,75 @@
+# Convert pickled models to the lean model artifact format (see mlserver-model/artifact.py).
+
+# usage examples:
+#   python convert_model.py -i mlserver-model/pixelring2nmf.joblib -o mlserver-model/pixelring2nmf
+#   python convert_model.py -i mlserver-model/pixelring2nmf.joblib ../Development/models/model_8_PXRing_1_period_4_type_1.pkl -o ring1ring2
+# the input files can be pickled PixelRing2NMF models (e.g. the deployed .joblib file)
+# or pickled NMF2D models (e.g. the .pkl files in Development/models);
+# for the latter, the monitoring element name is taken from the file name (PXRing_<n> -> Ring<n>)
+# unless specified with --mename. Multiple input files are combined into a single multi-ME model.
+
+import os
+import re
+import sys
+import argparse
+import joblib
+
+# import local modules from the mlserver-model directory
+thisdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(thisdir, 'mlserver-model'))
+from nmf2d import NMF2D
+from pixelring2nmf import PixelRing2NMF
+from artifact import save_artifact, load_artifact
+
+
+def load_pickled_model(path, mename=None):
+    '''
+    Load a pickled PixelRing2NMF or NMF2D model, and return it as a PixelRing2NMF model.
+    '''
+    model = joblib.load(path)
+    if isinstance(model, PixelRing2NMF): return model
+    if not isinstance(model, NMF2D):
+        raise Exception(f'File {path} contains an object of type {type(model)}, which cannot be converted.')
+    if mename is None:
+        match = re.search(r'PXRing_([12])', os.path.basename(path))
+        if match is None:
+            raise Exception(f'Could not determine the monitoring element name for {path}; please specify --mename.')
+        mename = f'Ring{match.group(1)}'
+    return PixelRing2NMF({mename: model})
+
+def combine_models(models):
+    '''
+    Combine PixelRing2NMF models into a single multi-ME model
+    (with the thresholds and settings of the first model, and per-ME thresholds if they differ).
+    '''
+    if len(models) == 1: return models[0]
+    nmfs = {}
+    thresholds = {}
+    for model in models:
+        for mename in model.menames:
+            if mename in nmfs: raise Exception(f'Monitoring element {mename} found in multiple input models.')
+            nmfs[mename] = model.nmfs[mename]
+            thresholds[mename] = model.get_thresholds(mename)
+    if all(t == thresholds[models[0].menames[0]] for t in thresholds.values()):
+        thresholds = models[0].get_thresholds(models[0].menames[0])
+    first = models[0]
+    return PixelRing2NMF(nmfs, thresholds=thresholds, chunk_size=first.chunk_size, fused=first.fused,
+                         precision=first.precision, oms_filters=first.oms_filters, n_threads=first.n_threads)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert pickled models to the lean model artifact format.")
+    parser.add_argument("-i", "--inputs", nargs='+', required=True, help="Input model file(s) (.joblib or .pkl).")
+    parser.add_argument("-o", "--output", required=True, help="Output artifact directory.")
+    parser.add_argument("--mename", nargs='+', default=None, help="Monitoring element name per input NMF2D model (default: from the file name).")
+    args = parser.parse_args()
+
+    menames = args.mename if args.mename is not None else [None]*len(args.inputs)
+    if len(menames) != len(args.inputs):
+        raise Exception('The number of monitoring element names must match the number of input files.')
+    model = combine_models([load_pickled_model(path, mename=mename) for path, mename in zip(args.inputs, menames)])
+    save_artifact(model, args.output)
+
+    # check that the artifact can be loaded back
+    loaded = load_artifact(args.output)
+    print(f'[INFO]: saved model artifact with monitoring elements {loaded.menames} to {args.output}.')
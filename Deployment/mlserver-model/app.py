@@ -10,23 +10,37 @@
 #       in the local model definition; see pixelnmf.py.
 
 # import external modules
-from typing import List, Dict
+from typing import List, Dict, Tuple
 import joblib
 import numpy as np
 from mlserver import MLModel
-from mlserver.types import InferenceRequest, InferenceResponse, RequestInput, RequestOutput, ResponseOutput
+from mlserver.types import InferenceRequest, InferenceResponse, RequestInput, RequestOutput, ResponseOutput, Parameters
 from mlserver.utils import get_model_uri
 
 # import local modules
+from artifact import is_artifact, load_artifact
 from datatype import dtype_to_datatype
-from datatype import datatype_to_dtype
+from datatype import decode_tensor_data
+from datatype import encode_tensor_data
+
+# maximum number of lumisections in the result cache of the model (see PixelRing2NMF.enable_cache)
+CACHE_SIZE = 100000
 
 class Handler(MLModel):
     async def load(self):
         model_uri = await get_model_uri(self._settings)
         self.model_name = self._settings.name
         self.model_version = self._settings.version
-        self.model = joblib.load(model_uri)
+        # load the model, either from a model artifact (fast, memory-mapped; see artifact.py)
+        # or from a pickled PixelRing2NMF instance
+        if is_artifact(model_uri): self.model = load_artifact(model_uri)
+        else: self.model = joblib.load(model_uri)
+        # precompute the factors needed for inference
+        self.model.prepare_inference()
+        # cache results per lumisection, so that re-requested lumisections are not processed again
+        # (only if the results per lumisection do not depend on the other lumisections in a request)
+        if self.model.is_batch_independent(): self.model.enable_cache(max_entries=CACHE_SIZE)
+        else: print('WARNING in Handler.load: the result cache is disabled, since the model is not batch independent.')
 
     async def preprocess(self, inputs: List[RequestInput]) -> Dict[str, np.ndarray]:
         """Process data sent from HTTP request"""
@@ -35,56 +49,76 @@ class Handler(MLModel):
         for idx in range(len(inputs)):
             # get basic attributes
             input_name = inputs[idx].name
-            input_datatype = datatype_to_dtype(inputs[idx].datatype)
             input_shape = tuple(inputs[idx].shape)
             # get actual data
             # note: data should be received in flattened format,
             #       so need to unflatten here; see more info here:
             #       https://gitlab.cern.ch/cms-ppd/technical-support/web-services/dials-service/-/issues/136#note_10063426
-            data = np.array(inputs[idx].data, dtype=input_datatype)
-            if data.shape != input_shape:
-                data = data.flatten().reshape(input_shape)
+            # note: data can also be received as binary data (bytes or a base64-encoded string),
+            #       which is decoded without conversion to python objects; see decode_tensor_data.
+            data = decode_tensor_data(inputs[idx].data, inputs[idx].datatype, input_shape)
             input_data[input_name] = data
         return input_data
 
-    async def inference(self, inputs: Dict[str, np.ndarray]) -> np.ndarray:
-        """Run inference"""
-        flags = self.model.predict(inputs)
-        return flags
+    async def inference(self, inputs: Dict[str, np.ndarray]) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Run inference (returns the flags and the continuous anomaly scores)"""
+        flags, scores = self.model.predict(inputs, return_scores=True)
+        return flags, scores
 
-    async def postprocess(self, results: np.ndarray) -> List[ResponseOutput]:
+    async def postprocess(self, results: np.ndarray, scores: Dict[str, np.ndarray] = None, binary: bool = False) -> List[ResponseOutput]:
         """Process results from model inference and make each output compliant with Open Inference Protocol"""
+        # note: if binary is True, the data of each output is a base64-encoded string
+        #       instead of a list (see encode_tensor_data), marked with content_type 'base64'.
+        parameters = Parameters(content_type='base64') if binary else None
         outputs = [
                     ResponseOutput(
                       name='Flag',
                       shape=results.shape,
                       datatype=dtype_to_datatype(results.dtype),
-                      data=results.flatten().tolist(),
+                      data=encode_tensor_data(results, binary=binary),
+                      parameters=parameters,
                     )
                   ]
-        # For now, DIALS requires a MetricKey (which is supposed to be a continuous score),
+        # DIALS requires a MetricKey (a continuous score),
         # on top of an optional FlaggingKey (which is the MetricKey with a built-in threshold applied).
-        # In this method, the MetricKey cannot be well defined, so return a dummy value for now.
-        # This can be changed in future versions of DIALS, when the MetricKey is no longer required.
-        dummy_metric = results.astype(float)
+        # The metric is the anomaly score computed together with the flags (see bad_ROC.get_anomaly_scores),
+        # for which a lumisection is flagged if and only if the score is at least 1 (before filtering).
+        # If no scores are available, fall back to the flags themselves.
+        metric = results.astype(float)
+        if scores is not None: metric = scores['score'].astype(float)
         outputs.append(
             ResponseOutput(
                 name='Metric',
-                shape=dummy_metric.shape,
-                datatype=dtype_to_datatype(dummy_metric.dtype),
-                data=dummy_metric.flatten().tolist(),
+                shape=metric.shape,
+                datatype=dtype_to_datatype(metric.dtype),
+                data=encode_tensor_data(metric, binary=binary),
+                parameters=parameters,
             )
         )
 
         return outputs
 
+    @staticmethod
+    def binary_output_requested(request: InferenceRequest) -> bool:
+        """
+        Check whether the request asks for binary outputs,
+        i.e. if the binary_data_output request parameter
+        or the binary_data parameter of any requested output is set.
+        """
+        if request.parameters is not None and getattr(request.parameters, 'binary_data_output', False):
+            return True
+        for output in (request.outputs or []):
+            if output.parameters is not None and getattr(output.parameters, 'binary_data', False):
+                return True
+        return False
+
     async def predict(self, request: InferenceRequest) -> InferenceResponse:
         """
         Main handler called on each inference HTTP request.
         """
         data = await self.preprocess(request.inputs)
-        data = await self.inference(data)
-        data = await self.postprocess(data)
+        flags, scores = await self.inference(data)
+        data = await self.postprocess(flags, scores=scores, binary=self.binary_output_requested(request))
         return InferenceResponse(
             id=request.id, model_name=self.model_name, model_version=self.model_version, outputs=data
         )
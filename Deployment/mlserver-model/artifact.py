@@ -0,0 +1,130 @@
+# Lean model artifact format for PixelRing2NMF
+
+# The artifact is a directory with the following content:
+# - manifest.json: format version, monitoring element names, thresholds and settings,
+#   and per monitoring element the NMF parameters needed for inference.
+# - <monitoring element name>.components.npy: the NMF components (shape (n_components, *xshape)).
+# The components are loaded as read-only memory-mapped arrays,
+# so loading does not need to unpickle (or import) the sklearn estimator.
+# Note: the power group geometry is not stored, since it is precomputed from constants in functions.py.
+
+# import external modules
+import os
+import json
+import numpy as np
+
+# import local modules
+from nmf2d import NMF2D
+from pixelring2nmf import PixelRing2NMF
+
+# name and version of the artifact format
+ARTIFACT_FORMAT = 'pixelring2nmf-artifact'
+ARTIFACT_VERSION = 2
+MANIFEST_NAME = 'manifest.json'
+
+
+def is_artifact(path):
+    '''
+    Check whether a path is a model artifact (i.e. a directory with a manifest, or the manifest itself).
+    '''
+    if os.path.basename(path) == MANIFEST_NAME: return os.path.isfile(path)
+    return os.path.isfile(os.path.join(path, MANIFEST_NAME))
+
+def get_artifact_solver(nmf, mename):
+    '''
+    Return the solver settings with which a model loaded from an artifact reproduces the inference of an NMF2D model,
+    and raise an exception if the artifact cannot reproduce it.
+    Input arguments:
+    - nmf: NMF2D instance.
+    - mename: monitoring element name (for the error message).
+    Returns:
+    - tuple of solver, solver_max_iter and warm_start (see NMF2D.set_solver).
+    Note: the artifact does not contain the MiniBatchNMF estimator, so only the 'nnls' and 'mu' solvers are available,
+          which minimize the Frobenius norm; the 'sklearn' solver is stored as the 'mu' solver with its default settings,
+          which gives the same result for beta_loss frobenius (including the stopping rule if tol > 0).
+    '''
+    params = nmf.get_solver_params()
+    if params['beta_loss'] != 2:
+        msg = f'The NMF model for {mename} has beta_loss {params["beta_loss"]}, which cannot be saved as a model artifact'
+        msg += ' (only models with beta_loss frobenius can be reproduced without MiniBatchNMF estimator).'
+        raise Exception(msg)
+    if nmf.solver == 'sklearn': return ('mu', None, False)
+    return (nmf.solver, nmf.solver_max_iter, nmf.warm_start)
+
+def save_artifact(model, path):
+    '''
+    Save a PixelRing2NMF model as a model artifact.
+    Input arguments:
+    - model: PixelRing2NMF instance.
+    - path: output directory (created if needed; existing files of an artifact are overwritten).
+    Note: raises an exception (before writing anything) if the artifact cannot reproduce the model,
+          see get_artifact_solver.
+    '''
+    solvers = {mename: get_artifact_solver(model.nmfs[mename], mename) for mename in model.menames}
+    os.makedirs(path, exist_ok=True)
+    manifest = {
+      'format': ARTIFACT_FORMAT,
+      'version': ARTIFACT_VERSION,
+      'menames': model.menames,
+      'nmfs': {},
+      'thresholds': model.thresholds,
+      'settings': {
+        'chunk_size': model.chunk_size,
+        'fused': model.fused,
+        'precision': model.precision,
+        'oms_filters': model.oms_filters,
+        'n_threads': model.n_threads,
+      },
+    }
+    for mename in model.menames:
+        nmf = model.nmfs[mename]
+        components, params = nmf.get_inference_params()
+        components = np.ascontiguousarray(np.reshape(components, (-1, *nmf.xshape)))
+        filename = f'{mename}.components.npy'
+        np.save(os.path.join(path, filename), components)
+        manifest['nmfs'][mename] = {
+          'components': filename,
+          'xshape': [int(n) for n in nmf.xshape],
+          'alpha_W': float(params['alpha_W']),
+          'l1_ratio': float(params['l1_ratio']),
+          'max_iter': int(params['max_iter']),
+          'beta_loss': float(params['beta_loss']),
+          'tol': float(params['tol']),
+          'solver': solvers[mename][0],
+          'solver_max_iter': solvers[mename][1],
+          'warm_start': solvers[mename][2],
+        }
+    with open(os.path.join(path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, default=lambda x: x.item())
+
+def load_artifact(path, mmap_mode='r'):
+    '''
+    Load a PixelRing2NMF model from a model artifact.
+    Input arguments:
+    - path: artifact directory (or its manifest).
+    - mmap_mode: passed to np.load for the components (default: read-only memory map;
+      use None to read them into memory).
+    Returns:
+    - PixelRing2NMF instance (with NMF2D models without MiniBatchNMF estimator, see NMF2D.from_components).
+    '''
+    if os.path.basename(path) == MANIFEST_NAME: path = os.path.dirname(path)
+    with open(os.path.join(path, MANIFEST_NAME), 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('format') != ARTIFACT_FORMAT or manifest.get('version') != ARTIFACT_VERSION:
+        msg = f'Model artifact format {manifest.get("format")} version {manifest.get("version")}'
+        msg += f' not recognized (expected {ARTIFACT_FORMAT} version {ARTIFACT_VERSION}).'
+        raise Exception(msg)
+    nmfs = {}
+    for mename in manifest['menames']:
+        info = manifest['nmfs'][mename]
+        components = np.load(os.path.join(path, info['components']), mmap_mode=mmap_mode)
+        if list(components.shape[1:]) != info['xshape']:
+            msg = f'Components of {mename} have shape {components.shape},'
+            msg += f' which does not match the expected shape {info["xshape"]}.'
+            raise Exception(msg)
+        nmfs[mename] = NMF2D.from_components(components,
+                         alpha_W=info['alpha_W'], l1_ratio=info['l1_ratio'], max_iter=info['max_iter'],
+                         beta_loss=info['beta_loss'], tol=info['tol'],
+                         solver=info['solver'], solver_max_iter=info['solver_max_iter'],
+                         warm_start=info['warm_start'])
+    return PixelRing2NMF(nmfs, thresholds=manifest['thresholds'], **manifest['settings'])
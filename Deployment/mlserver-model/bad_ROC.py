@@ -1,140 +1,264 @@
 import itertools
 import numpy as np
-import pandas as pd
-from functions import plot_losses, powerGroupToIndex, powerGroupsToAnomalyType, analyzePowerGroupString
-
-optimized_powerGroupStringsList = np.array(['FPix_BmO_D3_ROG4','FPix_BmO_D2_ROG4','FPix_BmO_D1_ROG4','FPix_BmO_D3_ROG3','FPix_BmO_D2_ROG3','FPix_BmO_D1_ROG3','FPix_BmO_D3_ROG2','FPix_BmO_D2_ROG2','FPix_BmO_D1_ROG2','FPix_BmO_D3_ROG1','FPix_BmO_D2_ROG1','FPix_BmO_D1_ROG1','FPix_BmI_D3_ROG1','FPix_BmI_D2_ROG1','FPix_BmI_D1_ROG1','FPix_BmI_D3_ROG2','FPix_BmI_D2_ROG2','FPix_BmI_D1_ROG2','FPix_BmI_D3_ROG3','FPix_BmI_D2_ROG3','FPix_BmI_D1_ROG3','FPix_BmI_D3_ROG4','FPix_BmI_D2_ROG4','FPix_BmI_D1_ROG4','FPix_BpO_D1_ROG4','FPix_BpO_D2_ROG4','FPix_BpO_D3_ROG4','FPix_BpO_D1_ROG3','FPix_BpO_D2_ROG3','FPix_BpO_D3_ROG3','FPix_BpO_D1_ROG2','FPix_BpO_D2_ROG2','FPix_BpO_D3_ROG2','FPix_BpO_D1_ROG1','FPix_BpO_D2_ROG1','FPix_BpO_D3_ROG1','FPix_BpI_D1_ROG1','FPix_BpI_D2_ROG1','FPix_BpI_D3_ROG1','FPix_BpI_D1_ROG2','FPix_BpI_D2_ROG2','FPix_BpI_D3_ROG2','FPix_BpI_D1_ROG3','FPix_BpI_D2_ROG3','FPix_BpI_D3_ROG3','FPix_BpI_D1_ROG4','FPix_BpI_D2_ROG4','FPix_BpI_D3_ROG4'])
-#A list of all of the quarters of the detector
-QUARTERS = np.array([['FPix_BmI_D3_ROG1','FPix_BmI_D3_ROG2','FPix_BmI_D3_ROG3','FPix_BmI_D3_ROG4','FPix_BmI_D2_ROG1','FPix_BmI_D2_ROG2','FPix_BmI_D2_ROG3','FPix_BmI_D2_ROG4','FPix_BmI_D1_ROG1','FPix_BmI_D1_ROG2','FPix_BmI_D1_ROG3','FPix_BmI_D1_ROG4'], ['FPix_BmO_D3_ROG1','FPix_BmO_D3_ROG2','FPix_BmO_D3_ROG3','FPix_BmO_D3_ROG4','FPix_BmO_D2_ROG1','FPix_BmO_D2_ROG2','FPix_BmO_D2_ROG3','FPix_BmO_D2_ROG4','FPix_BmO_D1_ROG1','FPix_BmO_D1_ROG2','FPix_BmO_D1_ROG3','FPix_BmO_D1_ROG4'], ['FPix_BpI_D1_ROG1','FPix_BpI_D1_ROG2','FPix_BpI_D1_ROG3','FPix_BpI_D1_ROG4','FPix_BpI_D2_ROG1','FPix_BpI_D2_ROG2','FPix_BpI_D2_ROG3','FPix_BpI_D2_ROG4','FPix_BpI_D3_ROG1','FPix_BpI_D3_ROG2','FPix_BpI_D3_ROG3','FPix_BpI_D3_ROG4'], ['FPix_BpO_D1_ROG1','FPix_BpO_D1_ROG2','FPix_BpO_D1_ROG3','FPix_BpO_D1_ROG4','FPix_BpO_D2_ROG1','FPix_BpO_D2_ROG2','FPix_BpO_D2_ROG3','FPix_BpO_D2_ROG4','FPix_BpO_D3_ROG1','FPix_BpO_D3_ROG2','FPix_BpO_D3_ROG3','FPix_BpO_D3_ROG4']])
+from functions import plot_losses
+from functions import optimized_powerGroupStringsList, QUARTERS, POWERGROUP_GEOMETRY, meNameToRing
 
 RING = 2
-    
-def search_for_anomalies(losses, thresholds):
 
-    verbose = 0
-    mename = 'Ring2'
+# integer representation of the power groups for the anomaly classification:
+# - one bit per power group ID (i.e. index in optimized_powerGroupStringsList)
+# - one group per (half-cylinder, I/O, ROG part), i.e. the same power group on the three disks;
+#   a Multi-Disk anomaly is a group with anomalous power groups on at least two distinct disks.
+POWERGROUP_BITS = np.left_shift(np.uint64(1), np.arange(len(optimized_powerGroupStringsList), dtype=np.uint64))
+_, ROG_GROUPS = np.unique([f'{m_or_p}{I_or_O}{part}' for m_or_p, I_or_O, part
+                           in zip(POWERGROUP_GEOMETRY.m_or_p, POWERGROUP_GEOMETRY.I_or_O, POWERGROUP_GEOMETRY.part)],
+                          return_inverse=True)
+ROG_GROUP_MEMBERSHIP = (ROG_GROUPS[:, None] == np.arange(ROG_GROUPS.max()+1)[None, :]).astype(np.uint8)
+# power group IDs per group, as an array of shape (number of groups, number of disks)
+ROG_GROUP_INDICES = np.argsort(ROG_GROUPS, kind='stable').reshape(ROG_GROUP_MEMBERSHIP.shape[1], -1)
+QUARTER_MASKS = np.array([np.bitwise_or.reduce(POWERGROUP_BITS[POWERGROUP_GEOMETRY.quarter == idx])
+                          for idx in range(len(QUARTERS))])
+
+# structured array type for the anomaly details (one row per anomaly):
+# - ls_index: index of the lumisection in the input array
+# - powergroups: bitmask of the power groups involved in the anomaly (see POWERGROUP_BITS)
+# - multi_disk: whether the anomaly is of type Multi-Disk (otherwise Single-Disk)
+ANOMALY_DTYPE = np.dtype([('ls_index', np.int64), ('powergroups', np.uint64), ('multi_disk', bool)])
+
+# cache of power-group membership maps,
+# keyed by (ring, number of y-bins, number of x-bins)
+_powergroup_masks = {}
+
+def get_powergroup_masks(ring=RING, shape=None, anticrop=None):
+    '''
+    Return the power-group membership map for a given ring.
+    Input arguments:
+    - ring: ring number (1 or 2).
+    - shape: (number of y-bins, number of x-bins) of the loss maps (WITH the cross);
+             default: smallest shape that contains all power groups.
+    - anticrop: if specified, tuple of (y-slice, x-slice) of the empty cross (see PreProcessor),
+                which is then removed from the map, i.e. the map is translated to cropped coordinates.
+    Returns:
+    - boolean np array of shape (number of power groups, y-bins, x-bins),
+      where entry j is True for the bins that belong to optimized_powerGroupStringsList[j].
+    Note: the map is computed only once per ring, shape and anticrop, and cached for later calls.
+    '''
+    slices = POWERGROUP_GEOMETRY.slices[ring]
+    if shape is None:
+        shape = (max(s[0].stop for s in slices), max(s[1].stop for s in slices))
+    key = (ring, *shape)
+    if anticrop is not None:
+        key += tuple((s.start, s.stop) for s in anticrop)
+    if key not in _powergroup_masks:
+        masks = np.zeros((len(slices), *shape), dtype=bool)
+        for j, (powerGroupSlice, diskSlice) in enumerate(slices):
+            masks[j, powerGroupSlice, diskSlice] = True
+        if anticrop is not None:
+            masks = np.delete(masks, anticrop[0], axis=1)
+            masks = np.delete(masks, anticrop[1], axis=2)
+        masks.setflags(write=False)
+        _powergroup_masks[key] = masks
+    return _powergroup_masks[key]
 
-    loss_threshold = thresholds['loss_threshold']
+def count_bad_ROCs(losses_array, loss_threshold, masks, batch_size=1024):
+    '''
+    Count the number of bins above threshold in each power group, for all lumisections at once.
+    Input arguments:
+    - losses_array: np array of shape (number of lumisections, y-bins, x-bins) with the losses.
+    - loss_threshold: bins with a loss strictly larger than this value are counted as bad.
+    - masks: power-group membership map (see get_powergroup_masks).
+    - batch_size: number of lumisections processed per matrix product (limits the memory usage).
+    Returns:
+    - int np array of shape (number of lumisections, number of power groups).
+    '''
+    nls = losses_array.shape[0]
+    # flattened membership matrix of shape (number of bins, number of power groups)
+    # note: float32 matrix products are exact for counts up to 2**24
+    membership = masks.reshape(masks.shape[0], -1).T.astype(np.float32)
+    counts = np.zeros((nls, masks.shape[0]), dtype=np.int32)
+    for start in range(0, nls, batch_size):
+        binary_losses = losses_array[start:start+batch_size].reshape(-1, membership.shape[0]) > loss_threshold
+        counts[start:start+batch_size] = np.matmul(binary_losses.astype(np.float32), membership)
+    return counts
+
+def find_anomalous_powergroups(losses_array, thresholds, ring=RING, anticrop=None, return_ratios=False):
+    '''
+    Find the anomalous power groups in all lumisections at once.
+    Input arguments:
+    - losses_array: np array of shape (number of lumisections, y-bins, x-bins) with the losses
+                    (WITH the cross, unless anticrop is specified).
+    - thresholds: dict with keys "loss_threshold" (threshold on the loss of a bin)
+                  and "ROC_fraction" (threshold in percent on the fraction of bad bins in a power group).
+    - anticrop: tuple of (y-slice, x-slice) of the empty cross that was removed from the losses
+                (default: the losses are WITH the cross).
+    - return_ratios: also return the bad-ROC ratios (see below).
+    Returns:
+    - boolean np array of shape (number of lumisections, number of power groups),
+      where the power groups are ordered as in optimized_powerGroupStringsList.
+    - if return_ratios is True: tuple of the above and the following two float np arrays of the same shape:
+      - the number of bad bins divided by the minimum number of bad bins for an anomalous power group
+        (i.e. a power group is anomalous if this ratio is at least 1; the ratio is 1 if this minimum is 0),
+      - the fraction of bad bins in each power group.
+    '''
+    shape = losses_array.shape[1:]
+    if anticrop is not None:
+        shape = tuple(n + s.stop - s.start for n, s in zip(shape, anticrop))
+    masks = get_powergroup_masks(ring, shape, anticrop=anticrop)
+    counts = count_bad_ROCs(losses_array, thresholds['loss_threshold'], masks)
+    # minimum number of bad bins per power group
+    # (computed exactly as in the per-lumisection implementation)
     ROC_fraction = thresholds['ROC_fraction']
-    
-    losses_array = np.array(losses[mename]) 
+    totals = masks.reshape(masks.shape[0], -1).sum(axis=1)
+    min_bad_ROCs = np.array([int(ROC_fraction/100 * int(total)) for total in totals])
+    anomalous = counts >= min_bad_ROCs
+    if not return_ratios: return anomalous
+    # (if the minimum is 0, e.g. for a small ROC_fraction, every power group is anomalous,
+    # so the ratio is set to 1 to keep it consistent with the flags, while staying finite for the metric output)
+    ratios = np.where(min_bad_ROCs > 0, counts / np.maximum(min_bad_ROCs, 1), 1.)
+    fractions = counts / totals
+    return (anomalous, ratios, fractions)
+
+def count_multidisk_groups(anomalous):
+    '''
+    Count the anomalous power groups per (half-cylinder, I/O, ROG part) group.
+    Input arguments:
+    - anomalous: boolean np array of shape (number of lumisections, number of power groups)
+                 (see find_anomalous_powergroups).
+    Returns:
+    - int np array of shape (number of lumisections, number of groups),
+      with the number of distinct disks with an anomalous power group in each group.
+    '''
+    return np.matmul(anomalous.astype(np.uint8), ROG_GROUP_MEMBERSHIP)
+
+def get_anomaly_scores(anomalous, ratios, fractions):
+    '''
+    Compute continuous per-lumisection anomaly scores from the per-power-group results
+    (see find_anomalous_powergroups), without another pass over the losses.
+    Returns:
+    - dict with the following np arrays of shape (number of lumisections):
+      - 'score': maximum over (half-cylinder, I/O, ROG part) groups of the second-largest bad-ROC ratio
+        of the power groups in that group; a lumisection is flagged if and only if the score is at least 1
+        (i.e. if a group has an anomalous power group on at least two disks).
+      - 'max_bad_fraction': maximum fraction of bad bins over all power groups.
+      - 'multi_disk_groups': number of groups with an anomalous power group on at least two disks.
+    '''
+    grouped = np.sort(ratios[:, ROG_GROUP_INDICES], axis=-1)
+    return {
+      'score': np.max(grouped[:, :, -2], axis=1),
+      'max_bad_fraction': np.max(fractions, axis=1),
+      'multi_disk_groups': np.sum(count_multidisk_groups(anomalous) >= 2, axis=1),
+    }
+
+def get_empty_anomaly_scores(nls):
+    '''
+    Return anomaly scores (see get_anomaly_scores) equal to 0 for a given number of lumisections.
+    '''
+    empty = np.zeros((nls, len(optimized_powerGroupStringsList)))
+    return get_anomaly_scores(empty.astype(bool), empty, empty)
+
+def get_anomaly_details(anomalous):
+    '''
+    Make the list of anomalies in each lumisection.
+    Input arguments:
+    - anomalous: boolean np array of shape (number of lumisections, number of power groups)
+                 (see find_anomalous_powergroups).
+    Returns:
+    - structured np array of type ANOMALY_DTYPE, with one row per anomaly.
+      The rows are the same (and in the same order) as in the former per-lumisection dataframe:
+      - a whole quarter (12 anomalous power groups in the same quarter) gives one Multi-Disk row;
+      - a single anomalous power group gives one Single-Disk row;
+      - each pair of anomalous power groups in the same group gives one Multi-Disk row,
+        each other pair gives one Single-Disk row per power group (without duplicates).
+    '''
+    details = []
+    for i in np.nonzero(np.any(anomalous, axis=1))[0]:
+        pgids = np.nonzero(anomalous[i])[0]
+        rows = []
+        if len(pgids) == 12:
+            mask = np.bitwise_or.reduce(POWERGROUP_BITS[pgids])
+            if np.any(QUARTER_MASKS == mask): rows.append((i, mask, True))
+        if len(pgids) == 1:
+            rows.append((i, POWERGROUP_BITS[pgids[0]], False))
+        for pgid_one, pgid_two in itertools.combinations(pgids, 2):
+            if ROG_GROUPS[pgid_one] == ROG_GROUPS[pgid_two]:
+                rows.append((i, POWERGROUP_BITS[pgid_one] | POWERGROUP_BITS[pgid_two], True))
+            else:
+                rows.append((i, POWERGROUP_BITS[pgid_one], False))
+                rows.append((i, POWERGROUP_BITS[pgid_two], False))
+        # remove duplicate rows, keeping the first occurrence
+        details.extend(dict.fromkeys(rows))
+    return np.array(details, dtype=ANOMALY_DTYPE)
+
+def render_anomaly_details(details):
+    '''
+    Convert anomaly details (see get_anomaly_details) to a human-readable dataframe
+    with columns "LS_Index", "Powergroup", "Disk" and "Anomaly_Type".
+    '''
+    import pandas as pd
+    rows = []
+    for ls_index, mask, multi_disk in details:
+        pgids = np.nonzero(np.bitwise_and(POWERGROUP_BITS, mask))[0]
+        disks = POWERGROUP_GEOMETRY.disk[pgids]
+        if len(pgids) == 12: disks = np.sign(disks[:1]) * np.array([1, 2, 3])
+        rows.append({"LS_Index": ls_index,
+                     "Powergroup": ':'.join(optimized_powerGroupStringsList[pgids]),
+                     "Disk": ':'.join(str(disk) for disk in disks),
+                     "Anomaly_Type": "Multi-Disk" if multi_disk else "Single-Disk"})
+    return pd.DataFrame(rows, columns=["LS_Index", "Powergroup", "Disk", "Anomaly_Type"])
+
+def search_for_anomalies(losses, thresholds, return_details=False, anticrop=None, return_scores=False, mename='Ring2'):
+    '''
+    Search for Multi-Disk anomalies.
+    Input arguments:
+    - losses: dict of the form {mename: np array of shape (number of lumisections, y-bins, x-bins)}
+              with the losses (WITH the cross, unless anticrop is specified).
+              note: float32 losses are used as is (compared to the threshold in float32, without conversion).
+    - thresholds: see find_anomalous_powergroups.
+    - return_details: also return the anomaly details (see get_anomaly_details).
+    - anticrop: see find_anomalous_powergroups.
+    - return_scores: also return the continuous anomaly scores (see get_anomaly_scores).
+    - mename: name of the monitoring element in losses (e.g. 'Ring1' or 'Ring2'),
+              from which the ring number is determined.
+    Returns:
+    - boolean np array of shape (number of lumisections), True if a Multi-Disk anomaly is found.
+    - if return_details is True: tuple of the above and the structured array with anomaly details.
+    - if return_scores is True: tuple of the above and the dict with anomaly scores.
+    '''
+
+    verbose = 0
+    ring = meNameToRing(mename)
+
+    losses_array = np.asarray(losses[mename])
     if verbose: print("Searching for anomalies")
-    res = np.zeros(losses_array.shape[0], dtype=bool)
-
-    for i in range(losses_array.shape[0]):  # loop over LS
-        full_losses = losses_array[i]
-        binary_losses = (full_losses > loss_threshold).astype(int)
-        anomalous_powergroups = []
-
-        for j, powergroup in enumerate(optimized_powerGroupStringsList):
-                powerGroupSlice, diskSlice = powerGroupToIndex(powergroup, RING)
-                num_bad_ROCs = int(np.sum(binary_losses[powerGroupSlice, diskSlice].flatten()))
-                total_ROC_in_powergroup = int(binary_losses[powerGroupSlice, diskSlice].flatten().size)
-                if verbose: print(powergroup, num_bad_ROCs, total_ROC_in_powergroup, int(num_bad_ROCs/total_ROC_in_powergroup*100),"%" )
-
-                #Access each power group in each lumisection and see if more than 40% of the bins are on
-                if num_bad_ROCs >= int(ROC_fraction/100 * total_ROC_in_powergroup):
-                    if verbose: print(f"Anomalous Power Group: {powergroup}")
-                    anomalous_powergroups.append(powergroup)
-
-        anomalous_powergroups = np.array(anomalous_powergroups)
-
-        #If there are no anomalous powergroups do not proceed further
-        if anomalous_powergroups.size == 0:
-            if verbose: print("NO Anomalies")
-        else:
-            if verbose: print("Check Anomaly Type")
-            #Create dataframe of anomalous lumisections and powergroups
-            anomaly_df = pd.DataFrame({"powergroups": anomalous_powergroups})
-
-            if verbose: print("Anomaly Dataframe: \n", anomaly_df, '\n')
-
-            #Create a pandas dataframe with all anomalies in that LS
-            headers = ["Powergroup", "Disk", "Anomaly_Type"]
-            dataDict = dict.fromkeys(headers)
-            detailed_anomaly_df = pd.DataFrame(columns=headers)
-
-            #Get the lumisection and all of the anomaly powergroups
-            #If there is only one powergroup, mark it Single Disk, preparing the detailed Pandas anomaly dataframe, then move on
-                #If there is multiple powergroups, iterate through each pair, breaking on the first Multi-disk anomaly after preparing the detailed Pandas anomaly dataframe
-                #If there is no Multi-disk anomaly despite there being multiple anomalies in one lumisection, prepare the detailed Pandas anomaly dataframe with EACH anomaly
-
-            dataframe = anomaly_df
-            powergroups = dataframe["powergroups"].to_list()
-
-            #If there are 12 anomalous powergroups in one lumisection, check if it's a whole quarter out
-            if len(powergroups) == 12:
-                    for quarter in QUARTERS:
-                        #If all of the powergroups are in one quarter, then we can save and break early
-                        if np.all(np.isin(powergroups, quarter)):
-                            #Fill in the data dict
-                            m_or_p, I_or_O, disk_number, part_number = analyzePowerGroupString(powergroups[0])
-                            dataDict["Powergroup"] = ':'.join(powergroups)
-                            dataDict["Disk"] = "-1:-2:-3" if disk_number < 0 else "1:2:3"
-                            #dataDict["Anomaly_Type"] = "Whole Quarter"
-                            dataDict["Anomaly_Type"] = "Multi-Disk"
-                            dataFrame = pd.Series(dataDict).to_frame().T
-                            detailed_anomaly_df = pd.concat([detailed_anomaly_df, dataFrame])
-                    #then continue to the next unique anomaly
-                    #continue
-
-            #If there is only one powergroup, mark it as a Single-Disk anomaly
-            if len(powergroups) == 1:
-                    #Fill in the data dict
-                    m_or_p, I_or_O, disk_number, part_number = analyzePowerGroupString(powergroups[0])
-                    dataDict["Powergroup"] = powergroups[0]
-                    dataDict["Disk"] = disk_number
-                    dataDict["Anomaly_Type"] = "Single-Disk"
-                    #Convert the data dict to a pandas dataframe and concat it to the detailed data frame 
-                    dataFrame = pd.Series(dataDict).to_frame().T
-                    detailed_anomaly_df = pd.concat([detailed_anomaly_df, dataFrame])
-                    #continue to the next loop
-                    
-            #If there is more than one anomalous powergroup in that lumisection and it's NOT the whole quarter out
-            all_powergroup_combos = itertools.combinations(powergroups, 2)
-            #Loop over all pairs of powergroups and search for multi-disk anomalies
-            #dataDictList = [] #Create a list to store all of the possible Single-Disk anomalies in case there are multiple anomalies but no Multi-Disk anomaly
-            for powergroup_combo in all_powergroup_combos:
-                    anomaly_type = powerGroupsToAnomalyType(powergroup_combo[0], powergroup_combo[1])
-                    #Extract relevant information
-                    m_or_p_one, I_or_O_one, disk_number_one, part_number_one = analyzePowerGroupString(powergroup_combo[0])
-                    m_or_p_two, I_or_O_two, disk_number_two, part_number_two = analyzePowerGroupString(powergroup_combo[1])
-                    if anomaly_type == "Multi-Disk":
-                        #Fill in the data dict
-                        dataDict["Powergroup"] = powergroup_combo[0] + ':' + powergroup_combo[1]
-                        dataDict["Disk"] = str(disk_number_one) + ':' + str(disk_number_two)
-                        dataDict["Anomaly_Type"] = "Multi-Disk"
-                        dataFrame = pd.Series(dataDict).to_frame().T
-                        detailed_anomaly_df = pd.concat([detailed_anomaly_df, dataFrame])
-                    else:
-                        #Fill in a data dict for each anomaly
-                        dataDict["Powergroup"] = powergroup_combo[0]
-                        dataDict["Disk"] = str(disk_number_one)
-                        dataDict["Anomaly_Type"] = "Single-Disk"
-                        dataFrame = pd.Series(dataDict).to_frame().T
-                        detailed_anomaly_df = pd.concat([detailed_anomaly_df, dataFrame])
-
-                        #Fill in second data dict
-                        dataDict["Powergroup"] = powergroup_combo[1]
-                        dataDict["Disk"] = str(disk_number_two)
-                        dataDict["Anomaly_Type"] = "Single-Disk"
-                        dataFrame = pd.Series(dataDict).to_frame().T
-                        detailed_anomaly_df = pd.concat([detailed_anomaly_df, dataFrame])
-               
-            #Remove all exact duplicate rows
-            detailed_anomaly_df = detailed_anomaly_df.drop_duplicates()
-
-            if verbose: print(detailed_anomaly_df.to_string())
-            # Example of anomaly_df from run 386661 (LS 103)
-            #Powergroup Disk Anomaly_Type
-            #0  FPix_BpO_D1_ROG2:FPix_BpO_D2_ROG2  1:2   Multi-Disk
-            #0  FPix_BpO_D1_ROG2:FPix_BpO_D3_ROG2  1:3   Multi-Disk
-            #0  FPix_BpO_D2_ROG2:FPix_BpO_D3_ROG2  2:3   Multi-Disk
-
-            if verbose: 
-                plot_losses(full_losses, binary_losses, 100, 200, 2, saveFig=False, showFig=True)
-                    
-            if (detailed_anomaly_df['Anomaly_Type'] == 'Multi-Disk').any():
-                res[i] = True
 
+    # find the anomalous power groups for all LS at once,
+    # and flag the LS where the same power group is anomalous on at least two disks
+    # (note: this includes the case of a whole quarter)
+    anomalous, ratios, fractions = find_anomalous_powergroups(losses_array, thresholds, ring,
+                                                              anticrop=anticrop, return_ratios=True)
+    res = np.any(count_multidisk_groups(anomalous) >= 2, axis=1)
+
+    details = None
+    if return_details or verbose:
+        details = get_anomaly_details(anomalous)
+
+    if verbose:
+        print(render_anomaly_details(details).to_string())
+        # Example of anomaly details from run 386661 (LS 103)
+        #LS_Index Powergroup Disk Anomaly_Type
+        #0  103  FPix_BpO_D1_ROG2:FPix_BpO_D2_ROG2  1:2   Multi-Disk
+        #1  103  FPix_BpO_D1_ROG2:FPix_BpO_D3_ROG2  1:3   Multi-Disk
+        #2  103  FPix_BpO_D2_ROG2:FPix_BpO_D3_ROG2  2:3   Multi-Disk
+        for i in np.nonzero(res)[0]:
+            full_losses = losses_array[i]
+            if anticrop is not None:
+                full_losses = np.insert(full_losses, [anticrop[0].start]*(anticrop[0].stop-anticrop[0].start), 0, axis=0)
+                full_losses = np.insert(full_losses, [anticrop[1].start]*(anticrop[1].stop-anticrop[1].start), 0, axis=1)
+            binary_losses = (full_losses > thresholds['loss_threshold']).astype(int)
+            plot_losses(full_losses, binary_losses, 100, 200, ring, saveFig=False, showFig=True)
+
+    if not (return_details or return_scores): return res
+    res = (res,)
+    if return_details: res += (details,)
+    if return_scores: res += (get_anomaly_scores(anomalous, ratios, fractions),)
     return res
@@ -0,0 +1,102 @@
+# Cache of per-lumisection results
+
+# import external modules
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+
+class LumisectionCache(object):
+    '''
+    Size-bounded cache of per-lumisection results, with least-recently-used eviction.
+    The keys are content hashes of the lumisections (see hash_lumisections),
+    so that lumisections that were already processed (e.g. when a run is re-requested
+    with new lumisections appended) do not need to be processed again.
+    '''
+
+    def __init__(self, max_entries=100000):
+        '''
+        Initializer.
+        Input arguments:
+        - max_entries: maximum number of lumisections in the cache;
+          the least recently used ones are removed when this number is exceeded.
+        '''
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def hash_lumisections(mes, indices, salt=b''):
+        '''
+        Compute a content hash per lumisection.
+        Input arguments:
+        - mes: list of np arrays of shape (number of lumisections, ...), e.g. one per monitoring element.
+        - indices: indices of the lumisections to hash.
+        - salt: bytes identifying everything else the results depend on
+          (e.g. model, settings and thresholds, see PixelRing2NMF.get_cache_salt);
+          lumisections with the same content but a different salt get a different hash.
+        Returns:
+        - list of hashes (bytes), one per index.
+        '''
+        mes = [np.ascontiguousarray(me) for me in mes]
+        hashes = []
+        for idx in indices:
+            h = hashlib.blake2b(salt, digest_size=16)
+            for me in mes: h.update(me[idx].data)
+            hashes.append(h.digest())
+        return hashes
+
+    def lookup(self, keys):
+        '''
+        Look up results in the cache.
+        Input arguments:
+        - keys: list of hashes (see hash_lumisections).
+        Returns:
+        - a tuple with the following elements:
+          - boolean np array of the same length as keys, True for keys found in the cache
+          - list of cached results for the keys that were found (in the same order)
+        '''
+        found = np.zeros(len(keys), dtype=bool)
+        values = []
+        for i, key in enumerate(keys):
+            value = self.entries.get(key)
+            if value is None: continue
+            self.entries.move_to_end(key)
+            found[i] = True
+            values.append(value)
+        nhits = len(values)
+        self.hits += nhits
+        self.misses += len(keys) - nhits
+        return (found, values)
+
+    def store(self, keys, values):
+        '''
+        Store results in the cache (removing the least recently used entries if needed).
+        Input arguments:
+        - keys: list of hashes (see hash_lumisections).
+        - values: list of results of the same length as keys.
+        '''
+        for key, value in zip(keys, values):
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        '''
+        Remove all entries (the counters are kept).
+        '''
+        self.entries.clear()
+
+    def stats(self):
+        '''
+        Return a dict with the cache counters.
+        '''
+        return {'entries': len(self.entries), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
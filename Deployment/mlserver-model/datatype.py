@@ -1,3 +1,4 @@
+import base64
 import numpy as np
 
 
@@ -32,3 +33,40 @@ def dtype_to_datatype(dtype):
     Docs: https://kserve.github.io/website/master/modelserving/data_plane/v2_protocol/#tensor-data-types_1
     """
     return DTYPE_MAP.get(np.dtype(dtype).type, "UNKNOWN")
+
+
+def decode_tensor_data(data, datatype, shape):
+    """
+    Convert the data of an OIP input tensor to a numpy array of the given shape,
+    without going through per-element python objects where possible:
+    - raw bytes (binary data, in little-endian byte order) are read with np.frombuffer;
+    - a string is interpreted as base64-encoded binary data and read in the same way;
+    - a (flat or nested) list is converted with np.asarray (fallback for plain JSON requests).
+    Note: arrays read from bytes are read-only views on the request payload.
+    """
+    data = getattr(data, "__root__", data)
+    dtype = np.dtype(datatype_to_dtype(datatype)).newbyteorder("<")
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    if isinstance(data, list) and len(data) > 0 and isinstance(data[0], (bytes, bytearray)):
+        data = b"".join(data)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        array = np.frombuffer(data, dtype=dtype)
+    else:
+        array = np.asarray(data, dtype=dtype)
+    if array.shape != tuple(shape):
+        array = array.reshape(shape)
+    return array
+
+
+def encode_tensor_data(array, binary=False):
+    """
+    Convert a numpy array to the data of an OIP output tensor:
+    - if binary is False: a flat list (using ndarray.tolist, without an intermediate copy);
+    - if binary is True: a base64-encoded string of the raw data in little-endian byte order
+      (the inverse of decode_tensor_data).
+    """
+    if binary:
+        array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+        return base64.b64encode(array.data).decode("ascii")
+    return array.ravel().tolist()
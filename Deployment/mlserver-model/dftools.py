@@ -9,9 +9,11 @@
 
 # external modules
 import numpy as np
+from collections.abc import Mapping
 
 # local modules
 from omstools import find_oms_attr_for_lumisections
+from omstools import OMSJoinIndex
 
 # getter and selector for run numbers
 
@@ -74,14 +76,132 @@ def get_mes(df, datacolumn='data', xbinscolumn='xbins', ybinscolumn='ybins',
     if lumis is not None: df = select_ls(df, lumis, lumicolumn=lumicolumn)
     xbins = int(df[xbinscolumn].values[0])
     ybins = int(df[ybinscolumn].values[0])
-    # note: df['data'][idx] yields an array of 1d arrays;
-    # need to convert it to a 2d array with np.stack
-    mes = np.array([np.stack(df[datacolumn].values[i]).reshape(ybins,xbins) for i in range(len(df))])
+    # note: df['data'][idx] yields an array of 1d arrays (or a flat array);
+    # concatenate the rows of all instances into a single flat array
+    # (in two calls in total, instead of one np.stack call per instance), and reshape.
+    rows = np.concatenate(df[datacolumn].values)
+    if rows.dtype == object: rows = np.concatenate(rows)
+    mes = rows.reshape(len(df), ybins, xbins)
     runs = df[runcolumn].values
     lumis = df[lumicolumn].values
     return (mes, runs, lumis)
 
 
+# filter expressions
+
+# comparison operators allowed in filter expressions,
+# mapped to the corresponding vectorized numpy functions
+FILTER_OPERATORS = {
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '<': np.less,
+    '<=': np.less_equal,
+    '==': np.equal,
+    '!=': np.not_equal,
+}
+
+# logical operators allowed to combine filter expressions
+FILTER_COMBINATIONS = {
+    'and': np.logical_and,
+    'or': np.logical_or,
+}
+
+class FilterExpression(object):
+    """
+    Compiled filter expression on OMS attributes.
+    A filter expression is specified in one of the following (serializable) forms:
+    - ["<attribute>"]: the attribute converted to boolean (e.g. a DCS bit).
+    - ["<attribute>", "<operator>", <target value>]: comparison with one of the operators in FILTER_OPERATORS.
+    - {"and": [<filter expression>, ...]} or {"or": [<filter expression>, ...]}: combination of filter expressions.
+    The expression is parsed and validated only once (no eval), and applied with vectorized numpy functions.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.children = None
+        self.key = None
+        self.operator = None
+        self.target = None
+        if isinstance(spec, dict):
+            if len(spec)!=1 or list(spec.keys())[0] not in FILTER_COMBINATIONS:
+                raise Exception(f'Filter {spec} not recognized.')
+            self.operator = list(spec.keys())[0]
+            self.children = [FilterExpression(child) for child in spec[self.operator]]
+            if len(self.children)==0: raise Exception(f'Filter {spec} not recognized.')
+            self.name = '(' + f' {self.operator} '.join(child.name for child in self.children) + ')'
+        elif isinstance(spec, (list, tuple)) and len(spec)==1:
+            self.key = spec[0]
+            self.name = self.key
+        elif isinstance(spec, (list, tuple)) and len(spec)==3:
+            self.key, self.operator, self.target = spec
+            if self.operator not in FILTER_OPERATORS:
+                raise Exception(f'Filter {spec} not recognized (operator {self.operator} is not supported).')
+            if isinstance(self.target, (list, tuple, dict)):
+                raise Exception(f'Filter {spec} not recognized (target value must be a scalar).')
+            self.name = f'{self.key} {self.operator} {self.target}'
+        else:
+            raise Exception(f'Filter {spec} not recognized.')
+
+    @property
+    def keys(self):
+        """
+        Return the list of OMS attributes needed to evaluate this expression.
+        """
+        if self.children is None: return [self.key]
+        keys = []
+        for child in self.children:
+            keys += [key for key in child.keys if key not in keys]
+        return keys
+
+    def evaluate(self, values):
+        """
+        Evaluate the filter expression.
+        Input arguments:
+        - values: function or dict returning the 1D array of values for a given OMS attribute name
+                  (e.g. omstools.OMSJoinIndex.get).
+        Returns:
+        - boolean np array (True for lumisections that pass the filter).
+        """
+        getter = values.__getitem__ if isinstance(values, Mapping) else values
+        if self.children is not None:
+            return FILTER_COMBINATIONS[self.operator].reduce([child.evaluate(getter) for child in self.children])
+        if self.operator is None: return np.asarray(getter(self.key)).astype(bool)
+        return np.asarray(FILTER_OPERATORS[self.operator](getter(self.key), self.target), dtype=bool)
+
+def compile_filters(filters):
+    """
+    Compile a list of filter expressions (see FilterExpression).
+    Already compiled expressions are kept as they are.
+    """
+    if filters is None: return None
+    if isinstance(filters, (dict, FilterExpression)): filters = [filters]
+    return [f if isinstance(f, FilterExpression) else FilterExpression(f) for f in filters]
+
+class FilterResults(Mapping):
+    """
+    Read-only dict of the form {filter name: list of (run, lumisection) tuples failing the filter},
+    where the lists are only made when requested.
+    """
+
+    def __init__(self, run_numbers, ls_numbers, masks):
+        self.run_numbers = run_numbers
+        self.ls_numbers = ls_numbers
+        self.masks = masks
+        self.cache = {}
+
+    def __getitem__(self, key):
+        if key not in self.cache:
+            mask = self.masks[key]
+            self.cache[key] = [(run, ls) for run, ls in zip(self.run_numbers[~mask], self.ls_numbers[~mask])]
+        return self.cache[key]
+
+    def __iter__(self):
+        return iter(self.masks)
+
+    def __len__(self):
+        return len(self.masks)
+
+
 # advanced filtering
 
 def filter_lumisections(run_numbers, ls_numbers,
@@ -102,31 +222,34 @@ def filter_lumisections(run_numbers, ls_numbers,
                note: the array with number of entries is supposed to correspond to
                      run_numbers and ls_numbers; maybe generalize later.
     - min_entries_filter: dict of the form {<ME name>: <minimum number of entries for this ME>}.
+    - oms_info: dict with information from OMS (see omstools.find_oms_attr_for_lumisections).
+    - oms_filters: list of filter expressions on OMS attributes (see FilterExpression),
+                   either as specified or compiled beforehand with compile_filters.
+    Returns:
+    - a tuple with the following elements:
+      - boolean np array with the combined mask (True for lumisections that pass all filters)
+      - dict-like object of the form {filter name: list of (run, lumisection) tuples failing the filter}
+        (see FilterResults)
     '''
 
     # initializations
-    filter_results = {}
     combined_mask = np.ones(len(run_numbers)).astype(bool)
 
     # OMS attribute filters
+    # note: the filters are compiled here if they were not compiled before (see compile_filters)
+    masks = {}
     if oms_filters is not None:
-        for oms_filter in oms_filters:
-            if len(oms_filter)==1:
-                key = oms_filter[0]
-                filterstr = key
-                mask = find_oms_attr_for_lumisections(run_numbers, ls_numbers, oms_info, key).astype(bool)
-            elif len(oms_filter)==3:
-                key, operator, target = oms_filter
-                filterstr = f'{key} {operator} {target}'
-                values = find_oms_attr_for_lumisections(run_numbers, ls_numbers, oms_info, key)
-                mask = eval(f'values {operator} {target}', {'values': values})
-            else:
-                raise Exception(f'Filter {oms_filter} not recognized.')
+        # find the OMS rows for the provided lumisections only once for all filters
+        oms_index = OMSJoinIndex(run_numbers, ls_numbers, oms_info)
+        for oms_filter in compile_filters(oms_filters):
+            mask = oms_filter.evaluate(oms_index.get)
             # add to the total mask
             combined_mask = ((combined_mask) & (mask))
-            # keep track of lumisections that fail
-            fail = [(run, ls) for run, ls in zip(run_numbers[~mask], ls_numbers[~mask])]
-            filter_results[filterstr] = fail
+            masks[oms_filter.name] = mask
+
+    # keep track of lumisections that fail
+    # (lists of failing lumisections are only made when requested)
+    filter_results = FilterResults(np.asarray(run_numbers), np.asarray(ls_numbers), masks)
 
     # return results
     return (combined_mask, filter_results)
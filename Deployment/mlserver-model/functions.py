@@ -1,10 +1,32 @@
+import re
+import types
 import numpy as np
-import matplotlib.pyplot as plt
+# note: matplotlib is imported in the plotting functions only,
+#       so that it is not loaded when the model is deployed without plotting.
+
+################################################################################
+#######                            Constants                              ######
+################################################################################
+
+optimized_powerGroupStringsList = np.array(['FPix_BmO_D3_ROG4','FPix_BmO_D2_ROG4','FPix_BmO_D1_ROG4','FPix_BmO_D3_ROG3','FPix_BmO_D2_ROG3','FPix_BmO_D1_ROG3','FPix_BmO_D3_ROG2','FPix_BmO_D2_ROG2','FPix_BmO_D1_ROG2','FPix_BmO_D3_ROG1','FPix_BmO_D2_ROG1','FPix_BmO_D1_ROG1','FPix_BmI_D3_ROG1','FPix_BmI_D2_ROG1','FPix_BmI_D1_ROG1','FPix_BmI_D3_ROG2','FPix_BmI_D2_ROG2','FPix_BmI_D1_ROG2','FPix_BmI_D3_ROG3','FPix_BmI_D2_ROG3','FPix_BmI_D1_ROG3','FPix_BmI_D3_ROG4','FPix_BmI_D2_ROG4','FPix_BmI_D1_ROG4','FPix_BpO_D1_ROG4','FPix_BpO_D2_ROG4','FPix_BpO_D3_ROG4','FPix_BpO_D1_ROG3','FPix_BpO_D2_ROG3','FPix_BpO_D3_ROG3','FPix_BpO_D1_ROG2','FPix_BpO_D2_ROG2','FPix_BpO_D3_ROG2','FPix_BpO_D1_ROG1','FPix_BpO_D2_ROG1','FPix_BpO_D3_ROG1','FPix_BpI_D1_ROG1','FPix_BpI_D2_ROG1','FPix_BpI_D3_ROG1','FPix_BpI_D1_ROG2','FPix_BpI_D2_ROG2','FPix_BpI_D3_ROG2','FPix_BpI_D1_ROG3','FPix_BpI_D2_ROG3','FPix_BpI_D3_ROG3','FPix_BpI_D1_ROG4','FPix_BpI_D2_ROG4','FPix_BpI_D3_ROG4'])
+#A list of all of the quarters of the detector
+QUARTERS = np.array([['FPix_BmI_D3_ROG1','FPix_BmI_D3_ROG2','FPix_BmI_D3_ROG3','FPix_BmI_D3_ROG4','FPix_BmI_D2_ROG1','FPix_BmI_D2_ROG2','FPix_BmI_D2_ROG3','FPix_BmI_D2_ROG4','FPix_BmI_D1_ROG1','FPix_BmI_D1_ROG2','FPix_BmI_D1_ROG3','FPix_BmI_D1_ROG4'], ['FPix_BmO_D3_ROG1','FPix_BmO_D3_ROG2','FPix_BmO_D3_ROG3','FPix_BmO_D3_ROG4','FPix_BmO_D2_ROG1','FPix_BmO_D2_ROG2','FPix_BmO_D2_ROG3','FPix_BmO_D2_ROG4','FPix_BmO_D1_ROG1','FPix_BmO_D1_ROG2','FPix_BmO_D1_ROG3','FPix_BmO_D1_ROG4'], ['FPix_BpI_D1_ROG1','FPix_BpI_D1_ROG2','FPix_BpI_D1_ROG3','FPix_BpI_D1_ROG4','FPix_BpI_D2_ROG1','FPix_BpI_D2_ROG2','FPix_BpI_D2_ROG3','FPix_BpI_D2_ROG4','FPix_BpI_D3_ROG1','FPix_BpI_D3_ROG2','FPix_BpI_D3_ROG3','FPix_BpI_D3_ROG4'], ['FPix_BpO_D1_ROG1','FPix_BpO_D1_ROG2','FPix_BpO_D1_ROG3','FPix_BpO_D1_ROG4','FPix_BpO_D2_ROG1','FPix_BpO_D2_ROG2','FPix_BpO_D2_ROG3','FPix_BpO_D2_ROG4','FPix_BpO_D3_ROG1','FPix_BpO_D3_ROG2','FPix_BpO_D3_ROG3','FPix_BpO_D3_ROG4']])
+
+#The empty cross (rows, columns) in the data arrays of each ring, removed before training and inference
+ANTICROPS = {1: (slice(44, 48), slice(24, 32)), 2: (slice(68, 72), slice(24, 32))}
+
 
 ################################################################################
 #######                 Mapping to Disks/Panels/Powergroups               ######
 ################################################################################
 
+#return the ring number for a monitoring element name, e.g. 'Ring2' or 'PXRing_1'
+def meNameToRing(mename):
+    match = re.search(r'ring_?([12])', mename, re.IGNORECASE)
+    if match is None:
+        raise Exception(f"Could not determine the ring number for monitoring element {mename}!")
+    return int(match.group(1))
+
 #return slice objects for a data array WITH A CROSS 
 #that correspond to the desired panel on a desired disk on a desired ring
 def panelDiskToIndex(panel, disk, ring):
@@ -41,7 +63,7 @@ def panelDiskToIndex(panel, disk, ring):
 #Summary: 
 #Negative Disk: m    Positive Disk: p
 #Negative Panel: O   Positive Panel: I
-def powerGroupToDiskPanels(powerGroupString, ring):
+def _parsePowerGroupToDiskPanels(powerGroupString, ring):
     #Input Parameter checking
     stringParts = powerGroupString.split('_')
     #The whole string should be 16 characters long and
@@ -111,9 +133,9 @@ def powerGroupToDiskPanels(powerGroupString, ring):
 #Now that we have a function that takes in powerGroup Strings and returns the disk number and panels
 #We can make another function that will return the specific slice's for a 
 #specific powerGroup String
-def powerGroupToIndex(powerGroupString, ring):
+def _parsePowerGroupToIndex(powerGroupString, ring):
     #Get the disk number and panels of interest
-    panels, disk = powerGroupToDiskPanels(powerGroupString, ring)
+    panels, disk = _parsePowerGroupToDiskPanels(powerGroupString, ring)
     #print(panels)
     #Loop over each panel to get their slice's. Make sure to specify the type or numpy get's mad
     slices = np.empty(len(panels), dtype=type(slice))
@@ -148,7 +170,7 @@ def powerGroupToIndex(powerGroupString, ring):
     return powerGroupSlice, diskSlice
 
 
-def analyzePowerGroupString(powerGroupString):
+def _parsePowerGroupString(powerGroupString):
     #Take in a powergroup string in the form FPix_B[m/p][I/O]_Disk#_PRT_#
     #and return m/p, I/O, Disk number, and part number
     #Input Parameter checking
@@ -190,6 +212,89 @@ def analyzePowerGroupString(powerGroupString):
     return disk_minus_positive_char, panel_minus_positive_char, disk_number, part_number
 
 
+#Precompiled geometry of all power groups, so that the mapping functions below
+#do not need to split and validate the power group strings on every call
+class PowerGroupGeometry(object):
+    '''
+    Frozen table with the geometry of the power groups in optimized_powerGroupStringsList,
+    indexed by integer power group ID (i.e. the index in optimized_powerGroupStringsList).
+    Attributes:
+    - names: np array with the power group strings.
+    - ids: read-only dict of the form {power group string: power group ID}.
+    - m_or_p, I_or_O: np arrays with the half-cylinder ('m' or 'p') and inner/outer ('I' or 'O') identifiers.
+    - disk: np array with the signed disk numbers.
+    - part: np array with the ROG part numbers.
+    - quarter: np array with the index of the quarter (in QUARTERS) of each power group.
+    - panels: dict of the form {ring: tuple with a np array of signed panel numbers per power group}.
+    - slices: dict of the form {ring: tuple with a (powerGroupSlice, diskSlice) pair per power group}.
+    Note: all arrays are read-only, and attributes cannot be set after initialization.
+    '''
+
+    def __init__(self, powerGroupStrings, quarters, rings=(1, 2)):
+        analysis = [_parsePowerGroupString(powergroup) for powergroup in powerGroupStrings]
+        self.names = np.array(powerGroupStrings)
+        self.ids = types.MappingProxyType({str(name): idx for idx, name in enumerate(self.names)})
+        self.analysis = tuple(analysis)
+        self.m_or_p = np.array([a[0] for a in analysis])
+        self.I_or_O = np.array([a[1] for a in analysis])
+        self.disk = np.array([a[2] for a in analysis])
+        self.part = np.array([a[3] for a in analysis])
+        self.quarter = np.array([[idx for idx, quarter in enumerate(quarters) if name in quarter][0]
+                                 for name in self.names])
+        self.rings = tuple(rings)
+        self.panels = {}
+        self.slices = {}
+        for ring in self.rings:
+            panels = []
+            slices = []
+            for powergroup in self.names:
+                ring_panels = _parsePowerGroupToDiskPanels(powergroup, ring)[0]
+                ring_panels.setflags(write=False)
+                panels.append(ring_panels)
+                powerGroupSlice, diskSlice = _parsePowerGroupToIndex(powergroup, ring)
+                slices.append((slice(int(powerGroupSlice.start), int(powerGroupSlice.stop)), diskSlice))
+            self.panels[ring] = tuple(panels)
+            self.slices[ring] = tuple(slices)
+        self.panels = types.MappingProxyType(self.panels)
+        self.slices = types.MappingProxyType(self.slices)
+        for arr in (self.names, self.m_or_p, self.I_or_O, self.disk, self.part, self.quarter):
+            arr.setflags(write=False)
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise Exception('PowerGroupGeometry is frozen; attributes cannot be modified.')
+        super().__setattr__(name, value)
+
+    def lookup(self, powerGroupString, ring=None):
+        '''
+        Return the power group ID of a power group string,
+        or None if it is not in the table (or the ring is not supported).
+        '''
+        if ring is not None and ring not in self.rings: return None
+        return self.ids.get(powerGroupString)
+
+#Built once at import
+POWERGROUP_GEOMETRY = PowerGroupGeometry(optimized_powerGroupStringsList, QUARTERS)
+
+#Public mapping functions: lookups in POWERGROUP_GEOMETRY,
+#falling back to parsing the string for power groups that are not in the table
+def powerGroupToDiskPanels(powerGroupString, ring):
+    pgid = POWERGROUP_GEOMETRY.lookup(powerGroupString, ring)
+    if pgid is None: return _parsePowerGroupToDiskPanels(powerGroupString, ring)
+    return POWERGROUP_GEOMETRY.panels[ring][pgid], POWERGROUP_GEOMETRY.analysis[pgid][2]
+
+def powerGroupToIndex(powerGroupString, ring):
+    pgid = POWERGROUP_GEOMETRY.lookup(powerGroupString, ring)
+    if pgid is None: return _parsePowerGroupToIndex(powerGroupString, ring)
+    return POWERGROUP_GEOMETRY.slices[ring][pgid]
+
+def analyzePowerGroupString(powerGroupString):
+    pgid = POWERGROUP_GEOMETRY.lookup(powerGroupString)
+    if pgid is None: return _parsePowerGroupString(powerGroupString)
+    return POWERGROUP_GEOMETRY.analysis[pgid]
+
+
 #A function which takes in two powergroup strings and 
 #returns whether or not they would be a single or multi-disk anomaly
 def powerGroupsToAnomalyType(powergroup_one, powergroup_two):
@@ -209,6 +314,7 @@ def powerGroupsToAnomalyType(powergroup_one, powergroup_two):
 ################################################################################
 
 def plot_digis_ax(data_twodim, run_number, ls, ring, fig=None, axis=None):
+    import matplotlib.pyplot as plt
     
     #Create the fig and ax if they are not passed to the function
     if fig==None or axis==None:
@@ -258,6 +364,7 @@ def plot_digis_ax(data_twodim, run_number, ls, ring, fig=None, axis=None):
     return fig, ax
 
 def plot_losses(losses, losses_binary, run_number, lumi_number, ring_num, directory="images", saveFig=False, showFig=False):
+    import matplotlib.pyplot as plt
     fig, axes = plt.subplots(1, 2, figsize=(10, 8))
     
     FONTSIZE = 14
@@ -3,16 +3,47 @@ import logging
 logger = logging.getLogger(__name__)
 
 import copy
+import itertools
 import numpy as np
-from sklearn.decomposition import MiniBatchNMF
+# note: sklearn is imported when a new model is made (see __init__) or unpickled only,
+#       so that it is not loaded for models without MiniBatchNMF estimator (see from_components).
+
+# same small constant as used in sklearn to avoid divisions by zero
+EPSILON = np.finfo(np.float32).eps
+
+# numerical values of the beta_loss options of MiniBatchNMF (as in sklearn)
+BETA_LOSSES = {'frobenius': 2., 'kullback-leibler': 1., 'itakura-saito': 0.}
+
+# maximum number of components for the exact batched NNLS solver
+# (it enumerates all 2**n_components - 1 possible supports of the coefficients)
+NNLS_MAX_COMPONENTS = 10
 
 class NMF2D(object):
-    
+
     def __init__(self, **kwargs):
+        from sklearn.decomposition import MiniBatchNMF
         self.nmf = MiniBatchNMF(**kwargs)
         self.xshape = None
         self.components = None
-        
+        # inference settings (see set_solver)
+        self.solver = 'sklearn'
+        self.solver_max_iter = None
+        self.warm_start = False
+        # cached inference factors per data type (see prepare_inference)
+        self._inference = {}
+
+    def __getstate__(self):
+        # do not pickle the cached inference factors
+        state = self.__dict__.copy()
+        state['_inference'] = {}
+        return state
+
+    def __setstate__(self, state):
+        # set defaults for attributes that did not exist yet when the model was saved
+        defaults = {'solver': 'sklearn', 'solver_max_iter': None, 'warm_start': False, '_inference': {}}
+        self.__dict__.update(defaults)
+        self.__dict__.update(state)
+
     def fit(self, X):
         # fit components
         self.xshape = list(X.shape[1:])
@@ -23,17 +54,256 @@ class NMF2D(object):
         self.nmf.components_ = np.divide(self.nmf.components_, means[:, None])
         # post-processing: reshape back to input dimensions
         self.components = np.reshape(self.nmf.components_, (-1, *self.xshape))
-        
+        self._inference = {}
+
+    def set_solver(self, solver='sklearn', max_iter=None, warm_start=False):
+        '''
+        Set the solver used for inference.
+        Input arguments:
+        - solver: one of the following:
+          - 'sklearn': MiniBatchNMF.transform (default).
+          - 'nnls': exact batched non-negative least squares,
+            using the cached Gram matrix of the components (see prepare_inference).
+          - 'mu': multiplicative updates (as in MiniBatchNMF.transform, including its stopping rule if tol > 0),
+            using the cached Gram matrix of the components.
+        - max_iter: maximum number of iterations for the 'mu' solver (default: same as MiniBatchNMF.transform).
+        - warm_start: for the 'mu' solver, start the iterations from the 'nnls' solution
+          instead of a constant.
+        Note: the 'nnls' and 'mu' solvers are only available for models with beta_loss 'frobenius'
+              (see check_solver).
+        '''
+        self.check_solver(solver)
+        self.solver = solver
+        self.solver_max_iter = max_iter
+        self.warm_start = warm_start
+        self._inference = {}
+
+    def get_solver_params(self):
+        '''
+        Return a dict with the parameters of MiniBatchNMF.transform that determine
+        which solvers can reproduce it: beta_loss (as a number, 2 for 'frobenius') and tol.
+        '''
+        if self.nmf is None:
+            return {'beta_loss': self.inference_params['beta_loss'], 'tol': self.inference_params['tol']}
+        beta_loss = getattr(self.nmf, '_beta_loss', None)
+        if beta_loss is None: beta_loss = BETA_LOSSES.get(self.nmf.beta_loss, self.nmf.beta_loss)
+        return {'beta_loss': float(beta_loss), 'tol': float(self.nmf.tol)}
+
+    def check_solver(self, solver):
+        '''
+        Check that a solver is available for this model, and raise an exception otherwise.
+        The 'nnls' and 'mu' solvers minimize the Frobenius norm (with the multiplicative update for beta_loss 2),
+        so they cannot reproduce MiniBatchNMF.transform for other values of beta_loss.
+        '''
+        if solver not in ['sklearn', 'nnls', 'mu']:
+            raise Exception(f'Solver {solver} not recognized.')
+        if solver == 'sklearn' and self.nmf is None:
+            msg = 'The sklearn solver is not available for models without MiniBatchNMF estimator'
+            msg += ' (e.g. loaded from a model artifact); use the mu solver instead (same result for beta_loss frobenius).'
+            raise Exception(msg)
+        if solver != 'sklearn' and self.get_solver_params()['beta_loss'] != 2:
+            msg = f'The {solver} solver is only available for models with beta_loss frobenius'
+            msg += f' (this model has beta_loss {self.get_solver_params()["beta_loss"]}); use the sklearn solver instead.'
+            raise Exception(msg)
+
+    def is_batch_independent(self):
+        '''
+        Whether the coefficients of a lumisection are independent of the other lumisections in the batch.
+        This is the case for the 'nnls' solver, and for the other solvers if tol = 0 and either the iterations
+        do not start from the batch mean (warm_start with the 'mu' solver) or there is no L1 regularization
+        (alpha_W * l1_ratio = 0), since the multiplicative updates do not depend on the scale of the start
+        of the iterations only without the L1 term (see _solve_mu).
+        With tol > 0, the iterations stop based on the change over the whole batch.
+        '''
+        if self.solver == 'nnls': return True
+        params = self.get_inference_params()[1]
+        if params['tol'] > 0: return False
+        if self.solver == 'mu' and self.warm_start: return True
+        return (params['alpha_W'] * params['l1_ratio'] == 0)
+
+    @staticmethod
+    def working_dtype(X):
+        '''
+        Data type used for inference on X: float32 if X is float32, float64 otherwise.
+        '''
+        if np.asarray(X).dtype == np.float32: return np.dtype(np.float32)
+        return np.dtype(np.float64)
+
+    def get_inference_params(self):
+        '''
+        Return the components (2D np array of shape (n_components, n_features))
+        and a dict with the parameters of MiniBatchNMF.transform needed for inference
+        (alpha_W, l1_ratio, max_iter, beta_loss and tol).
+        '''
+        if self.nmf is None:
+            return (np.reshape(self.components, (len(self.components), -1)), self.inference_params)
+        params = {
+          'alpha_W': self.nmf.alpha_W,
+          'l1_ratio': self.nmf.l1_ratio,
+          'max_iter': getattr(self.nmf, '_transform_max_iter', self.nmf.max_iter),
+          **self.get_solver_params(),
+        }
+        return (self.nmf.components_, params)
+
+    def prepare_inference(self, dtype=np.float64):
+        '''
+        Precompute and cache the factors needed by the 'nnls' and 'mu' solvers.
+        Called automatically on first use; can be called explicitly at load time.
+        Input arguments:
+        - dtype: data type of the factors (float64 or float32, see working_dtype).
+        '''
+        dtype = np.dtype(dtype)
+        self.check_solver(self.solver)
+        # note: the factors are computed in float64 and only then converted
+        H, params = self.get_inference_params()
+        H = np.asarray(H, dtype=np.float64)
+        n_components, n_features = H.shape
+        # scaled regularization terms, as in MiniBatchNMF.transform
+        alpha_W = params['alpha_W']
+        l1_reg = n_features * alpha_W * params['l1_ratio']
+        l2_reg = n_features * alpha_W * (1.0 - params['l1_ratio'])
+        gram = np.dot(H, H.T)
+        # inverse of the (regularized) Gram matrix restricted to each possible support
+        supports = []
+        if n_components <= NNLS_MAX_COMPONENTS:
+            gram_reg = gram + l2_reg * np.eye(n_components)
+            for size in range(1, n_components+1):
+                for support in itertools.combinations(range(n_components), size):
+                    support = np.array(support)
+                    gram_inv = np.linalg.pinv(gram_reg[np.ix_(support, support)])
+                    supports.append((support, gram_inv.astype(dtype)))
+        max_iter = self.solver_max_iter
+        if max_iter is None: max_iter = params['max_iter']
+        self._inference[dtype] = {
+          'H': np.ascontiguousarray(H, dtype=dtype),
+          'HT': np.ascontiguousarray(H.T, dtype=dtype),
+          'HHt': gram.astype(dtype),
+          'l1_reg': l1_reg,
+          'l2_reg': l2_reg,
+          'supports': supports,
+          'max_iter': max_iter,
+          'tol': params['tol'],
+        }
+        return self._inference[dtype]
+
+    def get_inference(self, dtype=np.float64):
+        '''
+        Return the cached inference factors for the given data type (computing them if needed).
+        '''
+        engine = self._inference.get(np.dtype(dtype))
+        if engine is None: engine = self.prepare_inference(dtype=dtype)
+        return engine
+
+    def _solve_nnls(self, XHt, engine):
+        '''
+        Exact non-negative least squares for a batch, given X @ H.T.
+        For each possible support of the coefficients, solve the unconstrained problem
+        on that support; the solution is the feasible candidate with the lowest objective.
+        '''
+        if len(engine['supports']) == 0:
+            raise Exception('The nnls solver is not available for more than'
+                            + f' {NNLS_MAX_COMPONENTS} components; use the mu solver instead.')
+        b = XHt - engine['l1_reg']
+        W = np.zeros(b.shape, dtype=b.dtype)
+        # objective relative to W = 0 (at the unconstrained optimum on a support: -b.G^-1.b)
+        best = np.zeros(b.shape[0], dtype=b.dtype)
+        for support, gram_inv in engine['supports']:
+            W_support = np.dot(b[:, support], gram_inv)
+            objective = -np.sum(W_support * b[:, support], axis=1)
+            better = (objective < best) & np.all(W_support >= 0, axis=1)
+            if not np.any(better): continue
+            W[better] = 0
+            W[np.ix_(better, support)] = W_support[better]
+            best[better] = objective[better]
+        return W
+
+    def _solve_mu(self, X, XHt, engine, W=None):
+        '''
+        Multiplicative updates, with the same update rule (for beta_loss 2), stopping rule
+        and (unless W is provided) the same initialization as MiniBatchNMF.transform.
+        Note: the result of a lumisection depends on the other lumisections in the batch
+              if tol > 0 (the iterations stop when the relative change of W over the whole batch is at most tol,
+              as in MiniBatchNMF.transform), or if there is L1 regularization and W is not provided
+              (the constant start from the batch mean does not cancel out); see is_batch_independent.
+        '''
+        if W is None:
+            avg = np.sqrt(X.mean() / XHt.shape[1])
+            W = np.full(XHt.shape, avg, dtype=X.dtype)
+        else:
+            W = np.array(W, dtype=X.dtype)
+        l1_reg = engine['l1_reg']
+        l2_reg = engine['l2_reg']
+        tol = engine['tol']
+        if tol > 0:
+            # same norm as in MiniBatchNMF.transform
+            from scipy import linalg
+            W_buffer = W.copy()
+        for _ in range(engine['max_iter']):
+            denominator = np.dot(W, engine['HHt'])
+            if l1_reg > 0: denominator += l1_reg
+            if l2_reg > 0: denominator = denominator + l2_reg * W
+            denominator[denominator == 0] = EPSILON
+            numerator = XHt.copy()
+            numerator /= denominator
+            W *= numerator
+            if tol > 0:
+                if linalg.norm(W - W_buffer) / linalg.norm(W) <= tol: break
+                W_buffer[:] = W
+        return W
+
+    def transform(self, X):
+        '''
+        Compute the NMF coefficients for a batch of flattened inputs,
+        using the solver set with set_solver.
+        Note: float32 input is processed in float32 (see working_dtype).
+        '''
+        dtype = self.working_dtype(X)
+        if self.solver == 'sklearn': return self.nmf.transform(X).astype(dtype, copy=False)
+        engine = self.get_inference(dtype)
+        X = np.asarray(X, dtype=dtype)
+        XHt = np.dot(X, engine['HT'])
+        if self.solver == 'nnls': return self._solve_nnls(XHt, engine)
+        W = None
+        if self.warm_start: W = self._solve_nnls(XHt, engine)
+        return self._solve_mu(X, XHt, engine, W=W)
+
     def predict(self, X):
         X = np.reshape(X, (X.shape[0], -1))
-        Y = self.nmf.inverse_transform(self.nmf.transform(X))
+        dtype = self.working_dtype(X)
+        if self.solver == 'sklearn':
+            Y = self.nmf.inverse_transform(self.nmf.transform(X)).astype(dtype, copy=False)
+        else:
+            Y = np.dot(self.transform(X), self.get_inference(dtype)['H'])
         Y = np.reshape(Y, (-1, *self.xshape))
         return Y
-    
+
+    @staticmethod
+    def from_components(components, alpha_W=0., l1_ratio=0., max_iter=200, beta_loss=2., tol=0.,
+                        solver='mu', solver_max_iter=None, warm_start=False):
+        '''
+        Make a model for inference only, without MiniBatchNMF estimator.
+        Input arguments:
+        - components: np array of shape (n_components, *xshape) (e.g. a read-only memory-mapped array).
+        - alpha_W, l1_ratio, max_iter, beta_loss, tol: parameters of MiniBatchNMF.transform (see get_inference_params).
+        - solver, solver_max_iter, warm_start: see set_solver
+          (the 'sklearn' solver is not available, since there is no MiniBatchNMF estimator).
+        '''
+        new = NMF2D.__new__(NMF2D)
+        new.__setstate__({'nmf': None})
+        new.components = components
+        new.xshape = list(components.shape[1:])
+        new.inference_params = {'alpha_W': alpha_W, 'l1_ratio': l1_ratio, 'max_iter': max_iter,
+                                'beta_loss': float(beta_loss), 'tol': float(tol)}
+        new.set_solver(solver, max_iter=solver_max_iter, warm_start=warm_start)
+        return new
+
     @staticmethod
     def from_other(other):
         new = NMF2D()
         new.nmf = copy.deepcopy(other.nmf)
         new.xshape = copy.deepcopy(other.xshape)
         new.components = copy.deepcopy(other.components)
+        new.set_solver(getattr(other, 'solver', 'sklearn'),
+                       max_iter=getattr(other, 'solver_max_iter', None),
+                       warm_start=getattr(other, 'warm_start', False))
         return new
@@ -32,31 +32,87 @@ def find_oms_indices(runs, lumis, omsjson,
     ids = ids.astype(int)
     omsids = omsruns*idfactor + omslumis
     omsids = omsids.astype(int)
+    # find indices of ids in omsids with a sorted merge
+    # (sort omsids once, and look up all ids with a single binary search)
+    # note: if an id occurs multiple times in omsids, the first occurrence is used
+    indices = np.full(len(ids), -1)
+    found = np.zeros(len(ids), dtype=bool)
+    if len(omsids)>0:
+        omsids_sorted_inds = np.argsort(omsids, kind='stable')
+        omsids_sorted = omsids[omsids_sorted_inds]
+        positions = np.searchsorted(omsids_sorted, ids, side='left')
+        positions = np.minimum(positions, len(omsids_sorted)-1)
+        found = (omsids_sorted[positions] == ids)
+        indices[found] = omsids_sorted_inds[positions[found]]
     # check if all ids are in omsids
     # note: reduce from error to warning,
     # since it seems some lumisections are intrinsically missing in OMS,
     # e.g. run 380147, LS 186.
-    threshold = None
-    if np.any(np.isin(ids, omsids, invert=True)):
-        missing_ids_inds = np.isin(ids, omsids, invert=True).nonzero()[0]
-        missing_ids = ids[missing_ids_inds]
-        if verbose:
-            msg = 'WARNING: not all provided lumisections could be found in the oms data.'
-            msg += f' Missing lumisections are: {missing_ids}'
-            msg += f' ({len(missing_ids)} / {len(ids)})'
-            print(msg)
-        # temporarily add the missing ids to omsids
-        # (corresponding indices will be set to -1 later)
-        threshold = len(omsids)
-        omsids = np.concatenate((omsids, missing_ids))
-    # find indices of ids in omsids
-    omsids_sorted_inds = np.argsort(omsids)
-    omsids_sorted = omsids[omsids_sorted_inds]
-    indices = np.searchsorted(omsids_sorted, ids, side='left')
-    indices = omsids_sorted_inds[indices]
-    if threshold is not None: indices = np.where(indices>=threshold, -1, indices)
+    # (corresponding indices are set to -1)
+    if verbose and not np.all(found):
+        missing_ids = ids[~found]
+        msg = 'WARNING: not all provided lumisections could be found in the oms data.'
+        msg += f' Missing lumisections are: {missing_ids}'
+        msg += f' ({len(missing_ids)} / {len(ids)})'
+        print(msg)
     return indices
 
+class OMSJoinIndex(object):
+    '''
+    Mapping from (run, lumisection) pairs to rows of an OMS dict, computed once
+    and reused to retrieve any number of OMS attributes with vectorized indexing.
+    '''
+
+    def __init__(self, runs, lumis, omsjson, **kwargs):
+        '''
+        Initializer.
+        Input arguments:
+        - runs and lumis: 1D arrays of the same length, with run and lumisection numbers.
+        - omsjson: a dict with information from OMS (see find_oms_attr_for_lumisections).
+        - kwargs: passed down to find_oms_indices
+        '''
+        self.omsjson = omsjson
+        self.indices = find_oms_indices(runs, lumis, omsjson, **kwargs)
+        self.missing = (self.indices < 0)
+        self.any_missing = bool(np.any(self.missing))
+        # note: use a valid index for the missing lumisections,
+        #       the corresponding values are replaced by the default afterwards
+        self.safe_indices = np.where(self.missing, 0, self.indices)
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.indices)
+
+    def get(self, omsattr, default=0):
+        '''
+        Retrieve an OMS attribute for the lumisections of this index.
+        Input arguments:
+        - omsattr: the name of the attribute to retrieve.
+        - default: value used for lumisections that are missing in the OMS dict.
+        Returns:
+        - a 1D array with the values of the OMS attribute for the lumisections of this index.
+        '''
+        # check if attribute is present
+        if not omsattr in self.omsjson.keys():
+            msg = 'Attribute "{}" not found in provided omsjson.'.format(omsattr)
+            msg += ' Available keys are: {}'.format(self.omsjson.keys())
+            raise Exception(msg)
+        # convert the attribute to an array only once
+        if omsattr not in self.columns: self.columns[omsattr] = np.asarray(self.omsjson[omsattr])
+        column = self.columns[omsattr]
+        if len(column)==0: return np.full(len(self), default)
+        values = column[self.safe_indices]
+        if self.any_missing: values = np.where(self.missing, default, values)
+        return values
+
+    def get_many(self, omsattrs, default=0):
+        '''
+        Retrieve multiple OMS attributes at once.
+        Returns:
+        - a dict of the form {attribute name: 1D array of values, ...}
+        '''
+        return {omsattr: self.get(omsattr, default=default) for omsattr in omsattrs}
+
 def find_oms_attr_for_lumisections(runs, lumis, omsjson, omsattr, **kwargs):
     '''
     Retrieve an OMS attribute for given run and lumisection numbers.
@@ -72,16 +128,9 @@ def find_oms_attr_for_lumisections(runs, lumis, omsjson, omsattr, **kwargs):
     - kwargs: passed down to find_oms_indices
     Returns:
     - a 1D array of the same length as runs and lumis,
-      with the values of the OMS attribute for the requested lumisections.
+      with the values of the OMS attribute for the requested lumisections
+      (0 for lumisections that are missing in the omsjson).
+    Note: to retrieve multiple attributes for the same lumisections, use OMSJoinIndex instead,
+          which finds the indices only once.
     '''
-    # check if attribute is present
-    if not omsattr in omsjson.keys():
-        msg = 'Attribute "{}" not found in provided omsjson.'.format(omsattr)
-        msg += ' Available keys are: {}'.format(omsjson.keys())
-        raise Exception(msg)
-    # retrieve indices for provided lumisections
-    indices = find_oms_indices(runs, lumis, omsjson, **kwargs)
-    # make array of values corresponding to indices
-    # (assume index -1 is used as a default for lumisections that are missing in the omsjson)
-    values = np.array([(omsjson[omsattr][idx] if idx>-1 else 0) for idx in indices])
-    return values
+    return OMSJoinIndex(runs, lumis, omsjson, **kwargs).get(omsattr)
@@ -9,6 +9,10 @@
 
 # import external modules
 import sys
+import copy
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 # import local modules
@@ -17,21 +21,62 @@ import functions as functions
 import bad_ROC as bad_ROC
 from nmf2d import NMF2D
 from preprocessor import PreProcessor
+from cache import LumisectionCache
+
+# default filters on OMS attributes (see dftools.FilterExpression)
+OMS_FILTERS = [
+  ["beams_stable"],
+  ["cms_active"],
+  ["bpix_ready"],
+  ["fpix_ready"],
+  ["tibtid_ready"],
+  ["tob_ready"],
+  ["tecp_ready"],
+  ["tecm_ready"],
+  #["pileup", '>', 25],
+  #["hlt_zerobias_rate", '>', 5]
+]
 
 class PixelRing2NMF(object):
     # implementation of NMF model (including all pre- and post-processing steps)
-    # for the pixel cluster occupancy Ring 2 monitoring element.
+    # for the pixel cluster occupancy Ring 2 monitoring element,
+    # or more generally for one or more pixel ring monitoring elements (e.g. Ring 1 and Ring 2),
+    # with one NMF model per monitoring element and combined flags.
     
     def __init__(self,
                  nmfs,
                  thresholds = None,
+                 chunk_size = None,
+                 fused = False,
+                 precision = 'float64',
+                 oms_filters = None,
+                 n_threads = 1,
                  ):
         '''
         Initializer.
         Input arguments:
         - nmfs: dictionary of the following form: {monitoring element name: NMF model, ...}
+          note: the monitoring element names must contain the ring number, e.g. 'Ring1' and 'Ring2'.
+        - thresholds: dictionary with the thresholds for bad_ROC.search_for_anomalies,
+          either common for all monitoring elements, or of the form {monitoring element name: thresholds, ...}.
         - local_norms: dictionary of the following form: {monitoring element name: local norm (2D np array), ...}
         - loss_masks: dictionary of the following form: {monitoring element name: loss mask (2D np array), ...}
+        - chunk_size: if specified, process the lumisections in blocks of this size in predict
+          (peak memory is then bounded by the chunk size rather than by the number of lumisections).
+        - fused: if True, keep the data on the cropped grid (without the empty cross) from preprocessing to flagging
+          (see run_chain_fused), instead of removing and re-inserting the cross.
+        - precision: floating point precision of inference, loss calculation and flagging,
+          either 'float64' (default) or 'float32' (half the memory footprint and bandwidth).
+        - oms_filters: list of filter expressions on OMS attributes (see dftools.FilterExpression);
+          lumisections that do not pass them are not processed at all (see predict).
+          default: OMS_FILTERS.
+        - n_threads: number of threads to process the monitoring elements in parallel
+          (default: 1, i.e. sequentially; None for one thread per monitoring element).
+          note: no speedup of the threaded mode has been measured yet (see benchmark.py multi),
+                so the monitoring elements are processed sequentially by default.
+        Note: predict processes only subsets of the lumisections (after filtering, in chunks, or when not cached),
+              which gives the same flags only if the NMF inference is independent of the other lumisections
+              in a batch (see is_batch_independent); a warning is printed for models for which this is not the case.
         '''
         
         # get monitoring element names for later use
@@ -63,6 +108,160 @@ class PixelRing2NMF(object):
         self.thresholds = thresholds
         if self.thresholds is None:
             self.thresholds = {"loss_threshold": 1e5, "ROC_fraction": 40}
+
+        # execution settings
+        self.chunk_size = chunk_size
+        self.fused = fused
+        self.n_threads = n_threads
+        self.set_precision(precision)
+
+        # filter pipeline
+        if oms_filters is None: oms_filters = OMS_FILTERS
+        self.set_oms_filters(oms_filters)
+
+        # cache of per-lumisection results (disabled by default, see enable_cache)
+        self.cache = None
+
+        # state of the runs processed incrementally (see update)
+        self.max_runs = 10
+        self.run_states = OrderedDict()
+
+        self.warn_batch_dependence('PixelRing2NMF.__init__')
+
+    def __setstate__(self, state):
+        '''
+        Restore a pickled model, setting defaults for attributes
+        that did not exist yet when the model was saved.
+        '''
+        defaults = {'chunk_size': None, 'fused': False, 'precision': 'float64', 'oms_filters': OMS_FILTERS,
+                    'cache': None, 'max_runs': 10, 'run_states': None, 'n_threads': 1}
+        self.__dict__.update(defaults)
+        self.__dict__.update(state)
+        self.run_states = OrderedDict()
+        self.set_oms_filters(self.oms_filters)
+        self.warn_batch_dependence('PixelRing2NMF.__setstate__')
+
+    def __getstate__(self):
+        '''
+        Pickle the model, keeping only the declarative form of the filters
+        and leaving out the cache and the state of incrementally processed runs.
+        '''
+        state = self.__dict__.copy()
+        state.pop('compiled_oms_filters', None)
+        state['cache'] = None
+        state['run_states'] = None
+        return state
+
+    def enable_cache(self, max_entries=100000):
+        '''
+        Enable the cache of per-lumisection results (see cache.LumisectionCache).
+        Lumisections with the same content (for the same model, settings and thresholds)
+        as a previously processed lumisection are then not processed again.
+        Input arguments:
+        - max_entries: maximum number of lumisections in the cache.
+        '''
+        self.cache = LumisectionCache(max_entries=max_entries)
+
+    def disable_cache(self):
+        self.cache = None
+
+    def get_cache_salt(self, X_input):
+        '''
+        Return a hash of everything the per-lumisection results depend on, besides the lumisection content:
+        the NMF components and solver settings, the precision, the thresholds, and the input data types and shapes.
+        '''
+        h = hashlib.blake2b(digest_size=16)
+        for mename in self.menames:
+            nmf = self.nmfs[mename]
+            h.update(mename.encode())
+            h.update(np.ascontiguousarray(nmf.get_inference_params()[0]).data)
+            h.update(repr((nmf.solver, nmf.solver_max_iter, nmf.warm_start)).encode())
+            h.update(repr((X_input[mename].dtype.str, X_input[mename].shape[1:])).encode())
+        h.update(repr((self.precision, sorted(self.thresholds.items()))).encode())
+        return h.digest()
+
+    def set_oms_filters(self, oms_filters):
+        '''
+        Set the filters on OMS attributes.
+        Input arguments:
+        - oms_filters: list of filter expressions (see dftools.FilterExpression),
+          stored in this (serializable) form and compiled once here.
+        '''
+        oms_filters = [f.spec if isinstance(f, dftools.FilterExpression) else f for f in oms_filters]
+        self.compiled_oms_filters = dftools.compile_filters(oms_filters)
+        self.oms_filters = copy.deepcopy(oms_filters)
+
+    def set_precision(self, precision):
+        '''
+        Set the floating point precision ('float64' or 'float32').
+        '''
+        if precision not in ['float64', 'float32']:
+            raise Exception(f'Precision {precision} not recognized.')
+        self.precision = precision
+
+    def set_solver(self, solver, **kwargs):
+        '''
+        Set the solver used for NMF inference for all monitoring elements.
+        Input arguments:
+        - solver and kwargs: see NMF2D.set_solver.
+        '''
+        for mename in self.menames:
+            self.nmfs[mename].set_solver(solver, **kwargs)
+
+    def get_batch_dependent_menames(self):
+        '''
+        Return the names of the monitoring elements for which the NMF inference of a lumisection
+        depends on the other lumisections in the batch (see NMF2D.is_batch_independent).
+        '''
+        return [mename for mename in self.menames
+                if isinstance(self.nmfs[mename], NMF2D) and not self.nmfs[mename].is_batch_independent()]
+
+    def is_batch_independent(self):
+        '''
+        Whether the NMF inference of each lumisection is independent of the other lumisections in the batch,
+        for all monitoring elements. This is needed for the flags and scores to be the same whether the lumisections
+        are processed all at once, after filtering, in chunks (see iter_chunks), or partly from the cache.
+        Note: for models for which this is not the case, predict processes all lumisections at once
+              and applies the filters afterwards, while chunking, caching and update are refused
+              (see check_batch_independence).
+        '''
+        return len(self.get_batch_dependent_menames()) == 0
+
+    def check_batch_independence(self, operation):
+        '''
+        Raise an exception if the NMF inference is not independent of the other lumisections in the batch
+        (see is_batch_independent), for operations that process subsets of the lumisections.
+        Input arguments:
+        - operation: description of the operation, for the error message.
+        '''
+        menames = self.get_batch_dependent_menames()
+        if len(menames) == 0: return
+        msg = f'{operation} is not available for the NMF models for {menames},'
+        msg += ' since their result for a lumisection depends on the other lumisections in the batch'
+        msg += ' (see NMF2D.is_batch_independent); switch to the nnls solver with set_solver,'
+        msg += ' or use a model with tol = 0 (and without L1 regularization).'
+        raise Exception(msg)
+
+    def warn_batch_dependence(self, caller):
+        '''
+        Print a warning if the NMF inference is not independent of the other lumisections in the batch
+        (see is_batch_independent).
+        '''
+        menames = self.get_batch_dependent_menames()
+        if len(menames) == 0: return
+        msg = f'WARNING in {caller}: the NMF models for {menames} give a result for a lumisection'
+        msg += ' that depends on the other lumisections in the batch (see NMF2D.is_batch_independent),'
+        msg += ' so predict processes all lumisections at once, and chunking, caching and update are not available;'
+        msg += ' switch to the nnls solver with set_solver to avoid this.'
+        print(msg)
+
+    def prepare_inference(self):
+        '''
+        Precompute the factors needed for NMF inference (see NMF2D.prepare_inference),
+        so that this is not done on the first request.
+        '''
+        for mename in self.menames:
+            if self.nmfs[mename].solver != 'sklearn': self.nmfs[mename].prepare_inference(dtype=self.precision)
     
     def preprocess(self, X, verbose=False):
         '''
@@ -72,7 +271,7 @@ class PixelRing2NMF(object):
         '''
         mes_preprocessed = {}
         if verbose: print('[INFO]: preprocessing...')
-        for mename in self.menames:
+        for mename in self.get_menames(X):
             mes_preprocessed[mename] = self.preprocessors[mename].preprocess_mes(X[mename], None, None)
             
         return mes_preprocessed
@@ -80,7 +279,7 @@ class PixelRing2NMF(object):
     def deprocess(self, X, verbose=False):
         mes_deprocessed = {}
         if verbose: print('[INFO]: deprocessing...')
-        for mename in self.menames:
+        for mename in self.get_menames(X):
             mes_deprocessed[mename] = self.preprocessors[mename].deprocess(X[mename], None, None)
 
         return mes_deprocessed
@@ -94,9 +293,9 @@ class PixelRing2NMF(object):
         '''
         if verbose: print('[INFO]: running inference...')
         mes_reco = {}
-        for mename in self.menames:
-            X_input = np.copy(X[mename])
-            X_input = np.nan_to_num(X_input, nan=0)
+        for mename in self.get_menames(X):
+            X_input = np.array(X[mename], dtype=self.precision)
+            np.nan_to_num(X_input, copy=False, nan=0)
             mes_reco[mename] = self.nmfs[mename].predict(X_input)
         return mes_reco      
     
@@ -109,25 +308,97 @@ class PixelRing2NMF(object):
         '''
         losses = {}
         if verbose: print('[INFO]: calculating losses...')
-        for mename in self.menames:
-            losses[mename] = np.square(X_input[mename] - X_reco[mename])
+        for mename in self.get_menames(X_input):
+            losses[mename] = np.square(np.subtract(X_input[mename], X_reco[mename], dtype=self.precision))
         return losses
         
-    def flag(self, X_loss, verbose=False):
+    def get_menames(self, X):
+        '''
+        Return the names of the monitoring elements of this model that are present in X.
+        '''
+        return [mename for mename in self.menames if mename in X]
+
+    def get_thresholds(self, mename):
+        '''
+        Return the thresholds for a given monitoring element.
+        '''
+        if mename in self.thresholds: return self.thresholds[mename]
+        return self.thresholds
+
+    def map_menames(self, func, menames):
+        '''
+        Apply a function to each monitoring element name,
+        in parallel threads if n_threads is larger than 1 (or None) and there is more than one monitoring element
+        (note: the heavy lifting is done in numpy, which releases the GIL).
+        Returns:
+        - list of results in the same order as menames.
+        '''
+        n_threads = len(menames) if self.n_threads is None else min(self.n_threads, len(menames))
+        if n_threads <= 1: return [func(mename) for mename in menames]
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            return list(pool.map(func, menames))
+
+    def combine_flags(self, results, return_scores=False):
+        '''
+        Combine the flags of multiple monitoring elements.
+        Input arguments:
+        - results: dict of the form {monitoring element name: output of bad_ROC.search_for_anomalies, ...}
+        Returns:
+        - flags (1D np array), True if any of the monitoring elements is flagged
+        - if return_scores is True: tuple of the above and a dict of scores with the following keys:
+          - the keys of bad_ROC.get_anomaly_scores, combined over monitoring elements
+            (maximum for 'score' and 'max_bad_fraction', sum for 'multi_disk_groups').
+          - per monitoring element breakdown: '<monitoring element name>_flag' and '<monitoring element name>_score'.
+        '''
+        if not return_scores:
+            return np.any([result for result in results.values()], axis=0)
+        flags = np.any([result[0] for result in results.values()], axis=0)
+        scores = {
+          'score': np.max([result[1]['score'] for result in results.values()], axis=0),
+          'max_bad_fraction': np.max([result[1]['max_bad_fraction'] for result in results.values()], axis=0),
+          'multi_disk_groups': np.sum([result[1]['multi_disk_groups'] for result in results.values()], axis=0),
+        }
+        for mename, result in results.items():
+            scores[f'{mename}_flag'] = result[0]
+            scores[f'{mename}_score'] = result[1]['score']
+        return (flags, scores)
+
+    def get_empty_scores(self, nls):
+        '''
+        Return scores (see combine_flags) equal to 0 for a given number of lumisections.
+        '''
+        results = {mename: (np.zeros(nls, dtype=bool), bad_ROC.get_empty_anomaly_scores(nls)) for mename in self.menames}
+        return self.combine_flags(results, return_scores=True)[1]
+
+    def flag_me(self, mename, X_loss, cropped=False, return_scores=False):
+        '''
+        Do flagging for a single monitoring element (see flag).
+        '''
+        anticrop = None
+        if cropped: anticrop = self.preprocessors[mename].anticrop
+        return bad_ROC.search_for_anomalies(X_loss, self.get_thresholds(mename), anticrop=anticrop,
+                                            return_scores=return_scores, mename=mename)
+
+    def flag(self, X_loss, cropped=False, return_scores=False, verbose=False):
         '''
         Do final flagging of combined loss map.
         Input arguments:
-        - X_loss: combined loss (2D np array)
+        - X_loss: dictionary of the following form {monitoring element name: loss (3D np array), ...}
+        - cropped: whether the losses are on the cropped grid (without the empty cross)
+        - return_scores: also return the continuous anomaly scores (see bad_ROC.get_anomaly_scores),
+          computed in the same pass as the flags.
+        Returns:
+        - see combine_flags.
         '''
-        
-        flags = bad_ROC.search_for_anomalies(X_loss, self.thresholds)
-        return flags
+        results = {mename: self.flag_me(mename, X_loss, cropped=cropped, return_scores=return_scores)
+                   for mename in self.get_menames(X_loss)}
+        return self.combine_flags(results, return_scores=return_scores)
     
     def get_filter_mask(self, X_input, oms_data=None, verbose=False):
         '''
         Apply filters.
         Note: HLT rate filter not yet implemented.
-        Note: filters hard-coded in this function for now, maybe generalize later.
+        Note: filters defined in self.oms_filters (see set_oms_filters).
         Input arguments:
         - X_input: dictionary of the following form {monitoring element name: data (3D np array), ...} with input data.
         - oms_data: dictionary of the following form {OMS attribute name: data (1D np array), ...} with OMS info.
@@ -147,26 +418,15 @@ class PixelRing2NMF(object):
             run_numbers = oms_data['run_number']
             ls_numbers = oms_data['lumisection_number']
 
-        # define OMS filters
+        # get OMS filters (compiled in set_oms_filters)
         oms_filters = None
         if oms_data is not None:
-            oms_filters = [
-              ["beams_stable"],
-              ["cms_active"],
-              ["bpix_ready"],
-              ["fpix_ready"],
-              ["tibtid_ready"],
-              ["tob_ready"],
-              ["tecp_ready"],
-              ["tecm_ready"],
-              #["pileup", '>', 25],
-              #["hlt_zerobias_rate", '>', 5]
-            ]
+            oms_filters = self.compiled_oms_filters
             for oms_filter in oms_filters:
-                key = oms_filter[0]
-                if key not in oms_data.keys():
-                    msg = f'Provided OMS data does not contain the expected key {key}'
-                    raise Exception(msg)
+                for key in oms_filter.keys:
+                    if key not in oms_data.keys():
+                        msg = f'Provided OMS data does not contain the expected key {key}'
+                        raise Exception(msg)
 
         # apply the filter
         mask, _ = dftools.filter_lumisections(run_numbers, ls_numbers,
@@ -182,9 +442,103 @@ class PixelRing2NMF(object):
         # return mask
         return mask
         
-    def predict(self, X, verbose=False):
+    def run_chain(self, X_input, return_scores=False, fused=None, verbose=False):
+        '''
+        Run preprocessing, inference, loss calculation and flagging.
+        The monitoring elements are processed in parallel (see map_menames).
+        Input arguments:
+        - X_input: dictionary of the following form {monitoring element name: raw data (3D np array), ...}
+        - return_scores: also return the anomaly scores (see flag).
+        - fused: whether to use the fused chain (see run_chain_me; default: self.fused).
+        Returns:
+        - flags (1D np array, before filtering)
+        - if return_scores is True: tuple of the above and a dict of scores (1D np arrays, before filtering)
+        '''
+        if fused is None: fused = self.fused
+        menames = self.get_menames(X_input)
+        func = lambda mename: self.run_chain_me(mename, X_input, return_scores=return_scores, fused=fused, verbose=verbose)
+        results = self.map_menames(func, menames)
+        return self.combine_flags(dict(zip(menames, results)), return_scores=return_scores)
+
+    def run_chain_fused(self, X_input, return_scores=False, verbose=False):
+        '''
+        Fused version of run_chain, giving the same flags (see run_chain_me).
+        '''
+        return self.run_chain(X_input, return_scores=return_scores, fused=True, verbose=verbose)
+
+    def run_chain_me(self, mename, X_input, return_scores=False, fused=False, verbose=False):
+        '''
+        Run preprocessing, inference, loss calculation and flagging for a single monitoring element.
+        If fused is True, the data stay on the cropped grid (without the empty cross) end to end:
+        the cross is removed with a single copy (which also does the conversion to float),
+        the loss is computed in place in the reconstruction array,
+        and the flagging uses power groups translated to cropped coordinates.
+        Input arguments:
+        - mename: monitoring element name.
+        - X_input: dictionary of the following form {monitoring element name: raw data (3D np array), ...}
+        - return_scores: see run_chain.
+        - fused: whether to use the fused chain (giving the same flags).
+        Returns:
+        - output of bad_ROC.search_for_anomalies for this monitoring element.
+        '''
+        X_input = {mename: X_input[mename]}
+        if not fused:
+            mes_preprocessed = self.preprocess(X_input, verbose=verbose)
+            mes_reco = self.infer(mes_preprocessed, verbose=verbose)
+            losses = self.loss(mes_preprocessed, mes_reco, do_thresholding=True, verbose=verbose)
+            losses_with_cross = self.deprocess(losses, verbose=verbose)
+            return self.flag_me(mename, losses_with_cross, return_scores=return_scores)
+        if verbose: print(f'[INFO]: running fused preprocessing, inference and loss calculation for {mename}...')
+        X_crop = self.preprocessors[mename].crop(X_input[mename], dtype=self.precision)
+        # keep track of missing values, which give a NaN loss as in the non-fused chain
+        nanmask = None
+        if not np.issubdtype(X_input[mename].dtype, np.integer):
+            nanmask = np.isnan(X_crop)
+            np.nan_to_num(X_crop, copy=False, nan=0)
+        loss = self.nmfs[mename].predict(X_crop)
+        np.subtract(loss, X_crop, out=loss)
+        np.square(loss, out=loss)
+        if nanmask is not None: loss[nanmask] = np.nan
+        return self.flag_me(mename, {mename: loss}, cropped=True, return_scores=return_scores)
+
+    def iter_chunks(self, X_input, chunk_size, return_scores=False, indices=None, verbose=False):
+        '''
+        Run the full chain (see run_chain) in blocks of lumisections,
+        and yield the flags of each block as soon as it is processed.
+        Input arguments:
+        - X_input: dictionary of the following form {monitoring element name: raw data (3D np array), ...}
+        - chunk_size: number of lumisections per block.
+        - return_scores: see run_chain.
+        - indices: if specified, only process the lumisections with these indices (1D np array).
+        Yields:
+        - tuples of the form (slice or indices of lumisections, output of run_chain for these lumisections)
+        Note: the flags are the same as when processing all lumisections at once
+              only if the NMF inference is batch independent (see is_batch_independent).
+        '''
+        nls = len(X_input[self.menames[0]]) if indices is None else len(indices)
+        for start in range(0, nls, chunk_size):
+            lsslice = slice(start, min(start+chunk_size, nls))
+            if verbose: print(f'[INFO]: processing lumisections {lsslice.start} to {lsslice.stop} out of {nls}...')
+            if indices is not None: lsslice = indices[lsslice]
+            X_chunk = {mename: X_input[mename][lsslice] for mename in self.menames}
+            yield (lsslice, self.run_chain(X_chunk, return_scores=return_scores, verbose=verbose))
+
+    def predict(self, X, return_scores=False, verbose=False):
         '''
         Run full chain on incoming data X
+        Input arguments:
+        - X: dictionary of the following form {name: data (np array), ...} with the raw data per monitoring element
+             and (optionally) the OMS data used for filtering.
+        - return_scores: also return the continuous anomaly scores (see bad_ROC.get_anomaly_scores);
+          lumisections that do not pass the filter get a score of 0.
+        Note: the filters are applied first, and only the lumisections that pass them
+              are preprocessed, reconstructed and flagged; the others are not flagged.
+              If the NMF inference is not batch independent (see is_batch_independent),
+              all lumisections are processed together and the filters are applied afterwards,
+              and predict raises an exception if chunking or the cache is enabled.
+        Returns:
+        - flags (1D np array)
+        - if return_scores is True: tuple of the above and a dict of scores (1D np arrays)
         '''
         if verbose:
             print('[INFO]: Running PixelRing2NMF.predict on the following data:')
@@ -192,7 +546,7 @@ class PixelRing2NMF(object):
                 print(f'  - {key}: {val.shape}')
             
         # split ME and OMS data
-        menames = ['Ring2']
+        menames = self.menames
         X_input = {key: val for key, val in X.items() if key in menames}
         oms_input = {key: val for key, val in X.items() if key not in menames}
         oms_input = {key.split('__')[-1]: val for key, val in oms_input.items()}
@@ -202,33 +556,142 @@ class PixelRing2NMF(object):
         if len(oms_input.keys())==0:
             oms_input = None
 
-        # do preprocessing, inference, and loss calculation
-        mes_preprocessed = self.preprocess(X_input, verbose=verbose)
-        mes_reco = self.infer(mes_preprocessed, verbose=verbose)
-        losses = self.loss(mes_preprocessed, mes_reco, do_thresholding=True, verbose=verbose)
-        losses_with_cross = self.deprocess(losses, verbose=verbose)
-        flags = self.flag(losses_with_cross, verbose=verbose)
+        # check that subsets of the lumisections can be processed separately if requested
+        batch_independent = self.is_batch_independent()
+        if not batch_independent:
+            if self.chunk_size is not None: self.check_batch_independence('Chunked prediction (chunk_size)')
+            if self.cache is not None: self.check_batch_independence('Cached prediction (enable_cache)')
 
-        # printouts for testing and debugging
-        nflags = np.sum(flags.astype(int))
-        msg = '[INFO]: Flagging results (before filtering):'
-        msg += f' flagged {nflags} out of {len(flags)} lumisections.'
+        # apply filters
+        nls = len(X_input[menames[0]])
+        mask = self.get_filter_mask(X_input, oms_data=oms_input, verbose=verbose)
+        nselected = np.sum(mask.astype(int))
+        msg = f'[INFO]: Filtering: selected {nselected} out of {nls} lumisections.'
         print(msg)
 
-        # apply mask
-        mask = self.get_filter_mask(X_input, oms_data=oms_input, verbose=verbose)
-        flags[~mask] = False
+        # initializations
+        # note: if the cache is enabled, the scores are always computed, since they are cached as well
+        flags = np.zeros(nls, dtype=bool)
+        compute_scores = (return_scores or self.cache is not None)
+        scores = self.get_empty_scores(nls) if compute_scores else None
+        # note: if the NMF inference is not batch independent, all lumisections are processed
+        #       and the filters are applied afterwards
+        indices = None if (nselected==nls or not batch_independent) else np.nonzero(mask)[0]
+
+        # look up the selected lumisections in the cache (if enabled)
+        # and keep only the ones that are not found for further processing
+        cache_keys = None
+        if self.cache is not None and nselected > 0:
+            if indices is None: indices = np.arange(nls)
+            cache_keys = self.cache.hash_lumisections([X_input[mename] for mename in menames], indices,
+                                                      salt=self.get_cache_salt(X_input))
+            found, values = self.cache.lookup(cache_keys)
+            if len(values) > 0:
+                found_indices = indices[found]
+                flags[found_indices] = [value[0] for value in values]
+                for j, key in enumerate(scores.keys()):
+                    scores[key][found_indices] = [value[1][j] for value in values]
+            indices = indices[~found]
+            cache_keys = [cache_key for cache_key, isfound in zip(cache_keys, found) if not isfound]
+            msg = f'[INFO]: Cache: {np.sum(found)} hits, {len(indices)} misses'
+            msg += f' ({len(self.cache)} lumisections in cache).'
+            print(msg)
+
+        # do preprocessing, inference, loss calculation and flagging
+        # for the selected (and not cached) lumisections only
+        # (in blocks of lumisections if a chunk size is set)
+        nprocess = nselected if indices is None else len(indices)
+        if nprocess==0:
+            results = []
+        elif self.chunk_size is None:
+            lsindex = slice(None) if indices is None else indices
+            X_selected = {mename: X_input[mename][lsindex] for mename in menames}
+            results = [(lsindex, self.run_chain(X_selected, return_scores=compute_scores, verbose=verbose))]
+        else:
+            results = self.iter_chunks(X_input, self.chunk_size, return_scores=compute_scores,
+                                       indices=indices, verbose=verbose)
+        for lsindex, result in results:
+            if not compute_scores:
+                flags[lsindex] = result
+                continue
+            flags[lsindex] = result[0]
+            for key, val in result[1].items(): scores[key][lsindex] = val
+        if not batch_independent and nselected < nls:
+            flags[~mask] = False
+            if compute_scores:
+                empty_scores = self.get_empty_scores(nls)
+                for key in scores.keys(): scores[key][~mask] = empty_scores[key][~mask]
+
+        # store the new results in the cache
+        if cache_keys is not None and len(cache_keys) > 0:
+            values = [(flags[i], tuple(scores[key][i] for key in scores.keys())) for i in indices]
+            self.cache.store(cache_keys, values)
 
         # printouts for testing and debugging
-        nselected = np.sum(mask.astype(int))
-        msg = f'[INFO]: Filtering: selected {nselected} out of {len(flags)} lumisections.'
-        print(msg)
         nflags = np.sum(flags.astype(int))
         msg = '[INFO]: Flagging results (after filtering):'
-        msg += f' flagged {nflags} out of {len(mask)} lumisections.'
+        msg += f' flagged {nflags} out of {nls} lumisections.'
         print(msg)
         sys.stdout.flush()
         sys.stderr.flush()
         
         # return final result
+        if return_scores: return (flags, scores)
         return flags
+
+    def update(self, run, X, verbose=False):
+        '''
+        Incremental version of predict, for lumisections that arrive in blocks during a run.
+        Only the lumisections in the new block are processed, and the results are merged with those
+        of the previous blocks of the same run (this requires the NMF inference to be batch independent,
+        see is_batch_independent).
+        Input arguments:
+        - run: run number.
+        - X: new block of data, in the same format as for predict.
+          if X contains lumisection numbers (general__lumisection_number), they are used to merge the results
+          (lumisections that were already received are replaced); otherwise the block is appended.
+        Returns:
+        - a tuple with the following elements:
+          - 1D np array with the lumisection numbers received so far for this run (sorted)
+          - 1D np array with the corresponding flags
+        Note: the state of at most max_runs runs is kept; when a new run arrives,
+              the least recently updated run is removed (see also finish_run).
+        '''
+        self.check_batch_independence('Incremental prediction (update)')
+        flags, scores = self.predict(X, return_scores=True, verbose=verbose)
+        ls_numbers = None
+        for key, val in X.items():
+            if key.split('__')[-1]=='lumisection_number': ls_numbers = np.asarray(val).astype(int)
+
+        # get the state of this run, or make a new one
+        state = self.run_states.pop(run, None)
+        if state is None:
+            state = {'ls_numbers': np.zeros(0, dtype=int), 'flags': np.zeros(0, dtype=bool),
+                     'scores': {key: np.zeros(0, dtype=val.dtype) for key, val in scores.items()}}
+        if ls_numbers is None:
+            start = state['ls_numbers'][-1] + 1 if len(state['ls_numbers']) > 0 else 1
+            ls_numbers = np.arange(start, start+len(flags))
+
+        # merge the new results with the previous ones
+        # (the new results come first, so they are kept in case of duplicate lumisection numbers)
+        all_ls_numbers = np.concatenate((ls_numbers, state['ls_numbers']))
+        all_ls_numbers, indices = np.unique(all_ls_numbers, return_index=True)
+        state['ls_numbers'] = all_ls_numbers
+        state['flags'] = np.concatenate((flags, state['flags']))[indices]
+        for key in state['scores'].keys():
+            state['scores'][key] = np.concatenate((scores[key], state['scores'][key]))[indices]
+
+        # store the state as the most recently updated run, and remove the oldest runs if needed
+        self.run_states[run] = state
+        while len(self.run_states) > self.max_runs:
+            evicted_run, _ = self.run_states.popitem(last=False)
+            if verbose: print(f'[INFO]: removed state of run {evicted_run}.')
+        return (state['ls_numbers'], state['flags'])
+
+    def finish_run(self, run):
+        '''
+        Remove the state of a run that was processed incrementally (see update).
+        Returns:
+        - dict with the lumisection numbers, flags and scores of the run (None if the run is not known).
+        '''
+        return self.run_states.pop(run, None)
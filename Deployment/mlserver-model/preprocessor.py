@@ -4,6 +4,7 @@ import numpy as np
 # import local modules
 import dftools as dftools
 import omstools as omstools
+from functions import ANTICROPS, meNameToRing
 
 class PreProcessor(object):
     '''
@@ -14,8 +15,8 @@ class PreProcessor(object):
                  metype
                  ):
         
-        # set cropping values for Ring2
-        self.anticrop = (slice(68,72), slice(24,32))
+        # set cropping values for the ring of this monitoring element
+        self.anticrop = ANTICROPS[meNameToRing(metype)]
             
     def preprocess(self, df, **kwargs):
         '''
@@ -45,9 +46,31 @@ class PreProcessor(object):
         return mes
     
     
+    def crop(self, mes, dtype=None):
+        '''
+        Remove the empty cross (same result as preprocess_mes),
+        copying the four blocks around the cross directly into a new array.
+        Input arguments:
+        - mes: np array of shape (number of histograms, number of y-bins, number of x-bins)
+        - dtype: data type of the output array (default: same as input)
+        '''
+        if dtype is None: dtype = mes.dtype
+        if self.anticrop is None: return np.array(mes, dtype=dtype)
+        slicey = self.anticrop[0]
+        slicex = self.anticrop[1]
+        ny = slicey.stop - slicey.start
+        nx = slicex.stop - slicex.start
+        out = np.empty((mes.shape[0], mes.shape[1]-ny, mes.shape[2]-nx), dtype=dtype)
+        for outy, iny in [(slice(None, slicey.start), slice(None, slicey.start)),
+                          (slice(slicey.start, None), slice(slicey.stop, None))]:
+            for outx, inx in [(slice(None, slicex.start), slice(None, slicex.start)),
+                              (slice(slicex.start, None), slice(slicex.stop, None))]:
+                out[:, outy, outx] = mes[:, iny, inx]
+        return out
+    
     def deprocess(self, mes, runs=None, lumis=None):
         '''
-        Inverse operation of preprocess, specific for Ring 2 (*4)
+        Inverse operation of preprocess, for Ring 1 and Ring 2 (the cross is in the middle of the cropped array)
         '''
         # insert empty cross
         if self.anticrop is not None:
@@ -5,6 +5,7 @@
 
 import os
 import sys
+import base64
 import pickle
 import argparse
 from typing import Optional
@@ -113,7 +114,13 @@ def get_oms_data(run_numbers, ls_numbers):
     # return result
     return filtered_df
 
-def inference_over_http(data: dict, model_name: str, port=None, oms_data=None):
+def encode_data(arr, binary=False):
+    '''Encode an array for the request body (flattened list, or base64-encoded binary data)'''
+    if binary:
+        return base64.b64encode(np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder('<')).tobytes()).decode()
+    return arr.flatten().tolist()
+
+def inference_over_http(data: dict, model_name: str, port=None, oms_data=None, binary=False):
     '''Make inference request over local network'''
     
     print('Formatting request...')
@@ -135,7 +142,7 @@ def inference_over_http(data: dict, model_name: str, port=None, oms_data=None):
         #       but that doesn't work in production.
         #       see more info here:
         #       https://gitlab.cern.ch/cms-ppd/technical-support/web-services/dials-service/-/issues/136#note_10063426
-        this_input['data'] = arr.flatten().tolist()
+        this_input['data'] = encode_data(arr.astype(np.int32), binary=binary)
         inputs.append(this_input)
 
     # extend inputs with OMS data
@@ -146,11 +153,11 @@ def inference_over_http(data: dict, model_name: str, port=None, oms_data=None):
             this_input['name'] = 'dcs_bits__'+name
             this_input['shape'] = arr.shape
             this_input['datatype'] = "BOOL"
-            this_input['data'] = arr.flatten().tolist()
             # special cases
             if name=='run_number' or name=='lumisection_number':
                 this_input['name'] = 'general__'+name
                 this_input['datatype'] = 'INT32'
+            this_input['data'] = encode_data(arr.astype(bool if this_input['datatype']=='BOOL' else np.int32), binary=binary)
             # add to list
             inputs.append(this_input)
 
@@ -171,6 +178,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process run number, optional URL, and optional headers.")
     parser.add_argument("-p", "--port", type=str, help="Web server port.")
     parser.add_argument("-n", "--model-name", type=str, help="Model name.")
+    parser.add_argument("-b", "--binary", action="store_true", help="Send the data as base64-encoded binary data instead of lists.")
     args = parser.parse_args()
     
     if not args.port:
@@ -200,7 +208,7 @@ if __name__ == "__main__":
     oms_data = {name: np.array(oms_data[name].values) for name in oms_data.columns}
 
     # do the inference
-    predictions = inference_over_http(data, args.model_name, args.port, oms_data=oms_data)
+    predictions = inference_over_http(data, args.model_name, args.port, oms_data=oms_data, binary=args.binary)
 
     # parse the output predictions
     outputs = predictions["outputs"]
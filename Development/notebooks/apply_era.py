@@ -0,0 +1,250 @@
+# Apply a model to a whole era, in parallel over the runs
+# (the command line version of sections 2 to 7 of Apply_model_to_era.ipynb).
+
+# usage example:
+#   python apply_era.py --ring 2 \
+#     --file ../data/ZeroBias-Run2024I-PromptReco-v2-DQMIO-...-PXRing_2.parquet \
+#     --oms-json ../omsdata/omsdata_Run2024I-v2.json \
+#     --model ../models/model_7_PXRing_2_period_3_type_1.pkl \
+#     --loss-threshold 1e5 -o ../results/Anomalies_PXRing_2_2024I_v2_period_2.xlsx \
+#     --checkpoint-dir ../results/output_2024I_v2_period_2_PXRing_2 -j 4
+
+# The runs are split into groups of consecutive runs with about the same number of lumisections (one group
+# per process by default), and the groups are distributed over a pool of processes. Each process streams the
+# file once for its group of runs, in blocks of lumisections (see iter_era_batches in functions.py), predicts,
+# and searches for anomalous powergroups with the vectorized versions of the notebook loops
+# (see find_anomalous_powergroups and identify_anomaly_types), so the whole era (and its predictions)
+# is never in memory at once. The results are then split per run.
+# The detailed anomalies of each run are stored in the checkpoint directory (if specified) when its group is done,
+# so that an interrupted job can be restarted and only processes the remaining runs.
+# At the end, the detailed anomalies of all runs are condensed into the same table as in the notebook
+# (saved as .xlsx, or .csv depending on the extension of the output file).
+
+import os
+import json
+import time
+import pickle
+import argparse
+import joblib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pyarrow.parquet import ParquetDataset
+
+from functions import (iter_era_batches, load_DCS_flags, remove_cross, add_cross,
+                       find_anomalous_powergroups, identify_anomaly_types, ANOMALY_HEADERS,
+                       condense_lumisection_runs, condense_powergroup_overlap)
+
+# processing stages for which the time is measured
+STAGES = ['read', 'predict', 'flag']
+
+# model and settings of the worker processes (set by init_worker)
+worker = {}
+
+
+def get_runs(file, extra_filters=None):
+    #All runs in the file that pass the extra filters, and their number of lumisections before the DCS flags
+    #(only the run number column is read)
+    filters = extra_filters if extra_filters is not None and len(extra_filters) > 0 else None
+    table = ParquetDataset(file, filters=filters).read(columns=['run_number'])
+    return np.unique(table.column('run_number').to_numpy(), return_counts=True)
+
+def partition_runs(runs, num_ls, ngroups):
+    #Split the runs (in order) into at most ngroups groups of consecutive runs with about the same number of
+    #lumisections, so that each group is read in a single pass over the file
+    #(which only touches the row groups of these runs if the file is sorted by run number)
+    ngroups = max(1, min(ngroups, len(runs)))
+    before = np.cumsum(num_ls) - num_ls
+    group = np.minimum((before * ngroups) // max(np.sum(num_ls), 1), ngroups - 1)
+    return [runs[group == index] for index in np.unique(group)]
+
+def get_checkpoint_path(checkpoint_dir, run_number):
+    return os.path.join(checkpoint_dir, f'run_{run_number}.pkl')
+
+def check_checkpoint_config(checkpoint_dir, config):
+    #Make sure that existing checkpoints were made with the same settings
+    configfile = os.path.join(checkpoint_dir, 'config.json')
+    if os.path.exists(configfile):
+        with open(configfile, 'r') as f:
+            existing = json.load(f)
+        if existing != config:
+            msg = f'Checkpoint directory {checkpoint_dir} contains results for different settings:\n{existing}\n'
+            msg += 'Please use another checkpoint directory (or remove it).'
+            raise Exception(msg)
+    else:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        with open(configfile, 'w') as f:
+            json.dump(config, f, indent=2)
+
+def init_worker(config, dcs_flags):
+    #Load the model once per process, and use one thread per process for the linear algebra
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError: pass
+    worker['nmf'] = joblib.load(config['model'])
+    worker['config'] = config
+    worker['dcs_flags'] = dcs_flags
+
+def process_runs(run_numbers, checkpoint_dir=None):
+    #Search for anomalies in a group of runs (run in a separate process),
+    #with a single pass over the file for all runs of the group
+    config = worker['config']
+    times = dict.fromkeys(STAGES, 0.)
+    nls = dict.fromkeys(run_numbers, 0)
+    runs, lumisections, anomalous = [], [], []
+    run_filter = [int(run_number) for run_number in run_numbers]
+    filters = [tuple(f) for f in config['extra_filters']] + [('run_number', '>=', min(run_filter)),
+               ('run_number', '<=', max(run_filter)), ('run_number', 'in', run_filter)]
+    batches = iter_era_batches(config['file'], worker['dcs_flags'], extra_filters=filters,
+                               batch_size=config['batch_size'], verbose=False)
+    start = time.perf_counter()
+    for data, batch_runs, lumis in batches:
+        times['read'] += time.perf_counter() - start
+        for run_number, count in zip(*np.unique(batch_runs, return_counts=True)):
+            nls[run_number] += int(count)
+        start = time.perf_counter()
+        data_no_cross = remove_cross(data, config['ring'])
+        pred = worker['nmf'].predict(data_no_cross)
+        times['predict'] += time.perf_counter() - start
+        start = time.perf_counter()
+        #Calculate the losses and binary losses, and search for anomalous powergroups
+        losses_binary = (np.square(data_no_cross - pred) > config['loss_threshold']).astype(int)
+        batch_anomalous = find_anomalous_powergroups(add_cross(losses_binary), config['ring'],
+                                                     anomaly_cutoff=config['anomaly_cutoff'])
+        #Only keep the anomalous lumisections
+        is_anomalous = np.any(batch_anomalous, axis=1)
+        runs.append(batch_runs[is_anomalous])
+        lumisections.append(lumis[is_anomalous])
+        anomalous.append(batch_anomalous[is_anomalous])
+        times['flag'] += time.perf_counter() - start
+        start = time.perf_counter()
+    times['read'] += time.perf_counter() - start
+    #Split the anomalous lumisections per run
+    start = time.perf_counter()
+    results = []
+    if len(runs) > 0:
+        runs, lumisections, anomalous = np.concatenate(runs), np.concatenate(lumisections), np.concatenate(anomalous)
+    for run_number in run_numbers:
+        if nls[run_number] > 0:
+            in_run = (runs == run_number)
+            anomalies = identify_anomaly_types(run_number, lumisections[in_run], anomalous[in_run], config['ring'])
+        else: anomalies = pd.DataFrame(columns=ANOMALY_HEADERS, dtype=object)
+        results.append({'run_number': run_number, 'num_ls': nls[run_number], 'anomalies': anomalies})
+    times['flag'] += time.perf_counter() - start
+    #Write the checkpoints (atomically, so that an interrupted job never leaves a partial file)
+    if checkpoint_dir is not None:
+        for result in results:
+            path = get_checkpoint_path(checkpoint_dir, result['run_number'])
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(result, f)
+            os.replace(path + '.tmp', path)
+    return results, times
+
+def make_anomaly_table(all_detailed_anomaly_df):
+    #Condense the detailed anomalies and rename the columns, as in section 7 of Apply_model_to_era.ipynb
+    columns = {
+        "Run_Number": "Run",
+        "Start_LS": "First LS",
+        "End_LS": "Last LS",
+        "Num_LS": "Total LS",
+        "Powergroup": "Barrel/Forward",
+        "Disk": "Layer/Disk",
+        "Ring_Num": "Row/Quarter",
+        "Anomaly_Type": "Type",
+    }
+    if len(all_detailed_anomaly_df) == 0: return pd.DataFrame(columns=list(columns.values()))
+    condensed_df = condense_lumisection_runs(all_detailed_anomaly_df)
+    condensed_df_again = condense_powergroup_overlap(condensed_df)
+    renamed_df = condensed_df_again.rename(columns=columns)
+    renamed_df["Barrel/Forward"] = "Forward"
+    renamed_df["Layer/Disk"] = renamed_df["Layer/Disk"].apply(lambda x: f"Disk {x}")
+    renamed_df["Row/Quarter"] = renamed_df["Row/Quarter"].apply(lambda x: f"Ring {x}")
+    return renamed_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply a model to a whole era, in parallel over the runs.")
+    parser.add_argument("--ring", type=int, required=True, choices=[1, 2], help="Ring number.")
+    parser.add_argument("--file", required=True, help="Input .parquet file of the era.")
+    parser.add_argument("--oms-json", default=None, help="OMS json file with the DCS flags (default: no DCS flags).")
+    parser.add_argument("--model", required=True, help="Model file (.pkl).")
+    parser.add_argument("--loss-threshold", type=float, required=True, help="Threshold on the loss of a bin (e.g. 1e5 for Ring 2).")
+    parser.add_argument("--anomaly-cutoff", type=float, default=40, help="Percentage of bad bins for an anomalous powergroup (default: 40).")
+    parser.add_argument("--extra-filters", default=None, help="Extra filters in json format, e.g. '[[\"run_number\", \">=\", 378985]]'.")
+    parser.add_argument("-o", "--output", required=True, help="Output file for the anomaly table (.xlsx or .csv).")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of parallel processes (default: number of CPUs).")
+    parser.add_argument("--groups", type=int, default=None, help="Number of groups of runs, each read in a single pass over the file (default: one per process; more groups give finer checkpoints and load balancing).")
+    parser.add_argument("--checkpoint-dir", default=None, help="Directory for the per-run results, to resume an interrupted job (default: no checkpoints).")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of lumisections per block (default: 1000).")
+    args = parser.parse_args()
+
+    config = {
+        'ring': args.ring,
+        'file': args.file,
+        'oms_json': args.oms_json,
+        'model': args.model,
+        'loss_threshold': args.loss_threshold,
+        'anomaly_cutoff': args.anomaly_cutoff,
+        'extra_filters': json.loads(args.extra_filters) if args.extra_filters is not None else [],
+        'batch_size': args.batch_size,
+    }
+    runs, runs_num_ls = get_runs(args.file, [tuple(f) for f in config['extra_filters']])
+    if len(runs) == 0: raise Exception(f'No runs found in {args.file} that pass the extra filters.')
+    print(f'Found {len(runs)} runs in {args.file}')
+
+    # skip the runs that were already processed
+    results = {}
+    if args.checkpoint_dir is not None:
+        check_checkpoint_config(args.checkpoint_dir, {key: val for key, val in config.items() if key != 'batch_size'})
+        for run_number in runs:
+            path = get_checkpoint_path(args.checkpoint_dir, run_number)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    results[run_number] = pickle.load(f)
+        if len(results) > 0: print(f'Loaded {len(results)} runs from checkpoints in {args.checkpoint_dir}')
+    is_todo = np.array([run_number not in results for run_number in runs], dtype=bool)
+    todo = runs[is_todo]
+
+    # process the remaining runs in parallel, in groups of consecutive runs
+    # (the DCS flags are read once and passed on to the processes)
+    jobs = args.jobs if args.jobs is not None else (os.cpu_count() or 1)
+    groups = partition_runs(todo, runs_num_ls[is_todo], args.groups if args.groups is not None else jobs)
+    dcs_flags = load_DCS_flags(args.oms_json) if args.oms_json is not None else None
+    start = time.perf_counter()
+    nls_done = 0
+    times = dict.fromkeys(STAGES, 0.)
+    if len(todo) > 0:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(config, dcs_flags)) as pool:
+            futures = [pool.submit(process_runs, group, args.checkpoint_dir) for group in groups]
+            for future in as_completed(futures):
+                group_results, group_times = future.result()
+                for result in group_results:
+                    results[result['run_number']] = result
+                    nls_done += result['num_ls']
+                for stage in STAGES: times[stage] += group_times[stage]
+                elapsed = time.perf_counter() - start
+                done = ', '.join(str(result['run_number']) for result in group_results)
+                print(f'Done runs {done} ({len(results)}/{len(runs)} runs, {nls_done} lumisections in {elapsed:.1f} s,'
+                      + f' {nls_done/elapsed:.1f} LS/s)')
+    walltime = time.perf_counter() - start
+
+    # throughput per stage (summed over the processes, so per process)
+    if nls_done > 0:
+        print(f'Processed {nls_done} lumisections in {walltime:.1f} s ({nls_done/walltime:.1f} LS/s)')
+        for stage in STAGES:
+            print(f'  - {stage}: {times[stage]:.1f} s ({nls_done/max(times[stage], 1e-9):.1f} LS/s per process)')
+
+    # merge the detailed anomalies of all runs (in order of run number)
+    all_detailed_anomaly_df = pd.concat([results[run_number]['anomalies'] for run_number in runs])
+    num_ls = sum(result['num_ls'] for result in results.values())
+    num_anomalous_lumisections = sum(result['anomalies']['Lumisection'].nunique() for result in results.values())
+    print(f'Era {args.file} (Run {runs[0]} to Run {runs[-1]}): {num_ls} lumisections that pass all DCS flags')
+    print(f'{num_anomalous_lumisections} Anomalous Lumisections')
+
+    # condense and save the anomaly table
+    renamed_df = make_anomaly_table(all_detailed_anomaly_df)
+    if os.path.dirname(args.output) != '': os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    if args.output.endswith('.csv'): renamed_df.to_csv(args.output, index=False)
+    else: renamed_df.to_excel(args.output, index=False, engine='openpyxl')
+    print(f'Final Anomaly File Saved at {args.output}')
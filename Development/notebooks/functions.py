@@ -4,8 +4,12 @@ import json
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 # from pyarrow.parquet import ParquetFile
 from pyarrow.parquet import ParquetDataset
+import pyarrow.parquet as pq
 
 ################################################################################
 #######                            Constants                              ######
@@ -20,38 +24,68 @@ QUARTERS = np.array([['FPix_BmI_D3_ROG1','FPix_BmI_D3_ROG2','FPix_BmI_D3_ROG3','
 #######                        Data Extraction                            ######
 ################################################################################
 
+#Convert a (nested) list column of a pyarrow table into a numpy array
+#Pass in a pyarrow Array or ChunkedArray of type list<list<...>> (e.g. the 'data' column)
+#and return a numpy array of shape (number of rows, ybins, xbins)
+#The flat child buffer of the nested lists is reshaped directly using the list offsets,
+#instead of converting each row to a python object and calling np.stack per row.
+#This needs at most one copy (when the column consists of multiple chunks, or contains nulls).
+def list_column_to_numpy(column):
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks() if column.num_chunks != 1 else column.chunk(0)
+    shape = [len(column)]
+    while pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+        if column.null_count > 0:
+            raise Exception('Cannot convert a list column with missing values to a numpy array.')
+        #All lists at this level must have the same length, which becomes the next dimension
+        lengths = pc.list_value_length(column)
+        if len(column) == 0: length = 0
+        else:
+            minmax = pc.min_max(lengths)
+            if minmax['min'].as_py() != minmax['max'].as_py():
+                raise Exception('Cannot convert a list column with lists of different lengths to a numpy array.')
+            length = minmax['min'].as_py()
+        shape.append(length)
+        #Note: flatten takes the offsets into account, so this also works for sliced arrays
+        column = column.flatten()
+    return column.to_numpy(zero_copy_only=False).reshape(shape)
+
+#Read histograms from a .parquet data file directly into a numpy array
+#Only the requested columns are read (column projection), and the filters are passed on to
+#the parquet reader (predicate pushdown), in the form [('run_number', '=', 12345), ('ls_number', '>', 10)].
+#Returns the histograms as a numpy array of shape (number of lumisections, ybins, xbins),
+#and a pandas dataframe with the other requested columns (default: run and lumisection numbers)
+def read_parquet_histograms(file, columns=None, filters=None, datacolumn='data'):
+    if columns is None: columns = ['run_number', 'ls_number']
+    if filters is not None and len(filters) == 0: filters = None #ParquetDataset needs None, not []
+    columns = [column for column in columns if column != datacolumn]
+    table = ParquetDataset(file, filters=filters).read(columns=[datacolumn] + columns)
+    data = list_column_to_numpy(table.column(datacolumn))
+    df = table.drop_columns([datacolumn]).to_pandas()
+    return data, df
+
 #Return all of the available runs
 def extract_runs(file):
     #Take in a .parquet data file containing a pandas dataframe of runs/lumis
     #and return all of the available runs        
-    df = ParquetDataset(file).read().to_pandas()
+    #Only the run number column is read
+    df = ParquetDataset(file).read(columns=['run_number']).to_pandas()
     
     return df['run_number'].unique()
 
 def extract_data_2d(file, run_number, lumi_number):
     #Take in a .parquet data file containing a pandas dataframe of runs/lumis
     #and return the 2D array of data from that specific run/lumi number
-    #ALSO return the number of xbins and ybins
     
-    #Filters to pass into the pandas dataframe
+    #Filters to pass into the parquet reader
     filters = []
     filters.append( ('run_number', '=', run_number) )
     filters.append( ('ls_number', '=', lumi_number) )
     
-    df = ParquetDataset(file, filters=filters).read().to_pandas()
-    #For some reason the x/y bins are floats, not integers
-    xbins = int(df['x_bin'][0])
-    ybins = int(df['y_bin'][0])
-    
-    #Since we are only looking at ONE run_number, hists is just an array of length one
-    hists = np.array(df['data'])
-    runs = np.array(df['run_number'])
-    lumis = np.array(df['ls_number'])
-    
-    #Extract the data in the required way
-    data = np.stack(hists[0])
+    data, _ = read_parquet_histograms(file, filters=filters)
     
-    return data
+    #Since we are only looking at ONE lumisection, data is just an array of length one
+    return data[0]
 
 #Take in the oms_json file and the specific run number we want to check the DCS flags for
 def check_DCS_flags(oms_json, run_number):
@@ -85,49 +119,25 @@ def check_DCS_flags(oms_json, run_number):
     #Parquet filter can work less
     return bad_lumis
 
-#TODO: Research how the filters work and see 
-#how to exclude single lumisections and sequences of lumis
 def extract_data_2d_multi_lumis(file, run_number, lumi_start, lumi_end):
     #Take in a .parquet data file containing a pandas dataframe of runs/lumis
     #and return the 2D array of data from that specific run
     #from INCLUSIVE range lumi_start to lumi_end
     
-    #Filters to pass into the pandas dataframe
+    #Filters to pass into the parquet reader
     filters = []
     filters.append( ('run_number', '=', run_number) )
     filters.append( ('ls_number', '>=', lumi_start) )
     filters.append( ('ls_number', '<=', lumi_end))
     
-    df = ParquetDataset(file, filters=filters).read().to_pandas()
-    #print(df.head())
-    #For some reason the x/y bins are floats, not integers
-    xbins = int(df['x_bin'][0])
-    ybins = int(df['y_bin'][0])
-    
-    #Since we are only looking at ONE run_number, hists is just an array of length one
-    hists = np.array(df['data'])
-    runs = np.array(df['run_number'])
+    data, df = read_parquet_histograms(file, filters=filters)
+    #Note: lumisections w/o data are not saved into the parquet file (eg. 2024EraC Ring 1 Run 380043 LS 353-355),
+    #so the returned lumisections can have gaps
     lumis = np.array(df['ls_number'])
-    #print("EXTRACTED LUMISECTIONS: ", lumis)
-    
-    #Extract the data in the required way
-    #print(hists.shape)
-    data = np.stack(hists)
-    #print(data.shape)
-    #Sadly, stack, dstack, vstack, and hstack don't seem to work on the second (92 length) dimension. 
-    #Even with the axis parameter, I can't seem to find a way to stack the xbins object into
-    #a fully 3D array. So we have to follow Luka and loop over each lumisection. 
-    #Luckily this doesn't seem to add much time
-    #be careful to iterate over the length of the lumi array, not lumi_end-lumi_start+1, since we could be missing lumis. 
-    #Lumisections w/o data are not saved into the parquet file (eg. 2024EraC Ring 1 Run 380043 LS 353-355)
-    data2 = np.array([np.stack(data[i]) for i in range(len(lumis))])
-
-    #print("Returned Data Shape: ", data2.shape)
+
     #Return the data and an array of the lumisections found
-    return data2, lumis
+    return data, lumis
 
-#TODO: Research how the filters work and see 
-#how to exclude single lumisections and sequences of lumis
 #The way we exclude single runs and sequences of runs is by adding the optional extra_filters parameter
 #Pass in filters in an array in the form [('ls_number', '!=', 12345), ('ls_number', '>', 56789)]
 def extract_data_2d_all_lumis(file, run_number, oms_json=None, extra_filters=None):
@@ -135,7 +145,7 @@ def extract_data_2d_all_lumis(file, run_number, oms_json=None, extra_filters=Non
     #and return the 2D array of data from that specific run
     #with ALL lumisections
     
-    #Filters to pass into the pandas dataframe
+    #Filters to pass into the parquet reader
     filters = []
     filters.append( ('run_number', '=', run_number) )
     #Sometimes we need to add extra filters to exclude single runs or sequences of runs
@@ -146,44 +156,20 @@ def extract_data_2d_all_lumis(file, run_number, oms_json=None, extra_filters=Non
     #Filter for the lumisections which pass the DCS flags
     if oms_json != None:
         bad_lumis = check_DCS_flags(oms_json, run_number)
-        #bad lumis is just a python list. So sadly we have to add an individual filter for each bad lumisection
+        #A single 'not in' filter on the bad lumisections
         #This is why I chose check_DCS_flags() to return a list of BAD lumisections
-        for bad_ls in bad_lumis:
-            filters.append( ('ls_number', '!=', bad_ls) )
+        if len(bad_lumis) > 0:
+            filters.append( ('ls_number', 'not in', [int(bad_ls) for bad_ls in bad_lumis]) )
     
-    
-    df = ParquetDataset(file, filters=filters).read().to_pandas()
-    #print(df.head())
+    data, df = read_parquet_histograms(file, filters=filters)
     #After filtering with the OMS JSON, the dataframe can be empty
-    if df.empty:
-        return np.empty(0), np.empty(0)
     #Just return two empty arrays? Don't want to raise an exception
-    
-    #For some reason the x/y bins are floats, not integers
-    xbins = int(df['x_bin'][0])
-    ybins = int(df['y_bin'][0])
-    
-    #Since we are only looking at ONE run_number, hists is just an array of length one
-    hists = np.array(df['data'])
-    runs = np.array(df['run_number'])
+    if len(df) == 0:
+        return np.empty(0), np.empty(0)
     lumis = np.array(df['ls_number'])
-    #print("EXTRACTED LUMISECTIONS: ", lumis)
-    
-    #Extract the data in the required way
-    #print(hists.shape)
-    data = np.stack(hists)
-    #print(data.shape)
-    #Sadly, stack, dstack, vstack, and hstack don't seem to work on the second (92 length) dimension. 
-    #Even with the axis parameter, I can't seem to find a way to stack the xbins object into
-    #a fully 3D array. So we have to follow Luka and loop over each lumisection. 
-    #Luckily this doesn't seem to add much time
-    #be careful to iterate over the length of the lumi array, not lumi_end-lumi_start+1, since we could be missing lumis. 
-    #Lumisections w/o data are not saved into the parquet file (eg. 2024EraC Ring 1 Run 380043 LS 353-355)
-    data2 = np.array([np.stack(data[i]) for i in range(len(lumis))])
-
-    #print("Returned Data Shape: ", data2.shape)
+
     #Return the data and an array of the lumisections found
-    return data2, lumis
+    return data, lumis
 
 
 #Extract all of the runs and lumis from a single era
@@ -191,6 +177,7 @@ def extract_data_2d_all_lumis(file, run_number, oms_json=None, extra_filters=Non
 #run_number, ls_number, ...
 #The way we exclude single runs and sequences of runs is by adding the optional extra_filters parameter
 #Pass in filters in an array in the form [('run_number', '!=', 12345), ('run_number', '>', 56789)]
+#Note: the returned dataframe does not contain the data column (the histograms are returned as numpy array)
 def extract_data_whole_era(file, oms_json=None, extra_filters=None):
     #Take in a .parquet data file containing a pandas dataframe of runs/lumis
     #and return the 2D array of data from that specific run
@@ -219,10 +206,12 @@ def extract_data_whole_era(file, oms_json=None, extra_filters=None):
         #Need to rename one column so we can join
         oms_df.rename(columns={'lumisection_number': 'ls_number'}, inplace=True)
     
+    #Import the histograms and all other columns of the parquet dataset
     #Sometimes we need to add extra filters to exclude single runs or sequences of runs
-    if len(extra_filters) == 0: extra_filters = None #ParquetDataset needs None, not []
-    #Import the parquet dataset
-    df = ParquetDataset(file, filters=extra_filters).read().to_pandas()
+    columns = [name for name in ParquetDataset(file).schema.names if name != 'data']
+    data, df = read_parquet_histograms(file, columns=columns, filters=extra_filters)
+    #Keep track of the row of each lumisection in the data array
+    df['_row'] = np.arange(len(df))
     #join the two dataframes. NOTE: this does NOT create NaN's. It will only contain data that is present in BOTH dataframes
     #It is possible that there is a lumisection that is present in oms_JSON and not in the parquet file, 
     #And vice-versa. If that happens, the extra lumisection will just be thrown out. The number of rows
@@ -245,27 +234,106 @@ def extract_data_whole_era(file, oms_json=None, extra_filters=None):
                               (dataset["tecp_ready"] == True) & (dataset["tecm_ready"] == True)]
     else:
         passed_lumis_df = df
-    #Since we are only looking at ONE run_number, hists is just an array of length one
-    hists = np.array(passed_lumis_df['data'])
     runs = np.array(passed_lumis_df['run_number'])
     lumis = np.array(passed_lumis_df['ls_number'])
-    #print("EXTRACTED LUMISECTIONS: ", lumis)
-
-    #Extract the data in the required way
-    #print(hists.shape)
-    data = np.stack(hists)
-    #print(data.shape)
-    #Sadly, stack, dstack, vstack, and hstack don't seem to work on the second (92 length) dimension. 
-    #Even with the axis parameter, I can't seem to find a way to stack the xbins object into
-    #a fully 3D array. So we have to follow Luka and loop over each lumisection. 
-    #Luckily this doesn't seem to add much time
-    #be careful to iterate over the length of the lumi array, not lumi_end-lumi_start+1, since we could be missing lumis. 
-    #Lumisections w/o data are not saved into the parquet file (eg. 2024EraC Ring 1 Run 380043 LS 353-355)
-    data2 = np.array([np.stack(data[i]) for i in range(len(lumis))])
-
-    #print("Returned Data Shape: ", data2.shape)
+
+    #Select the histograms of the passing lumisections (no copy if all of them pass)
+    rows = np.array(passed_lumis_df['_row'])
+    if not np.array_equal(rows, np.arange(len(data))): data = data[rows]
+    passed_lumis_df = passed_lumis_df.drop(columns=['_row'])
+
     #Return the data and an array of the lumisections found
-    return data2, runs, lumis, passed_lumis_df
+    return data, runs, lumis, passed_lumis_df
+
+
+#Read the DCS flags from the oms_json file into sorted arrays for fast lookups
+#Return a tuple of (run_number, lumisection_number) pairs sorted on (run, lumi)
+#and a boolean array that is True for the lumisections that pass ALL DCS flags
+#Note: if a lumisection appears more than once in the oms_json file, the first occurrence is used
+DCS_FLAGS = ["beams_stable", "cms_active", "bpix_ready", "fpix_ready",
+             "tibtid_ready", "tob_ready", "tecp_ready", "tecm_ready"]
+
+def load_DCS_flags(oms_json):
+    with open(oms_json, 'r') as f:
+        oms_filters = json.load(f)
+    runs = np.array(oms_filters['run_number'], dtype=np.int64)
+    lumis = np.array(oms_filters['lumisection_number'], dtype=np.int64)
+    passed = np.ones(len(runs), dtype=bool)
+    for key in DCS_FLAGS:
+        passed &= (np.array(oms_filters[key]) == True)
+    order = np.lexsort((lumis, runs))
+    return (runs[order], lumis[order]), passed[order]
+
+#Find the given lumisections in the sorted DCS flags (see load_DCS_flags)
+#Return two boolean arrays: True for the lumisections that are present in the DCS flags,
+#and True for the lumisections that are present AND pass the DCS flags
+def lookup_DCS_flags(dcs_keys, dcs_passed, runs, lumis):
+    dcs_runs, dcs_lumis = dcs_keys
+    #Binary search on the run number first, then on the lumisection number within the run
+    start = np.searchsorted(dcs_runs, runs, side='left')
+    stop = np.searchsorted(dcs_runs, runs, side='right')
+    idx = np.zeros(len(runs), dtype=np.int64)
+    for run in np.unique(runs):
+        mask = (runs == run)
+        run_start, run_stop = start[mask][0], stop[mask][0]
+        idx[mask] = run_start + np.searchsorted(dcs_lumis[run_start:run_stop], lumis[mask], side='left')
+    found = (idx < stop)
+    found[found] = (dcs_lumis[idx[found]] == lumis[found])
+    return found, found & dcs_passed[np.minimum(idx, len(dcs_passed)-1)]
+
+#Streaming version of extract_data_whole_era: loop over an era in blocks of lumisections
+#Pass in a parquet file (or directory), and optionally the DCS Flags JSON and extra filters
+#(in the form [('run_number', '!=', 12345), ('run_number', '>', 56789)]).
+#The parquet file is read batch by batch (read_batch_size lumisections at a time), the DCS flags are
+#joined and applied per batch, and the passing lumisections are yielded in blocks of batch_size
+#(the last block can be smaller), so that the memory usage does not depend on the size of the era.
+#Yields tuples of (data of shape (batch_size, ybins, xbins), run numbers, lumisection numbers)
+#The oms_json can also be the output of load_DCS_flags (to avoid reading the json file again for every call).
+#Note: the lumisections are the same (and in the same order) as returned by extract_data_whole_era,
+#      except that lumisections that are duplicated in the oms_json file are yielded only once.
+def iter_era_batches(file, oms_json=None, extra_filters=None, batch_size=1000, read_batch_size=None, verbose=True):
+    if read_batch_size is None: read_batch_size = batch_size
+    dcs_keys, dcs_passed = (None, None)
+    if isinstance(oms_json, tuple): dcs_keys, dcs_passed = oms_json
+    elif oms_json != None: dcs_keys, dcs_passed = load_DCS_flags(oms_json)
+    #Predicate pushdown of the extra filters
+    filter_expression = None
+    if extra_filters is not None and len(extra_filters) > 0:
+        filter_expression = pq.filters_to_expression(extra_filters)
+    dataset = ds.dataset(file, format='parquet')
+    batches = dataset.to_batches(columns=['data', 'run_number', 'ls_number'], filter=filter_expression,
+                                 batch_size=read_batch_size)
+    #Buffer of passing lumisections that were not yet yielded
+    buffer = []
+    nbuffer = 0
+    ntot, nmissing, npassed = 0, 0, 0
+    for batch in batches:
+        if batch.num_rows == 0: continue
+        runs = batch.column('run_number').to_numpy()
+        lumis = batch.column('ls_number').to_numpy()
+        data = list_column_to_numpy(batch.column('data'))
+        ntot += len(runs)
+        #Join with the DCS flags and keep only the lumisections that pass
+        if dcs_keys is not None:
+            found, passed = lookup_DCS_flags(dcs_keys, dcs_passed, runs, lumis)
+            nmissing += np.sum(~found)
+            if not np.all(passed):
+                data, runs, lumis = data[passed], runs[passed], lumis[passed]
+        npassed += len(runs)
+        buffer.append((data, runs, lumis))
+        nbuffer += len(runs)
+        #Yield full blocks
+        while nbuffer >= batch_size:
+            data, runs, lumis = [np.concatenate(arrays) for arrays in zip(*buffer)]
+            yield data[:batch_size], runs[:batch_size], lumis[:batch_size]
+            buffer = [(data[batch_size:], runs[batch_size:], lumis[batch_size:])]
+            nbuffer -= batch_size
+    #Yield the remaining lumisections
+    if nbuffer > 0:
+        yield tuple(np.concatenate(arrays) for arrays in zip(*buffer))
+    if verbose and nmissing > 0:
+        print(f"There are {nmissing} lumisections out of {ntot} that were thrown out due to no DCS flags present!")
+    if verbose: print(f"{npassed} out of {ntot} lumisections passed the DCS flags.")
 
 
 ################################################################################
@@ -841,30 +909,128 @@ def add_cross(data):
     return data
 
 
+#Vectorized version of the power group loop of Apply_model_to_era.ipynb (section 6):
+#takes the binary losses WITH the cross in the form (num_lumis, 92, 56)
+#and returns a boolean array of the form (num_lumis, 48), which is True if at least
+#anomaly_cutoff percent of the bins of the powergroup (in the order of optimized_powerGroupStringsList) are on
+def find_anomalous_powergroups(losses_binary_cross, ring, anomaly_cutoff=40):
+    anomalous = np.zeros((len(losses_binary_cross), len(optimized_powerGroupStringsList)), dtype=bool)
+    for j, powergroup in enumerate(optimized_powerGroupStringsList):
+        powerGroupSlice, diskSlice = powerGroupToIndex(powergroup, ring)
+        #Sum over the powergroup for all lumisections at once
+        powergroup_data = losses_binary_cross[:, powerGroupSlice, diskSlice]
+        size = powergroup_data[0].size if len(powergroup_data) > 0 else 0
+        anomalous[:, j] = np.sum(powergroup_data, axis=(1, 2)) >= int(anomaly_cutoff/100 * size)
+    return anomalous
+
+#Disk numbers and Single/Multi-Disk anomaly types of all pairs of powergroups
+#(in the order of optimized_powerGroupStringsList), so they are only computed once
+POWERGROUP_DISKS = [analyzePowerGroupString(pg)[2] for pg in optimized_powerGroupStringsList]
+POWERGROUP_MULTIDISK = np.array([[powerGroupsToAnomalyType(pg1, pg2) == "Multi-Disk"
+                                  for pg2 in optimized_powerGroupStringsList] for pg1 in optimized_powerGroupStringsList])
+ANOMALY_HEADERS = ["Run_Number", "Lumisection", "Powergroup", "Disk", "Ring_Num", "Anomaly_Type"]
+
+#Version of the anomaly type identification of Apply_model_to_era.ipynb (section 7) for a single run,
+#starting from the output of find_anomalous_powergroups.
+#Returns the detailed anomaly dataframe of that run (with the same rows and values as the notebook)
+def identify_anomaly_types(run_number, lumisections, anomalous, ring_num):
+    rows = []
+    is_anomalous = np.any(anomalous, axis=1)
+    for lumisection in np.unique(lumisections[is_anomalous]):
+        #All anomalous powergroups in this lumisection, in the order of optimized_powerGroupStringsList
+        indices = np.nonzero(is_anomalous & (lumisections == lumisection))[0]
+        pgs = np.concatenate([np.nonzero(anomalous[index])[0] for index in indices])
+        #If there are more than 10 anomalous powergroups, mark it as a Multi-Disk anomaly on the whole side
+        if len(pgs) > 10:
+            powergroup = ':'.join(str(optimized_powerGroupStringsList[pg]) for pg in pgs)
+            disk = "-1:-2:-3" if POWERGROUP_DISKS[pgs[0]] < 0 else "1:2:3"
+            rows.append([run_number, lumisection, powergroup, disk, ring_num, "Multi-Disk"])
+        #If there is only one powergroup, mark it as a Single disk anomaly
+        elif len(pgs) == 1:
+            rows.append([run_number, lumisection, str(optimized_powerGroupStringsList[pgs[0]]),
+                         POWERGROUP_DISKS[pgs[0]], ring_num, "Single-Disk"])
+        #Otherwise loop over all pairs of powergroups and search for multi-disk anomalies
+        else:
+            for k, pg1 in enumerate(pgs):
+                for pg2 in pgs[k+1:]:
+                    pgstring1 = str(optimized_powerGroupStringsList[pg1])
+                    pgstring2 = str(optimized_powerGroupStringsList[pg2])
+                    if POWERGROUP_MULTIDISK[pg1, pg2]:
+                        rows.append([run_number, lumisection, pgstring1 + ':' + pgstring2,
+                                     str(POWERGROUP_DISKS[pg1]) + ':' + str(POWERGROUP_DISKS[pg2]), ring_num, "Multi-Disk"])
+                    else:
+                        rows.append([run_number, lumisection, pgstring1, str(POWERGROUP_DISKS[pg1]), ring_num, "Single-Disk"])
+                        rows.append([run_number, lumisection, pgstring2, str(POWERGROUP_DISKS[pg2]), ring_num, "Single-Disk"])
+    #Remove all exact duplicate rows
+    return pd.DataFrame(rows, columns=ANOMALY_HEADERS, dtype=object).drop_duplicates()
+
+
 # Identify and condense runs of consecutive lumisections for each powergroup
 def condense_lumisection_runs(anomaly_df):
     """
     Input: DataFrame with columns 'Lumisection' and 'Powergroup'
     Output: DataFrame with columns ['Powergroup', 'Start_Lumisection', 'End_Lumisection']
     """
-    condensed_rows = []
-    # Group by powergroup
-    for (run_number, powergroup, disk, ring_num, anomaly_type), group in anomaly_df.groupby(['Run_Number', 'Powergroup', 'Disk', 'Ring_Num', 'Anomaly_Type']):
-        lumis = sorted(group['Lumisection'].unique())
-        #print("ksjfng", group['Disk'])
-        if not lumis:
-            continue
-        start = end = lumis[0]
-        for ls in lumis[1:]:
-            if ls == end + 1:
-                end = ls
-            else:
-                condensedDict = {'Run_Number': run_number, 'Start_LS': start, 'End_LS': end, 'Num_LS': end-start+1, 'Powergroup': powergroup, 'Disk': disk, 'Ring_Num': ring_num, 'Anomaly_Type': anomaly_type}
-                condensed_rows.append(condensedDict)
-                start = end = ls
-        condensed_rows.append({'Run_Number': run_number, 'Start_LS': start, 'End_LS': end, 'Num_LS': end-start+1, 'Powergroup': powergroup, 'Disk': disk, 'Ring_Num': ring_num, 'Anomaly_Type': anomaly_type})
-    return pd.DataFrame(condensed_rows)
-
+    keys = ['Run_Number', 'Powergroup', 'Disk', 'Ring_Num', 'Anomaly_Type']
+    # Number of the group of each row (in the same order as looping over the groupby,
+    # and NaN for rows that are dropped by the groupby)
+    group_ids = anomaly_df.groupby(keys).ngroup().to_numpy()
+    rows = np.nonzero(~np.isnan(group_ids))[0] if group_ids.dtype.kind == 'f' else np.arange(len(group_ids))
+    if len(rows) == 0:
+        return pd.DataFrame([])
+    group_ids = group_ids[rows].astype(np.int64)
+    lumis = np.array(anomaly_df['Lumisection'].iloc[rows].tolist())
+    # The key values of each group are taken from its first row
+    _, first_rows = np.unique(group_ids, return_index=True)
+    first_rows = rows[first_rows]
+    # Sort once by group and lumisection, and remove duplicate lumisections within a group
+    order = np.lexsort((lumis, group_ids))
+    group_ids, lumis = group_ids[order], lumis[order]
+    keep = np.ones(len(lumis), dtype=bool)
+    keep[1:] = (group_ids[1:] != group_ids[:-1]) | (lumis[1:] != lumis[:-1])
+    group_ids, lumis = group_ids[keep], lumis[keep]
+    # A new run of lumisections starts at each new group, or when the lumisections are not consecutive
+    is_start = np.ones(len(lumis), dtype=bool)
+    is_start[1:] = (group_ids[1:] != group_ids[:-1]) | (lumis[1:] != lumis[:-1] + 1)
+    starts = np.nonzero(is_start)[0]
+    ends = np.append(starts[1:], len(lumis)) - 1
+    first_rows = first_rows[group_ids[starts]]
+    condensed = {
+        'Run_Number': anomaly_df['Run_Number'].to_numpy()[first_rows].tolist(),
+        'Start_LS': lumis[starts].tolist(),
+        'End_LS': lumis[ends].tolist(),
+        'Num_LS': (lumis[ends] - lumis[starts] + 1).tolist(),
+    }
+    for key in keys[1:]:
+        condensed[key] = anomaly_df[key].to_numpy()[first_rows].tolist()
+    return pd.DataFrame(condensed)
+
+
+#Intern colon separated lists of names (e.g. 'FPix_BmO_D3_ROG4:FPix_BmO_D2_ROG4' or '-1:-2') as bitmasks,
+#so that sets of names can be merged with a bitwise OR instead of splitting and joining strings.
+#The bits follow the sorted (np.unique) order of the names, and each distinct string is only split once.
+#Returns an array of bitmasks of shape (len(values), number of 64-bit words) and the sorted names
+def colon_strings_to_bitmasks(values):
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object), use_na_sentinel=False)
+    splitted = [str(value).split(':') for value in uniques]
+    names = np.unique(np.hstack(splitted)) if len(splitted) > 0 else np.array([], dtype=str)
+    bits = {name: i for i, name in enumerate(names)}
+    unique_masks = np.zeros((len(uniques), max(1, (len(names)+63)//64)), dtype=np.uint64)
+    for i, parts in enumerate(splitted):
+        for name in parts:
+            unique_masks[i, bits[name]//64] |= np.uint64(1) << np.uint64(bits[name] % 64)
+    return unique_masks[codes], names
+
+#Return the (sorted) names of the bits that are set in a bitmask made by colon_strings_to_bitmasks
+def bitmask_to_names(mask, names):
+    bits = np.unpackbits(np.asarray(mask, dtype='<u8').view(np.uint8), bitorder='little')
+    return names[np.nonzero(bits[:len(names)])[0]]
+
+#Render bitmasks as colon separated strings (each distinct bitmask is only rendered once)
+def bitmasks_to_colon_strings(masks, names):
+    unique_masks, inverse = np.unique(masks, axis=0, return_inverse=True)
+    strings = [':'.join(bitmask_to_names(mask, names)) for mask in unique_masks]
+    return [strings[i] for i in inverse.reshape(-1)]
 
 # Identify and condense runs of consecutive Start_LS and End_LS for each ['Start_LS', 'End_LS']
 def condense_powergroup_overlap(anomaly_df, verbose=False):
@@ -872,47 +1038,39 @@ def condense_powergroup_overlap(anomaly_df, verbose=False):
     Input: DataFrame with columns 'Lumisection' and 'Powergroup'
     Output: DataFrame with columns ['Powergroup', 'Start_Lumisection', 'End_Lumisection']
     """
-    condensed_rows = []
-    # Group by powergroup
-    for (run_number, start_ls, end_ls, num_ls, ring_num), group in anomaly_df.groupby(['Run_Number', 'Start_LS', 'End_LS', 'Num_LS', 'Ring_Num']):
-        #lumis = sorted(group['Lumisection'].unique())
-        #print("ksjfng", group["Disk"])
-        
-        #Get all of the powergroups in this anomalous set and get rid of duplicates
-        powergroups_raw = group["Powergroup"].to_list()
-        powergroup_list = []
-        for powergroup in powergroups_raw:
-            powergroups = powergroup.split(':')
-            #if verbose: print(powergroups)
-            powergroup_list.append(powergroups)
-        powergroup_list = np.hstack(powergroup_list)
-        powergroup_list = np.unique(powergroup_list)
-        #print(powergroup_list) #we now have a list of all of the anomalous powergroups
-        powergroup_list_string = ':'.join(powergroup_list)
-        if verbose: print(f"There are {len(powergroup_list)} Anomalous Powergroups from Lumisection {start_ls} to {end_ls} in Run Number {run_number}:\n{powergroup_list}\n") #and now it is in string form with colon separators. NOTE: IT MAY NOT BE IN ORDER BY DISK
-        
-        #Now we find all of the disks with anomalies
-        disks_raw = group["Disk"].to_list()
-        disk_list = []
-        for disk in disks_raw:
-            #print("DISK: ", disk)
-            disk = str(disk)
-            disks = disk.split(':')
-            #print(disks)
-            disk_list.append(disks)
-        disk_list = np.hstack(disk_list)
-        disk_list = np.unique(disk_list)
-        #print(powergroup_list) #we now have a list of all of the anomalous powergroups
-        disk_list_string = ':'.join(disk_list)
-        #print(disk_list_string) #and now it is in string form with colon separators. NOTE: IT MAY NOT BE IN ORDER BY DISK
-        
-        #Now we see if ANY of the anomaly types are Multi-Disk, or are they all Single-Disk
-        anomalies = group["Anomaly_Type"]
-        if anomalies.isin(["Multi-Disk"]).any():
-            anomaly_type = "Multi-Disk"
-        else:
-            anomaly_type = "Single-Disk"
-        
-        condensed_rows.append({'Run_Number': run_number, 'Start_LS': start_ls, 'End_LS': end_ls, 'Num_LS': num_ls, 'Powergroup': powergroup_list_string, 'Disk': disk_list_string, 'Ring_Num': ring_num, 'Anomaly_Type': anomaly_type})
-    return pd.DataFrame(condensed_rows)
+    keys = ['Run_Number', 'Start_LS', 'End_LS', 'Num_LS', 'Ring_Num']
+    # Number of the group of each row (in the same order as looping over the groupby,
+    # and NaN for rows that are dropped by the groupby)
+    group_ids = anomaly_df.groupby(keys).ngroup().to_numpy()
+    rows = np.nonzero(~np.isnan(group_ids))[0] if group_ids.dtype.kind == 'f' else np.arange(len(group_ids))
+    if len(rows) == 0:
+        return pd.DataFrame([])
+    # Sort the rows by group (stable, so the first row of each group comes first)
+    order = np.argsort(group_ids[rows], kind='stable')
+    rows = rows[order]
+    group_ids = group_ids[rows]
+    starts = np.nonzero(np.concatenate(([True], group_ids[1:] != group_ids[:-1])))[0]
+
+    # Merge all of the powergroups and disks in each group (getting rid of duplicates) with a bitwise OR
+    powergroup_masks, powergroup_names = colon_strings_to_bitmasks(anomaly_df['Powergroup'].to_numpy()[rows])
+    powergroup_masks = np.bitwise_or.reduceat(powergroup_masks, starts, axis=0)
+    disk_masks, disk_names = colon_strings_to_bitmasks(anomaly_df['Disk'].to_numpy()[rows])
+    disk_masks = np.bitwise_or.reduceat(disk_masks, starts, axis=0)
+
+    # Now we see if ANY of the anomaly types are Multi-Disk, or are they all Single-Disk
+    is_multi = np.logical_or.reduceat(anomaly_df['Anomaly_Type'].to_numpy()[rows] == "Multi-Disk", starts)
+
+    # The key values of each group are taken from its first row
+    first_rows = rows[starts]
+    condensed = {key: anomaly_df[key].to_numpy()[first_rows].tolist() for key in keys[:4]}
+    # Render the powergroup and disk lists as strings with colon separators (NOTE: IT MAY NOT BE IN ORDER BY DISK)
+    condensed['Powergroup'] = bitmasks_to_colon_strings(powergroup_masks, powergroup_names)
+    condensed['Disk'] = bitmasks_to_colon_strings(disk_masks, disk_names)
+    condensed['Ring_Num'] = anomaly_df['Ring_Num'].to_numpy()[first_rows].tolist()
+    condensed['Anomaly_Type'] = ["Multi-Disk" if multi else "Single-Disk" for multi in is_multi]
+    if verbose:
+        for i in range(len(starts)):
+            powergroup_list = bitmask_to_names(powergroup_masks[i], powergroup_names)
+            print(f"There are {len(powergroup_list)} Anomalous Powergroups from Lumisection {condensed['Start_LS'][i]} to {condensed['End_LS'][i]} in Run Number {condensed['Run_Number'][i]}:\n{powergroup_list}\n")
+    return pd.DataFrame(condensed)
 
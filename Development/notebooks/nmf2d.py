@@ -16,15 +16,94 @@ class NMF2D(object):
         X = np.reshape(X, (X.shape[0], -1))
         self.nmf.partial_fit(X)
         
+        # post-processing
+        self.normalize()
+
+    def normalize(self):
         # post-processing: scaling
         means = np.mean(self.nmf.components_, axis=1)
         self.nmf.components_ = np.divide(self.nmf.components_, means[:, None])
         
         # post-processing: reshape back to input dimensions
         self.components = np.reshape(self.nmf.components_, (-1, *self.xshape))
-        
+
+    def fit_stream(self, batches, epochs=1, minibatch_size=None, shuffle_buffer=None,
+                   preprocess=None, monitor_size=200, tol=1e-4, patience=1, seed=None, verbose=False):
+        '''
+        Fit the components on a stream of batches (out-of-core),
+        with repeated calls to MiniBatchNMF.partial_fit, so that the whole dataset never needs to be in memory.
+        Input arguments:
+        - batches: a function that returns an iterable over batches (np arrays of shape (n, ybins, xbins)),
+          called once per epoch, e.g. lambda: (data for data, _, _ in iter_era_batches(file, oms_json)),
+          or a list of batches.
+        - epochs: maximum number of passes over the data.
+        - minibatch_size: number of lumisections per partial_fit call (default: batch_size of the MiniBatchNMF).
+        - shuffle_buffer: if specified, collect this many lumisections and shuffle them before making minibatches
+          (the memory usage is then bounded by the buffer size; default: no shuffling).
+        - preprocess: function applied to each batch before fitting (e.g. lambda X: remove_cross(X, ring)).
+        - monitor_size: number of lumisections (the first ones in the stream) used to monitor convergence.
+        - tol: stop when the relative decrease of the reconstruction error on the monitor lumisections
+          after an epoch is smaller than this value for patience consecutive epochs.
+        - seed: seed for the shuffling.
+        Note: the components are normalized only once, at the end (see normalize).
+        Returns:
+        - list with the reconstruction error (mean squared error) on the monitor lumisections after each epoch.
+        '''
+        if minibatch_size is None: minibatch_size = self.nmf.batch_size
+        rng = np.random.default_rng(seed)
+        monitor = None
+        history = []
+        nstalled = 0
+
+        def fit_buffer(buffer):
+            # shuffle (if requested) and fit in minibatches
+            X = np.concatenate(buffer)
+            if shuffle_buffer is not None: X = X[rng.permutation(len(X))]
+            for start in range(0, len(X), minibatch_size):
+                self.nmf.partial_fit(X[start:start+minibatch_size])
+
+        for epoch in range(epochs):
+            buffer = []
+            nbuffer = 0
+            buffer_size = shuffle_buffer if shuffle_buffer is not None else minibatch_size
+            for X in (batches() if callable(batches) else batches):
+                if preprocess is not None: X = preprocess(X)
+                if len(X) == 0: continue
+                self.xshape = list(X.shape[1:])
+                X = np.reshape(X, (X.shape[0], -1))
+                # keep the first lumisections to monitor the convergence
+                # (only during the first epoch, so that the monitor set is the same after each epoch)
+                if epoch == 0 and (monitor is None or len(monitor) < monitor_size):
+                    nmonitor = 0 if monitor is None else len(monitor)
+                    new = X[:monitor_size-nmonitor]
+                    monitor = new.copy() if monitor is None else np.concatenate((monitor, new))
+                buffer.append(X)
+                nbuffer += len(X)
+                if nbuffer >= buffer_size:
+                    fit_buffer(buffer)
+                    buffer = []
+                    nbuffer = 0
+            if nbuffer > 0: fit_buffer(buffer)
+            if monitor is None:
+                raise Exception('No data found to fit the model.')
+
+            # convergence monitor
+            reco = self.nmf.inverse_transform(self.nmf.transform(monitor))
+            history.append(float(np.mean(np.square(reco - monitor))))
+            if verbose: print(f'Epoch {epoch+1}: reconstruction error {history[-1]:.4e}')
+            if len(history) > 1:
+                decrease = (history[-2] - history[-1]) / history[-2]
+                nstalled = nstalled + 1 if decrease < tol else 0
+                if nstalled >= patience:
+                    if verbose: print(f'Converged after {epoch+1} epochs.')
+                    break
+
+        # post-processing
+        self.normalize()
+        return history
+
     def predict(self, X):
         X = np.reshape(X, (X.shape[0], -1))
         Y = self.nmf.inverse_transform(self.nmf.transform(X))
         Y = np.reshape(Y, (-1, *self.xshape))
-        return Y
\ No newline at end of file
+        return Y
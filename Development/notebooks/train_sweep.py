@@ -0,0 +1,173 @@
+# Train NMF models for multiple configurations in parallel
+# (the command line version of the training steps in Train_model.ipynb).
+
+# usage example:
+#   python train_sweep.py sweep.json -o ../models/sweep -j 4
+
+# the configuration file is a json file of the following form:
+# {
+#   "datasets": [
+#     {"ring": 2, "period": 3, "run": 392642,
+#      "file": "../data/ZeroBias-Run2025C-PromptReco-v1-DQMIO-...-PXRing_2.parquet",
+#      "oms_json": "../omsdata/omsdata_Run2025C-v1.json",
+#      "extra_filters": [["ls_number", "!=", 168], ["ls_number", "<=", 960]]},
+#     ...
+#   ],
+#   "grid": {"n_components": [3, 5, 7], "beta_loss": ["frobenius"], "alpha_H": [0.1]},
+#   "settings": {"nbatches": 30, "batch_size": 3000, "max_iter": 1000}
+# }
+# every dataset is trained with every combination of the values in "grid"
+# (any keyword argument of MiniBatchNMF can be used in "grid" and "settings").
+# The training data of each dataset is read and decoded once, stored as .npy file in the output directory,
+# and shared read-only (memory-mapped) between the training processes.
+# Each model is saved with a version number that is increased instead of overwriting existing models
+# (the file names are reserved atomically in the main process before training),
+# and a summary table with the training time and losses of all models is written to the output directory.
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import joblib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from nmf2d import NMF2D
+from functions import extract_data_2d_all_lumis, remove_cross
+
+# default settings, as in Train_model.ipynb
+DEFAULT_SETTINGS = {
+    'nbatches': 30,
+    'n_components': 5,
+    'batch_size': 3000,
+    'forget_factor': 1,
+    'tol': 0.0,
+    'max_no_improvement': 100,
+    'max_iter': 1000,
+    'alpha_H': 0.1,
+    # fixed seed (not set in the notebook), so that the models of a sweep are reproducible
+    'random_state': 0,
+}
+
+
+def get_dataset_name(dataset):
+    return f'PXRing_{dataset["ring"]}_period_{dataset["period"]}_run_{dataset["run"]}'
+
+def get_dataset_hash(dataset):
+    #Short hash of the full dataset definition (including files and filters)
+    return hashlib.sha1(json.dumps(dataset, sort_keys=True).encode()).hexdigest()[:8]
+
+def get_model_name(dataset, params):
+    #The name contains the run and the hash of the dataset definition (as the prepared training data),
+    #so that models trained on different datasets never share a name
+    hyperparams = '_'.join(f'{key}_{val}' for key, val in sorted(params.items()))
+    return f'model_{get_dataset_name(dataset)}_{get_dataset_hash(dataset)}_{hyperparams}'
+
+def get_versioned_path(outputdir, name, extension='.pkl'):
+    #Never overwrite an existing file: reserve the first version number that does not exist yet
+    #by creating an empty file atomically (so that concurrent sweeps never get the same version)
+    version = 1
+    while True:
+        path = os.path.join(outputdir, f'{name}_v{version}{extension}')
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return path
+        except FileExistsError: version += 1
+
+def prepare_dataset(dataset, outputdir):
+    #Read and decode the training data of a dataset (once), remove the cross, and store it as .npy file
+    #(which is reused by later sweeps with the same dataset definition)
+    datafile = os.path.join(outputdir, 'data', f'{get_dataset_name(dataset)}_{get_dataset_hash(dataset)}.npy')
+    if os.path.exists(datafile): return datafile
+    extra_filters = [tuple(f) for f in dataset.get('extra_filters', [])]
+    data, lumis = extract_data_2d_all_lumis(dataset['file'], dataset['run'],
+                      oms_json=dataset.get('oms_json'), extra_filters=extra_filters)
+    if len(lumis) == 0:
+        raise Exception(f'No lumisections found for dataset {get_dataset_name(dataset)}.')
+    data = remove_cross(data, dataset['ring']).astype(float)
+    os.makedirs(os.path.dirname(datafile), exist_ok=True)
+    np.save(datafile, data)
+    print(f'Prepared dataset {get_dataset_name(dataset)}: {data.shape[0]} lumisections.')
+    return datafile
+
+def init_worker():
+    #Use one thread per process for the linear algebra, since the parallelism is over the processes
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError: pass
+
+def train_model(job):
+    #Train a single model (run in a separate process)
+    dataset, params, settings, datafile, modelfile = job
+    X = np.load(datafile, mmap_mode='r')
+    kwargs = {key: val for key, val in {**settings, **params}.items() if key != 'nbatches'}
+    nbatches = {**settings, **params}['nbatches']
+    start = time.perf_counter()
+    nmf = NMF2D(**kwargs)
+    for _ in range(nbatches): nmf.fit(X)
+    train_time = time.perf_counter() - start
+    reco = nmf.predict(X)
+    joblib.dump(nmf, modelfile)
+    return {
+        'model': os.path.basename(modelfile),
+        'ring': dataset['ring'],
+        'period': dataset['period'],
+        'run': dataset['run'],
+        **params,
+        'lumisections': X.shape[0],
+        'train_time (s)': round(train_time, 2),
+        'mse': float(np.mean(np.square(reco - X))),
+        'median_ls_mse': float(np.median(np.mean(np.square(reco - X), axis=(1, 2)))),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train NMF models for multiple configurations in parallel.")
+    parser.add_argument("config", help="Configuration file (json, see the top of this file).")
+    parser.add_argument("-o", "--outputdir", required=True, help="Output directory for the models and the summary table.")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of parallel processes (default: number of CPUs).")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the configurations.")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    settings = {**DEFAULT_SETTINGS, **config.get('settings', {})}
+    grid = config.get('grid', {})
+    combinations = [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+    print(f'{len(config["datasets"])} datasets x {len(combinations)} configurations')
+    if args.dry_run:
+        for dataset, params in itertools.product(config['datasets'], combinations):
+            print(f'  - {get_model_name(dataset, params)}')
+        sys.exit()
+
+    # read and decode the training data once per dataset (in the main process)
+    os.makedirs(args.outputdir, exist_ok=True)
+    datafiles = [prepare_dataset(dataset, args.outputdir) for dataset in config['datasets']]
+
+    # reserve the versioned model files (in the main process), and train all models in parallel
+    jobs = [(dataset, params, settings, datafile, get_versioned_path(args.outputdir, get_model_name(dataset, params)))
+            for dataset, datafile in zip(config['datasets'], datafiles) for params in combinations]
+    start = time.perf_counter()
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker) as pool:
+            for result in pool.map(train_model, jobs):
+                print(f'Trained {result["model"]} in {result["train_time (s)"]} s (mse: {result["mse"]:.4e})')
+                results.append(result)
+    finally:
+        # remove the reserved files of the models that were not trained (e.g. after an error)
+        for job in jobs:
+            if os.path.getsize(job[-1]) == 0: os.remove(job[-1])
+    print(f'Trained {len(results)} models in {time.perf_counter() - start:.1f} s.')
+
+    # write the summary table
+    summary = pd.DataFrame(results)
+    summaryfile = get_versioned_path(args.outputdir, 'summary', extension='.csv')
+    summary.to_csv(summaryfile, index=False)
+    print(summary.to_string(index=False))
+    print(f'Saved summary table at {summaryfile}')